@@ -0,0 +1,75 @@
+// Growable Int16 sample store for session audio.
+// Samples live in fixed-size preallocated Int16Array chunks plus a running length, so appends are
+// TypedArray.set copies (no per-sample push, no boxed numbers) and finalizing is one copy into
+// the destination buffer (e.g. the body of a WAV).
+
+const DEFAULT_CHUNK_SAMPLES = 32000; // 2s at 16kHz, 64KB per chunk
+
+export class AudioStore {
+  constructor(chunkSamples = DEFAULT_CHUNK_SAMPLES) {
+    this.chunkSamples = chunkSamples;
+    this.chunks = [];
+    this.tailUsed = 0;
+    this.length = 0;
+  }
+
+  // Append an Int16Array (or any array-like of numbers, converted once)
+  append(samples) {
+    if (!(samples instanceof Int16Array)) samples = Int16Array.from(samples);
+    let offset = 0;
+    while (offset < samples.length) {
+      if (this.chunks.length === 0 || this.tailUsed === this.chunkSamples) {
+        this.chunks.push(new Int16Array(this.chunkSamples));
+        this.tailUsed = 0;
+      }
+      const tail = this.chunks[this.chunks.length - 1];
+      const n = Math.min(samples.length - offset, this.chunkSamples - this.tailUsed);
+      tail.set(samples.subarray(offset, offset + n), this.tailUsed);
+      this.tailUsed += n;
+      offset += n;
+    }
+    this.length += samples.length;
+    return this.length;
+  }
+
+  // Copy samples [start, end) into target (an Int16Array) at targetOffset; returns samples copied
+  copyTo(target, targetOffset = 0, start = 0, end = this.length) {
+    start = Math.max(0, start);
+    end = Math.min(this.length, end);
+    let written = 0;
+    for (let c = Math.floor(start / this.chunkSamples); c < this.chunks.length && start + written < end; c++) {
+      const chunkStart = c * this.chunkSamples;
+      const from = start + written - chunkStart;
+      const to = Math.min(this.chunkSamples, end - chunkStart);
+      target.set(this.chunks[c].subarray(from, to), targetOffset + written);
+      written += to - from;
+    }
+    return written;
+  }
+
+  // Contiguous copy of samples [start, end)
+  toInt16Array(start = 0, end = this.length) {
+    const out = new Int16Array(Math.max(0, Math.min(this.length, end) - Math.max(0, start)));
+    this.copyTo(out, 0, start, end);
+    return out;
+  }
+
+  // Drop samples from `length` onwards (e.g. an utterance the VAD discarded)
+  truncate(length) {
+    if (length >= this.length) return;
+    if (length <= 0) {
+      this.clear();
+      return;
+    }
+    const keepChunks = Math.ceil(length / this.chunkSamples);
+    this.chunks.length = keepChunks;
+    this.tailUsed = length - (keepChunks - 1) * this.chunkSamples;
+    this.length = length;
+  }
+
+  clear() {
+    this.chunks = [];
+    this.tailUsed = 0;
+    this.length = 0;
+  }
+}
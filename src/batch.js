@@ -0,0 +1,345 @@
+// Offline transcription over HTTP: POST /transcribe with a whole recording as the request body (a
+// WAV file, or raw audio described by ?encoding= and ?sample_rate=). The body is read as a stream
+// and decoded to 16 kHz as it arrives. A SilenceSegmenter cuts the audio at pauses into segments of
+// at most max_segment_ms, and each segment goes to Whisper as soon as it closes, with at most
+// `concurrency` AI.run calls in flight. The calls go through the AI scheduler (src/scheduler.js) at
+// 'batch' priority, behind live turns and partial windows. The reply lists the segments in order
+// with their offsets and Whisper's words moved onto the recording's timeline, plus the joined text.
+// Mirrored by test/batch.py (same segmentation), which the stand-in serves and clients use.
+//
+// Memory stays bounded by the segments waiting for STT: once 2 x concurrency of them are pending
+// the body is not read further, so a slow model slows the upload instead of buffering the call.
+//
+// Status: 400 only for a body that is not audio in a supported format (BatchInputError, from the
+// header parser and the decoders); 503 when the model was out of time or capacity, so the upload
+// is worth retrying; 502 when every segment failed otherwise, and 500 for anything else.
+
+import { AudioStore } from './audio_store.js';
+import { INPUT_ENCODINGS, INPUT_SAMPLE_RATES, InputDecoder } from './codec.js';
+import { aiRunOutcome, now } from './metrics.js';
+import { TURN_BUDGET_EXHAUSTED } from './scheduler.js';
+import { buildWav, runStt } from './session.js';
+import { VAD_DEFAULTS, frameLevels } from './vad.js';
+
+const SAMPLE_RATE = 16000;
+const FRAME_MS = VAD_DEFAULTS.frameMs;
+const FRAME_SAMPLES = SAMPLE_RATE * FRAME_MS / 1000;
+const MAX_WAV_HEADER_BYTES = 64 * 1024;
+const WAV_FORMATS = { 1: 'pcm16', 6: 'alaw', 7: 'mulaw' }; // WAVE format tag -> input encoding
+
+export const BATCH_DEFAULTS = {
+  concurrency: 4,         // AI.run calls in flight
+  maxSegmentMs: 30000,    // Whisper's window; segments are cut at a pause before this
+  minSilenceMs: 300,      // pause long enough to end a segment
+  silenceDb: VAD_DEFAULTS.thresholdDb, // frame RMS level (dBFS) below which a frame is silence
+  minSpeechMs: VAD_DEFAULTS.minSpeechMs, // segments with less non-silent audio are not transcribed
+  hedge: false            // resend a segment still unanswered after Whisper's p95 latency
+};
+
+// ?concurrency=, ?max_segment_ms=, ?min_silence_ms=, ?silence_db=, ?hedge=1 over BATCH_DEFAULTS
+export function batchOptionsFromUrl(url) {
+  const params = new URL(url).searchParams;
+  const int = (name, min, max, fallback) => {
+    const n = Number(params.get(name) ?? NaN);
+    return Number.isFinite(n) ? Math.min(max, Math.max(min, Math.round(n))) : fallback;
+  };
+  return {
+    ...BATCH_DEFAULTS,
+    concurrency: int('concurrency', 1, 10, BATCH_DEFAULTS.concurrency),
+    maxSegmentMs: int('max_segment_ms', 5000, 30000, BATCH_DEFAULTS.maxSegmentMs),
+    minSilenceMs: int('min_silence_ms', 100, 2000, BATCH_DEFAULTS.minSilenceMs),
+    silenceDb: int('silence_db', -90, -10, BATCH_DEFAULTS.silenceDb),
+    hedge: params.get('hedge') === '1' || params.get('hedge') === 'true'
+  };
+}
+
+// Cuts a 16 kHz stream into segments at pauses. A segment may end once it is a third of
+// maxSegmentMs long, in the middle of the first pause of minSilenceMs; one that reaches
+// maxSegmentMs without such a pause is cut at its quietest frame past that third. push() and
+// flush() return the segments they closed: { index, start (sample offset), store, speechMs }.
+export class SilenceSegmenter {
+  constructor(options = {}) {
+    const o = { ...BATCH_DEFAULTS, ...options };
+    this.silenceDb = o.silenceDb;
+    this.maxFrames = Math.round(o.maxSegmentMs / FRAME_MS);
+    this.minFrames = Math.floor(this.maxFrames / 3);
+    this.minSilenceFrames = Math.max(1, Math.round(o.minSilenceMs / FRAME_MS));
+    this.frame = new Int16Array(FRAME_SAMPLES);
+    this.frameFill = 0;
+    this.store = new AudioStore();
+    this.levels = []; // dBFS of each whole frame of the current segment
+    this.start = 0;
+    this.index = 0;
+  }
+
+  push(samples) {
+    const closed = [];
+    this.store.append(samples);
+    let offset = 0;
+    while (offset < samples.length) {
+      const n = Math.min(samples.length - offset, FRAME_SAMPLES - this.frameFill);
+      this.frame.set(samples.subarray(offset, offset + n), this.frameFill);
+      this.frameFill += n;
+      offset += n;
+      if (this.frameFill < FRAME_SAMPLES) break;
+      this.frameFill = 0;
+      this.levels.push(frameLevels(this.frame).db);
+      const cut = this.cutFrame();
+      if (cut !== null) closed.push(this.cut(cut));
+    }
+    return closed;
+  }
+
+  flush() {
+    return this.store.length > 0 ? [this.cut(this.levels.length, true)] : [];
+  }
+
+  // Frame index to cut the current segment at, or null to keep growing it
+  cutFrame() {
+    const n = this.levels.length;
+    if (n < this.minFrames) return null;
+    let run = 0;
+    while (run < n && this.levels[n - 1 - run] < this.silenceDb) run++;
+    if (run >= this.minSilenceFrames && n - run >= this.minFrames) return n - Math.ceil(run / 2);
+    if (n < this.maxFrames) return null;
+    let quietest = this.minFrames;
+    for (let i = this.minFrames + 1; i < n; i++) if (this.levels[i] < this.levels[quietest]) quietest = i;
+    return quietest;
+  }
+
+  // Close frames [0, frame) as a segment (with `all`, every buffered sample) and keep the rest
+  cut(frame, all = false) {
+    const end = all ? this.store.length : frame * FRAME_SAMPLES;
+    const rest = new AudioStore();
+    rest.append(this.store.toInt16Array(end));
+    this.store.truncate(end);
+    const speechFrames = this.levels.slice(0, frame).filter((db) => db >= this.silenceDb).length;
+    const segment = { index: this.index++, start: this.start, store: this.store, speechMs: speechFrames * FRAME_MS };
+    this.store = rest;
+    this.levels = this.levels.slice(frame);
+    this.start += end;
+    return segment;
+  }
+}
+
+// The request body is not audio in a supported format (the client's fault: 400)
+export class BatchInputError extends Error {
+  constructor(message) {
+    super(message);
+    this.name = 'BatchInputError';
+  }
+}
+
+// Out of time (timeout, turn budget) or model capacity: worth retrying later
+function isOverload(err) {
+  const reason = err?.cause ?? err;
+  return reason?.message === TURN_BUDGET_EXHAUSTED || aiRunOutcome(reason) === 'timeout' ||
+    /\b3040\b|capacity/i.test(reason?.message ?? '');
+}
+
+// Format of a WAV header at the start of `bytes`: null while more bytes are needed
+export function parseWavHeader(bytes) {
+  const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+  const tag = (offset) => String.fromCharCode(...bytes.subarray(offset, offset + 4));
+  if (bytes.length < 12) return null;
+  if (tag(0) !== 'RIFF' || tag(8) !== 'WAVE') throw new BatchInputError('not a RIFF/WAVE file');
+  let format = null;
+  let offset = 12;
+  while (offset + 8 <= bytes.length) {
+    const id = tag(offset);
+    const size = view.getUint32(offset + 4, true);
+    if (id === 'data') {
+      if (!format) throw new BatchInputError('WAV data chunk before its fmt chunk');
+      // Streamed WAVs leave the data size 0 or 0xFFFFFFFF: read to the end of the body then
+      return { ...format, dataOffset: offset + 8, dataBytes: size > 0 && size < 0xFFFFFFFF ? size : Infinity };
+    }
+    if (id === 'fmt ') {
+      if (offset + 8 + 16 > bytes.length) return null;
+      const tagValue = view.getUint16(offset + 8, true);
+      const bits = view.getUint16(offset + 22, true);
+      const encoding = WAV_FORMATS[tagValue];
+      if (!encoding || bits !== (encoding === 'pcm16' ? 16 : 8)) {
+        throw new BatchInputError(`unsupported WAV format ${tagValue} with ${bits}-bit samples (16-bit PCM, 8-bit mu-law or A-law)`);
+      }
+      format = { encoding, channels: view.getUint16(offset + 10, true), sampleRate: view.getUint32(offset + 12, true) };
+    }
+    offset += 8 + size + (size & 1);
+  }
+  if (bytes.length > MAX_WAV_HEADER_BYTES) throw new BatchInputError('no WAV data chunk in the first 64 KB');
+  return null;
+}
+
+// Decoder for the body: its WAV header, else ?encoding= / ?sample_rate= / ?channels= (pcm16 at 16 kHz)
+function bodyDecoder(format) {
+  if (!INPUT_ENCODINGS.includes(format.encoding) || format.encoding === 'opus') {
+    throw new BatchInputError(`unsupported encoding ${format.encoding} (pcm16, mulaw or alaw)`);
+  }
+  if (!INPUT_SAMPLE_RATES.includes(format.sampleRate)) {
+    throw new BatchInputError(`unsupported sample rate ${format.sampleRate} (${INPUT_SAMPLE_RATES.join(', ')} Hz)`);
+  }
+  if (!(format.channels >= 1 && format.channels <= 2)) throw new BatchInputError(`unsupported channel count ${format.channels}`);
+  try {
+    return new InputDecoder(format.encoding, format.sampleRate, SAMPLE_RATE, format.channels);
+  } catch (err) {
+    throw new BatchInputError(err?.message);
+  }
+}
+
+function decodeBody(decoder, bytes) {
+  try {
+    return decoder.decodeBytes(bytes);
+  } catch (err) {
+    throw new BatchInputError(`undecodable ${decoder.encoding} audio: ${err?.message}`);
+  }
+}
+
+function rawFormat(url) {
+  const params = new URL(url).searchParams;
+  return {
+    encoding: params.get('encoding') ?? 'pcm16',
+    sampleRate: Number(params.get('sample_rate') ?? SAMPLE_RATE),
+    channels: Number(params.get('channels') ?? 1)
+  };
+}
+
+// Runs tasks with at most `limit` in flight
+function createLimiter(limit) {
+  let active = 0;
+  const queue = [];
+  const limiter = {
+    maxActive: 0,
+    run: (task) => new Promise((resolve, reject) => {
+      queue.push({ task, resolve, reject });
+      next();
+    }),
+    get pending() {
+      return active + queue.length;
+    }
+  };
+  const next = () => {
+    while (active < limit && queue.length > 0) {
+      const { task, resolve, reject } = queue.shift();
+      active++;
+      limiter.maxActive = Math.max(limiter.maxActive, active);
+      task().then(resolve, reject).finally(() => {
+        active--;
+        next();
+      });
+    }
+  };
+  return limiter;
+}
+
+const toMs = (samples) => Math.round(samples * 1000 / SAMPLE_RATE);
+const round3 = (s) => Math.round(s * 1000) / 1000;
+
+async function transcribeSegment(env, segment, options) {
+  const result = { index: segment.index, start_ms: toMs(segment.start), end_ms: toMs(segment.start + segment.store.length), text: '' };
+  if (segment.speechMs < options.minSpeechMs) return { ...result, skipped: true };
+  const startedAt = now();
+  try {
+    const stt = await runStt(env, buildWav(segment.store), { priority: 'batch', hedge: options.hedge });
+    const offset = segment.start / SAMPLE_RATE;
+    result.text = (stt?.text ?? '').trim();
+    if (Array.isArray(stt?.words)) {
+      result.words = stt.words.map((w) => ({ word: w.word, start: round3(w.start + offset), end: round3(w.end + offset) }));
+    }
+  } catch (err) {
+    result.error = err?.message;
+    if (isOverload(err)) result.overloaded = true;
+  }
+  result.stt_ms = Math.round(now() - startedAt);
+  return result;
+}
+
+// POST /transcribe (src/worker.js)
+export async function handleTranscribeRequest(request, env) {
+  if (!request.body) return Response.json({ error: 'empty body' }, { status: 400 });
+  const options = batchOptionsFromUrl(request.url);
+  const segmenter = new SilenceSegmenter(options);
+  const limiter = createLimiter(options.concurrency);
+  const results = [];
+  const inFlight = new Set();
+  const startedAt = now();
+  let decoder = null;
+  let head = null; // bytes before the WAV data chunk (or the format check) was complete
+  let carry = new Uint8Array(0); // bytes of an incomplete sample frame
+  let remaining = Infinity; // audio bytes left in the body
+
+  const submit = (segments) => {
+    for (const segment of segments) {
+      const p = limiter.run(() => transcribeSegment(env, segment, options)).then((r) => {
+        results[segment.index] = r;
+        inFlight.delete(p);
+      });
+      inFlight.add(p);
+    }
+  };
+
+  const reader = request.body.getReader();
+  try {
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      let bytes = value;
+      if (!decoder) {
+        head = head ? concatBytes(head, bytes) : bytes;
+        const isWav = head.length >= 4 && String.fromCharCode(...head.subarray(0, 4)) === 'RIFF';
+        if (head.length < 4) continue;
+        const format = isWav ? parseWavHeader(head) : { ...rawFormat(request.url), dataOffset: 0, dataBytes: Infinity };
+        if (!format) continue;
+        decoder = bodyDecoder(format);
+        bytes = head.subarray(format.dataOffset);
+        remaining = format.dataBytes;
+        head = null;
+      }
+      // Chunks after the WAV data chunk (LIST metadata) are not audio
+      if (bytes.length > remaining) bytes = bytes.subarray(0, remaining);
+      remaining -= bytes.length;
+      if (carry.length > 0) bytes = concatBytes(carry, bytes);
+      const whole = bytes.length - bytes.length % decoder.bytesPerSample;
+      carry = bytes.slice(whole);
+      submit(segmenter.push(decodeBody(decoder, bytes.subarray(0, whole))));
+      // Backpressure: stop reading while the model is behind
+      while (limiter.pending >= 2 * options.concurrency) await Promise.race(inFlight);
+    }
+  } catch (err) {
+    reader.cancel().catch(() => {});
+    await Promise.allSettled(inFlight);
+    const status = err instanceof BatchInputError ? 400 : isOverload(err) ? 503 : 500;
+    if (status === 500) console.error('POST /transcribe failed:', err);
+    return Response.json({ error: err?.message }, { status });
+  }
+  if (!decoder) return Response.json({ error: 'body too short for audio' }, { status: 400 });
+  submit(segmenter.flush());
+  await Promise.all(inFlight);
+
+  const transcribed = results.filter((r) => !r.skipped && !r.error);
+  const failed = results.filter((r) => r.error).length;
+  const body = {
+    text: transcribed.map((r) => r.text).filter(Boolean).join(' '),
+    duration_ms: toMs(segmenter.start),
+    segments: results,
+    stats: {
+      segments: results.length,
+      transcribed: transcribed.length,
+      skipped: results.filter((r) => r.skipped).length,
+      failed,
+      concurrency: options.concurrency,
+      max_in_flight: limiter.maxActive,
+      stt_ms: results.reduce((sum, r) => sum + (r.stt_ms ?? 0), 0),
+      elapsed_ms: Math.round(now() - startedAt)
+    }
+  };
+  // Partial results are still worth having; only a recording with no segment transcribed is an error
+  let status = 200;
+  if (failed > 0 && transcribed.length === 0) status = results.every((r) => !r.error || r.overloaded) ? 503 : 502;
+  return Response.json(body, { status });
+}
+
+function concatBytes(a, b) {
+  const out = new Uint8Array(a.length + b.length);
+  out.set(a);
+  out.set(b, a.length);
+  return out;
+}
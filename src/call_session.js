@@ -0,0 +1,312 @@
+// Durable Object that owns one call (one instance per session id, routed by src/worker.js).
+// The client socket is accepted with the WebSocket hibernation API, so a call that goes quiet is
+// evicted from memory instead of billing wall-clock time. Session state is checkpointed to storage:
+// `meta` holds options, counters, the recent conversation and the position of the sequenced input
+// stream, `audio:<n>` the buffered audio as the AudioStore's Int16Array chunks (a full chunk is
+// written once, the partial tail on every checkpoint). `meta` is written last, with the final
+// batch of chunks, and a restore keeps only the contiguous audio up to its `length`, so a
+// checkpoint cut short leaves the previous one readable. Audio that has not reached a checkpoint
+// yet is saved by an alarm shortly after the last message, before the socket can hibernate.
+// A fresh instance, after hibernation, eviction or a reconnect with the same session_id, resumes from there.
+import { createSession, createVad, describeStream, handleMessage, newStreamState, prepareInputDecoder, resetAcks, sessionConfigured } from './session.js';
+import { metricsResponse } from './metrics.js';
+
+const CHECKPOINT_SAMPLES = 16000;          // checkpoint after 1s of new audio (16kHz)
+const TAIL_FLUSH_MS = 2 * 1000;            // checkpoint unsaved audio once messages stop this long
+const ACTIVITY_CHECKPOINT_MS = 10 * 1000;  // keep the stored lastActivity at most this stale
+const IDLE_TIMEOUT_MS = 120 * 1000;        // close a silent socket (same as the in-isolate session)
+const RESUME_WINDOW_MS = 10 * 60 * 1000;   // keep state for a reconnect after the socket is gone
+const STORAGE_BATCH = 128;                 // max keys per storage put/delete call
+const AUDIO_KEY_PREFIX = 'audio:';
+const WS_OPEN = 1;
+
+const audioKey = (index) => AUDIO_KEY_PREFIX + String(index).padStart(6, '0');
+
+export class CallSession {
+  constructor(state, env) {
+    this.state = state;
+    this.env = env;
+    this.session = null;
+    this.loading = null;
+    this.persisted = { store: null, fullChunks: 0, keys: 0, length: 0, lastActivity: 0 };
+    this.checkpoints = Promise.resolve();
+    this.checkpointQueued = false;
+    this.tailFlushArmed = false;
+    this.decoderRejected = null; // the client is told once a socket is there (see reportDecoder)
+    // Replies go to whichever socket is live when they are sent, so a turn that was running when
+    // the client reconnected still delivers its transcript and audio
+    this.socket = {
+      send: (data) => {
+        const ws = this.liveSocket();
+        if (!ws) throw new Error('No client connected');
+        ws.send(data);
+      }
+    };
+  }
+
+  async fetch(request) {
+    const url = new URL(request.url);
+    // GET /metrics?session_id=<id>, forwarded by the worker: the histograms of this object's isolate
+    if (url.pathname === '/metrics' && request.headers.get('Upgrade') !== 'websocket') return metricsResponse();
+    const sessionId = url.searchParams.get('session_id');
+    const resumed = this.session !== null || (await this.state.storage.get('meta')) !== undefined;
+    const session = await this.getSession(request.url, sessionId);
+
+    // One live socket per call: a reconnect replaces the previous connection
+    for (const old of this.state.getWebSockets()) {
+      try { old.close(4000, 'Replaced by a newer connection'); } catch(e){}
+    }
+
+    const webSocketPair = new WebSocketPair();
+    const client = webSocketPair[0];
+    const server = webSocketPair[1];
+    this.state.acceptWebSocket(server);
+
+    session.lastActivity = Date.now();
+    resetAcks(session);
+    if (resumed) {
+      console.log(`Resumed session ${session.id} with ${session.audioBuffer.length} buffered samples`);
+      server.send(JSON.stringify({
+        type: 'session_resumed',
+        session_id: session.id,
+        buffer_size: session.audioBuffer.length,
+        response_seq: session.responseSeq,
+        stream: describeStream(session.stream),
+        timestamp: Date.now()
+      }));
+    } else {
+      console.log(`New WebSocket session: ${session.id}`);
+    }
+    this.reportDecoder(server);
+    await this.scheduleCheckpoint();
+    await this.state.storage.setAlarm(Date.now() + IDLE_TIMEOUT_MS);
+
+    return new Response(null, {
+      status: 101,
+      webSocket: client,
+    });
+  }
+
+  async webSocketMessage(ws, message) {
+    let session;
+    try {
+      session = await this.getSession();
+    } catch (err) {
+      try { ws.send(JSON.stringify({ type: 'error', message: 'Session expired', error: { message: err?.message } })); } catch(e){}
+      try { ws.close(4001, 'Session expired'); } catch(e){}
+      return;
+    }
+    this.reportDecoder(ws);
+    const optionsBefore = JSON.stringify(session.options);
+    const work = handleMessage(this.socket, session, this.env, message);
+    if (JSON.stringify(session.options) !== optionsBefore ||
+        session.lastActivity - this.persisted.lastActivity >= ACTIVITY_CHECKPOINT_MS) {
+      this.scheduleCheckpoint();
+    }
+    await this.armTailFlush();
+    // Stay awake until the work this message started (a turn, a partial window) settles
+    if (work) {
+      await work;
+      this.scheduleCheckpoint();
+    }
+  }
+
+  async webSocketClose(ws, code, reason) {
+    try { ws.close(); } catch(e){}
+    this.tailFlushArmed = false;
+    if (this.session) console.log(`Session ${this.session.id} closed (${code} ${reason || ''})`);
+    await this.scheduleCheckpoint();
+    if (!this.liveSocket()) await this.state.storage.setAlarm(Date.now() + RESUME_WINDOW_MS);
+  }
+
+  async webSocketError(ws, error) {
+    console.error(`Session ${this.session?.id} error:`, error);
+  }
+
+  // Tail flush and idle timeout while connected; expiry of the stored state once nobody reconnected
+  async alarm() {
+    let session;
+    try {
+      session = await this.getSession();
+    } catch (err) {
+      await this.state.storage.deleteAll();
+      return;
+    }
+    const now = Date.now();
+    const ws = this.liveSocket();
+    if (ws) {
+      if (this.tailFlushArmed) {
+        // Still streaming: wait for the messages to stop
+        if (now - session.lastActivity < TAIL_FLUSH_MS) {
+          await this.state.storage.setAlarm(session.lastActivity + TAIL_FLUSH_MS);
+          return;
+        }
+        this.tailFlushArmed = false;
+        if (this.unsaved()) await this.scheduleCheckpoint();
+      }
+      if (now - session.lastActivity < IDLE_TIMEOUT_MS) {
+        await this.state.storage.setAlarm(session.lastActivity + IDLE_TIMEOUT_MS);
+        return;
+      }
+      try { ws.send(JSON.stringify({ type: 'session_closed', reason: 'idle_timeout' })); } catch(e){}
+      try { ws.close(1000, 'Idle timeout'); } catch(e){}
+      console.log(`Session ${session.id} closed due to idle timeout`);
+      await this.state.storage.setAlarm(now + RESUME_WINDOW_MS);
+      return;
+    }
+    if (now - session.lastActivity < RESUME_WINDOW_MS) {
+      await this.state.storage.setAlarm(session.lastActivity + RESUME_WINDOW_MS);
+      return;
+    }
+    console.log(`Session ${session.id} expired`);
+    session.turn?.abort();
+    await this.checkpoints;
+    await this.state.storage.deleteAll();
+    this.session = null;
+    this.persisted = { store: null, fullChunks: 0, keys: 0, length: 0, lastActivity: 0 };
+  }
+
+  // A decoder that could not load when the session was created or restored (after eviction or
+  // hibernation) left it on pcm16: say so like a refused session_config, so the client stops sending Opus
+  reportDecoder(ws) {
+    if (!this.decoderRejected) return;
+    sessionConfigured(ws, this.session, this.decoderRejected);
+    this.decoderRejected = null;
+  }
+
+  // Buffered audio that no checkpoint holds yet (less than CHECKPOINT_SAMPLES of it)
+  unsaved() {
+    const store = this.session?.audioBuffer;
+    return !!store && (store !== this.persisted.store || store.length !== this.persisted.length);
+  }
+
+  // Arm the tail flush: the alarm replaces the idle one until it has run (alarm() re-arms that)
+  async armTailFlush() {
+    if (this.tailFlushArmed || !this.unsaved() || !this.liveSocket()) return;
+    this.tailFlushArmed = true;
+    await this.state.storage.setAlarm(Date.now() + TAIL_FLUSH_MS);
+  }
+
+  liveSocket() {
+    return this.state.getWebSockets().find((ws) => ws.readyState === WS_OPEN) || null;
+  }
+
+  // The in-memory session, restored from storage after hibernation or eviction (created when new)
+  async getSession(url = null, sessionId = null) {
+    if (this.session) return this.session;
+    this.loading ??= this.restore(url, sessionId).finally(() => { this.loading = null; });
+    return this.loading;
+  }
+
+  async restore(url, sessionId) {
+    const meta = await this.state.storage.get('meta');
+    if (!meta) {
+      if (!url) throw new Error('Session state not found');
+      const session = createSession(url, sessionId || undefined);
+      this.decoderRejected = await prepareInputDecoder(session);
+      return this.attach(session);
+    }
+    const session = createSession(null, meta.id);
+    session.debug = meta.debug;
+    session.options = { ...session.options, ...meta.options };
+    session.vad = createVad(session.options);
+    this.decoderRejected = await prepareInputDecoder(session);
+    session.responseSeq = meta.responseSeq;
+    session.history = meta.history ?? [];
+    // Checkpoints from before the reorder window lack its fields
+    if (meta.stream) session.stream = { ...newStreamState(), ...meta.stream, stats: { ...newStreamState().stats, ...meta.stream.stats } };
+    session.lastActivity = meta.lastActivity;
+    const store = session.audioBuffer;
+    const chunks = await this.state.storage.list({ prefix: AUDIO_KEY_PREFIX });
+    // Only audio:0..n in order, each full but the last, and no more than meta.length samples: a
+    // checkpoint cut short may have left chunks of a newer buffer or keys past the end
+    let keys = 0;
+    let contiguous = true;
+    for (const [key, samples] of chunks) {
+      const index = Number(key.slice(AUDIO_KEY_PREFIX.length));
+      keys = Math.max(keys, index + 1);
+      if (!contiguous || key !== audioKey(index) || index * store.chunkSamples !== store.length) {
+        contiguous = false;
+        continue;
+      }
+      const take = Math.min(samples.length, (meta.length ?? Infinity) - store.length);
+      if (take > 0) store.append(take < samples.length ? samples.subarray(0, take) : samples);
+      if (take < store.chunkSamples) contiguous = false;
+    }
+    if (meta.length !== undefined && store.length !== meta.length) {
+      console.warn(`Session ${meta.id}: restored ${store.length} of ${meta.length} checkpointed samples`);
+    }
+    this.persisted = {
+      store,
+      fullChunks: Math.floor(store.length / store.chunkSamples),
+      keys,
+      length: store.length,
+      lastActivity: meta.lastActivity
+    };
+    return this.attach(session);
+  }
+
+  attach(session) {
+    session.onBufferChange = () => this.bufferChanged();
+    this.session = session;
+    return session;
+  }
+
+  // Checkpoint after enough new audio, and at once when buffered audio was dropped or detached
+  bufferChanged() {
+    const store = this.session.audioBuffer;
+    const p = this.persisted;
+    if (store !== p.store || store.length < p.length || store.length - p.length >= CHECKPOINT_SAMPLES) {
+      this.scheduleCheckpoint();
+    }
+  }
+
+  // Checkpoints run one at a time; a request made while one is queued joins it
+  scheduleCheckpoint() {
+    if (this.checkpointQueued) return this.checkpoints;
+    this.checkpointQueued = true;
+    this.checkpoints = this.checkpoints.then(() => {
+      this.checkpointQueued = false;
+      return this.checkpoint();
+    }).catch((err) => console.warn('Session checkpoint failed:', err?.message));
+    return this.checkpoints;
+  }
+
+  async checkpoint() {
+    const session = this.session;
+    if (!session) return;
+    const store = session.audioBuffer;
+    const p = this.persisted;
+    const full = Math.floor(store.length / store.chunkSamples);
+    const tail = store.length - full * store.chunkSamples;
+    // Full chunks already written stay valid unless the store was replaced or truncated below them
+    const written = p.store === store ? Math.min(p.fullChunks, full) : 0;
+
+    const entries = [];
+    for (let c = written; c < full; c++) entries.push([audioKey(c), store.chunks[c]]);
+    // slice: storing a subarray would serialize the whole 64KB backing buffer
+    if (tail > 0) entries.push([audioKey(full), store.chunks[full].slice(0, tail)]);
+    // Last, so it never describes audio that is not stored yet
+    entries.push(['meta', {
+      id: session.id,
+      debug: session.debug,
+      options: session.options,
+      responseSeq: session.responseSeq,
+      history: session.history,
+      stream: session.stream,
+      lastActivity: session.lastActivity,
+      length: store.length
+    }]);
+    const keys = full + (tail > 0 ? 1 : 0);
+    const stale = [];
+    for (let c = keys; c < p.keys; c++) stale.push(audioKey(c));
+
+    for (let i = 0; i < entries.length; i += STORAGE_BATCH) {
+      await this.state.storage.put(Object.fromEntries(entries.slice(i, i + STORAGE_BATCH)));
+    }
+    for (let i = 0; i < stale.length; i += STORAGE_BATCH) {
+      await this.state.storage.delete(stale.slice(i, i + STORAGE_BATCH));
+    }
+    this.persisted = { store, fullChunks: full, keys, length: store.length, lastActivity: session.lastActivity };
+  }
+}
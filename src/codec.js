@@ -0,0 +1,215 @@
+// Client audio decoding for the ingest path: G.711 (μ-law / A-law) and PCM16 at 8/16/24/48kHz,
+// resampled to the 16kHz Int16 audio the session buffers, the VAD judges and STT receives, and
+// Opus packets (0x03 frames) decoded by a WASM decoder loaded on demand.
+// Mirrors test/codec.py (same tables, same filter design), which the stand-in and the clients use.
+//
+// G.711 decoding is a 256-entry table lookup per byte. Resampling is a polyphase FIR: a
+// windowed-sinc low-pass designed at the upsampled rate is split into `up` phases, and each
+// output sample is one dot product of a phase against the most recent input samples. The
+// resampler is streaming: it keeps the last taps - 1 input samples between chunks, so chunk
+// boundaries leave no seams.
+
+export const INPUT_ENCODINGS = ['pcm16', 'mulaw', 'alaw', 'opus'];
+export const INPUT_SAMPLE_RATES = [8000, 16000, 24000, 48000];
+
+const RESAMPLER_ZERO_CROSSINGS = 8; // sinc lobes each side of the centre tap
+const RESAMPLER_CUTOFF = 0.9;       // fraction of the lower Nyquist frequency kept
+
+function mulawToLinear(byte) {
+  const u = ~byte & 0xff;
+  const exponent = (u >> 4) & 0x07;
+  const sample = ((((u & 0x0f) << 3) + 0x84) << exponent) - 0x84;
+  return u & 0x80 ? -sample : sample;
+}
+
+function alawToLinear(byte) {
+  const a = byte ^ 0x55;
+  const exponent = (a >> 4) & 0x07;
+  const mantissa = a & 0x0f;
+  const sample = exponent === 0 ? (mantissa << 4) + 8 : ((mantissa << 4) + 0x108) << (exponent - 1);
+  return a & 0x80 ? sample : -sample;
+}
+
+export const MULAW_TABLE = Int16Array.from({ length: 256 }, (_, b) => mulawToLinear(b));
+export const ALAW_TABLE = Int16Array.from({ length: 256 }, (_, b) => alawToLinear(b));
+
+export function decodeG711(bytes, table) {
+  const out = new Int16Array(bytes.length);
+  for (let i = 0; i < bytes.length; i++) out[i] = table[bytes[i]];
+  return out;
+}
+
+const LITTLE_ENDIAN = new Uint8Array(new Uint16Array([1]).buffer)[0] === 1;
+
+// Little-endian Int16 samples from a byte range. An even byteOffset (binary frames with an even
+// header: 0x06 bulk frames, 0x05) is viewed in place, without copying; an odd one (0x01 frames,
+// 3-byte header) is copied once into a fresh, aligned buffer. The view shares the message's
+// buffer, which nothing writes to; AudioStore.append copies it.
+export function pcm16FromBytes(bytes) {
+  const count = bytes.length >> 1;
+  if (LITTLE_ENDIAN) {
+    if (bytes.byteOffset % 2 === 0) return new Int16Array(bytes.buffer, bytes.byteOffset, count);
+    return new Int16Array(bytes.slice(0, count * 2).buffer);
+  }
+  const samples = new Int16Array(count);
+  const dv = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+  for (let i = 0; i < count; i++) samples[i] = dv.getInt16(i * 2, true);
+  return samples;
+}
+
+// Interleaved multi-channel samples averaged to mono (stereo call recordings: one party per channel)
+export function downmix(samples, channels) {
+  if (channels === 1) return samples;
+  const out = new Int16Array(Math.floor(samples.length / channels));
+  for (let i = 0; i < out.length; i++) {
+    let sum = 0;
+    for (let c = 0; c < channels; c++) sum += samples[i * channels + c];
+    out[i] = Math.floor(sum / channels);
+  }
+  return out;
+}
+
+const gcd = (a, b) => (b === 0 ? a : gcd(b, a % b));
+
+export class PolyphaseResampler {
+  constructor(inRate, outRate) {
+    const g = gcd(inRate, outRate);
+    this.up = outRate / g;
+    this.down = inRate / g;
+    this.passthrough = this.up === 1 && this.down === 1;
+    const span = Math.max(this.up, this.down);
+    this.taps = 2 * RESAMPLER_ZERO_CROSSINGS * span / this.up; // taps per phase
+    this.phases = designPhases(this.up, this.taps, RESAMPLER_CUTOFF * 0.5 / span);
+    this.history = new Float64Array(this.taps - 1);
+    // Position of the next output in upsampled units, relative to the start of history
+    this.pos = (this.taps - 1) * this.up;
+  }
+
+  process(samples) {
+    if (this.passthrough) return samples;
+    const { up, down, taps, phases } = this;
+    const keep = taps - 1;
+    const buf = new Float64Array(keep + samples.length);
+    buf.set(this.history);
+    buf.set(samples, keep);
+
+    const limit = buf.length * up;
+    const out = new Int16Array(Math.max(0, Math.ceil((limit - this.pos) / down)));
+    let n = 0;
+    let pos = this.pos;
+    for (; pos < limit; pos += down) {
+      const base = Math.floor(pos / up);
+      const h = phases[pos - base * up];
+      let acc = 0;
+      for (let k = 0; k < taps; k++) acc += h[k] * buf[base - k];
+      out[n++] = Math.max(-32768, Math.min(32767, Math.round(acc)));
+    }
+    this.history = buf.slice(buf.length - keep);
+    this.pos = pos - (buf.length - keep) * up;
+    return n === out.length ? out : out.subarray(0, n);
+  }
+}
+
+// Windowed-sinc (Blackman) low-pass at the upsampled rate, split into `up` phases of `taps`
+// coefficients; gain `up` restores the level lost to zero-stuffing
+function designPhases(up, taps, cutoff) {
+  const length = up * taps;
+  const centre = (length - 1) / 2;
+  const phases = Array.from({ length: up }, () => new Float64Array(taps));
+  for (let i = 0; i < length; i++) {
+    const x = i - centre;
+    const sinc = x === 0 ? 2 * cutoff : Math.sin(2 * Math.PI * cutoff * x) / (Math.PI * x);
+    const w = 0.42 - 0.5 * Math.cos(2 * Math.PI * i / (length - 1)) + 0.08 * Math.cos(4 * Math.PI * i / (length - 1));
+    phases[i % up][Math.floor(i / up)] = sinc * w * up;
+  }
+  return phases;
+}
+
+// Per-session decoder from the declared input format to Int16 samples at outRate. `channels` > 1
+// (POST /transcribe WAV uploads) is downmixed; bytesPerSample then counts one sample of each channel.
+export class InputDecoder {
+  constructor(encoding, sampleRate, outRate, channels = 1) {
+    this.encoding = encoding;
+    this.sampleRate = sampleRate;
+    this.channels = channels;
+    this.bytesPerSample = (encoding === 'pcm16' ? 2 : 1) * channels;
+    this.table = encoding === 'mulaw' ? MULAW_TABLE : encoding === 'alaw' ? ALAW_TABLE : null;
+    this.resampler = new PolyphaseResampler(sampleRate, outRate);
+  }
+
+  // Payload bytes of a binary frame
+  decodeBytes(bytes) {
+    const samples = this.table ? decodeG711(bytes, this.table) : pcm16FromBytes(bytes);
+    return this.resampler.process(downmix(samples, this.channels));
+  }
+
+  // Sample values of a JSON audio_chunk (Int16 values, or G.711 byte values 0-255)
+  decodeValues(values) {
+    const samples = this.table ? decodeG711(Uint8Array.from(values), this.table) : Int16Array.from(values);
+    return this.resampler.process(samples);
+  }
+}
+
+// The Opus decoder (npm `opus-decoder`, WASM) is imported on first use, so sessions that never
+// negotiate Opus do not pay for it. The import or instantiation can fail (package not bundled,
+// WASM refused by the runtime); callers fall back to PCM.
+let opusModule = null;
+
+async function loadOpusDecoder(sampleRate) {
+  opusModule ??= import('opus-decoder');
+  const { OpusDecoder } = await opusModule;
+  const decoder = new OpusDecoder({ channels: 1, sampleRate });
+  await decoder.ready;
+  return decoder;
+}
+
+export class OpusInputDecoder {
+  constructor(outRate) {
+    this.encoding = 'opus';
+    this.bytesPerSample = 0;
+    this.outRate = outRate;
+    this.decoder = null;
+    this.error = null;
+    this.resampler = null;
+    this.ready = loadOpusDecoder(outRate).then((decoder) => { this.decoder = decoder; });
+    this.ready.catch((err) => { this.error = err; });
+  }
+
+  // Opus packets of a 0x03 frame, decoded in order (the decoder keeps state across packets)
+  decodePackets(packets) {
+    if (!this.decoder) throw new Error(this.error ? `Opus decoder unavailable: ${this.error.message}` : 'Opus decoder not ready');
+    const decoded = [];
+    let total = 0;
+    for (const packet of packets) {
+      const { channelData, samplesDecoded, sampleRate, errors } = this.decoder.decodeFrame(packet);
+      if (errors?.length) throw new Error(`Opus decode failed: ${errors[0].message || errors[0].error}`);
+      const pcm = channelData[0].subarray(0, samplesDecoded);
+      const samples = new Int16Array(pcm.length);
+      for (let i = 0; i < pcm.length; i++) samples[i] = Math.max(-32768, Math.min(32767, Math.round(pcm[i] * 32768)));
+      // Decoders that ignore the requested rate still produce 16kHz audio for the session
+      if (sampleRate !== this.outRate) this.resampler ??= new PolyphaseResampler(sampleRate, this.outRate);
+      decoded.push(this.resampler ? this.resampler.process(samples) : samples);
+      total += decoded[decoded.length - 1].length;
+    }
+    if (decoded.length === 1) return decoded[0];
+    const out = new Int16Array(total);
+    let offset = 0;
+    for (const part of decoded) {
+      out.set(part, offset);
+      offset += part.length;
+    }
+    return out;
+  }
+
+  decodeBytes() {
+    throw new Error('Opus sessions send audio in 0x03 frames');
+  }
+
+  decodeValues() {
+    throw new Error('Opus sessions send audio in 0x03 frames');
+  }
+
+  free() {
+    try { this.decoder?.free(); } catch(e){}
+  }
+}
@@ -0,0 +1,144 @@
+// Reply generation helpers: the streaming text-generation request, its server-sent-event token
+// stream, and a splitter that cuts the tokens into clauses small enough to synthesize one at a time.
+// Mirrored by ClauseSplitter / FakeLlm in test/local_worker.py.
+
+import { readWithTimeout } from './tts.js';
+
+export const LLM_MODEL = '@cf/meta/llama-3.1-8b-instruct';
+export const LLM_MAX_TOKENS = 256;
+export const LLM_HISTORY_TURNS = 6; // user/assistant pairs kept as context
+export const SYSTEM_PROMPT =
+  'You are a friendly voice assistant on a phone call. Answer in one to three short spoken sentences. ' +
+  'Do not use lists, markdown, emoji or URLs.';
+
+// Canned replies, used when the text-generation model fails before it produced anything
+export const FALLBACK_RESPONSES = [
+  "I understand. Can you tell me more?",
+  "That's interesting. How can I help you?",
+  "Thank you for that information. What else would you like to know?",
+  "I see. Let me help you with that."
+];
+
+const MIN_CLAUSE_CHARS = 40;  // a comma/semicolon/colon only ends a clause after this much text
+const MAX_CLAUSE_CHARS = 200; // cut at the last space when no punctuation shows up
+const ABBREVIATIONS = new Set(['mr', 'mrs', 'ms', 'dr', 'st', 'vs', 'etc', 'e.g', 'i.e', 'no', 'jr', 'sr']);
+
+export function llmRequest(userText, history = []) {
+  return {
+    messages: [
+      { role: 'system', content: SYSTEM_PROMPT },
+      ...history.slice(-2 * LLM_HISTORY_TURNS),
+      { role: 'user', content: userText }
+    ],
+    stream: true,
+    max_tokens: LLM_MAX_TOKENS
+  };
+}
+
+// Yield the text of a generation result as it arrives. Streaming results are a ReadableStream of
+// SSE lines (`data: {"response":"..."}`, ending with `data: [DONE]`); a non-streaming result is
+// `{ response }`. Returning early or aborting `signal` cancels the stream.
+export async function* llmTextChunks(result, readTimeoutMs = 15000, signal = null) {
+  if (typeof result?.response === 'string') {
+    if (result.response) yield result.response;
+    return;
+  }
+  const stream = result instanceof Response ? result.body : result;
+  if (!stream || typeof stream.getReader !== 'function') return;
+  const reader = stream.getReader();
+  const onAbort = () => reader.cancel().catch(() => {});
+  signal?.addEventListener('abort', onAbort, { once: true });
+  const decoder = new TextDecoder();
+  let buffered = '';
+  let finished = false;
+  try {
+    while (!finished) {
+      const { done, value } = await readWithTimeout(reader, readTimeoutMs, 'LLM stream read timed out');
+      signal?.throwIfAborted();
+      if (done) {
+        finished = true;
+        buffered += decoder.decode();
+      } else {
+        buffered += typeof value === 'string' ? value : decoder.decode(value, { stream: true });
+      }
+      const lines = buffered.split('\n');
+      buffered = finished ? '' : lines.pop();
+      for (const line of lines) {
+        if (!line.startsWith('data:')) continue;
+        const data = line.slice(5).trim();
+        if (data === '[DONE]') {
+          finished = true;
+          break;
+        }
+        let event;
+        try { event = JSON.parse(data); } catch(e){ continue; }
+        if (event?.response) yield event.response;
+      }
+    }
+  } finally {
+    signal?.removeEventListener('abort', onAbort);
+    if (!finished) reader.cancel().catch(() => {});
+    reader.releaseLock();
+  }
+}
+
+// Release a streaming result that will not be read (its turn was interrupted before the model answered)
+export function cancelLlmResult(result) {
+  const stream = result instanceof Response ? result.body : result;
+  if (stream && typeof stream.cancel === 'function' && !stream.locked) stream.cancel().catch(() => {});
+}
+
+// Accumulates generated text and hands out complete clauses: sentences, and long stretches up to
+// a comma, semicolon or colon. Periods after abbreviations, initials and inside numbers do not count.
+export class ClauseSplitter {
+  constructor(minClauseChars = MIN_CLAUSE_CHARS, maxClauseChars = MAX_CLAUSE_CHARS) {
+    this.minClauseChars = minClauseChars;
+    this.maxClauseChars = maxClauseChars;
+    this.text = '';
+  }
+
+  // Clauses completed by this piece of text (possibly none)
+  push(text) {
+    this.text += text;
+    const clauses = [];
+    let start = 0;
+    for (let i = 0; i < this.text.length; i++) {
+      const ch = this.text[i];
+      const next = this.text[i + 1];
+      // A boundary needs the following whitespace, so the last character waits for more text
+      if (next === undefined) break;
+      if (!/\s/.test(next)) continue;
+      const length = i + 1 - start;
+      if ('.!?'.includes(ch) ? !this.isAbbreviation(start, i) : ',;:'.includes(ch) && length >= this.minClauseChars) {
+        this.take(clauses, start, i + 1);
+        start = i + 1;
+      }
+    }
+    while (this.text.length - start > this.maxClauseChars) {
+      const cut = this.text.lastIndexOf(' ', start + this.maxClauseChars);
+      const end = cut > start ? cut : start + this.maxClauseChars;
+      this.take(clauses, start, end);
+      start = end;
+    }
+    this.text = this.text.slice(start);
+    return clauses;
+  }
+
+  // The unfinished remainder once the generation has ended
+  flush() {
+    const rest = this.text.trim();
+    this.text = '';
+    return rest ? [rest] : [];
+  }
+
+  take(clauses, start, end) {
+    const clause = this.text.slice(start, end).trim();
+    if (clause) clauses.push(clause);
+  }
+
+  isAbbreviation(start, dot) {
+    if (this.text[dot] !== '.') return false;
+    const word = /([\p{L}.]+)$/u.exec(this.text.slice(start, dot))?.[1] ?? '';
+    return ABBREVIATIONS.has(word.toLowerCase()) || (/^\p{Lu}$/u.test(word) && word !== 'I');
+  }
+}
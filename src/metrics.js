@@ -0,0 +1,190 @@
+// Per-stage latency instrumentation. A TurnTimer records the marks of one turn (first chunk, last
+// chunk, end_stream, WAV built, STT done, first LLM token, first TTS byte, first audio sent, TTS
+// done, audio end) and every AI.run call it made; the spans between marks are aggregated into
+// module-scope histograms (one set per isolate), which GET /metrics renders in the Prometheus text
+// format. With the `timings` session option the turn's marks also ride on outbound messages.
+// Mirrored by TurnTimer / Histogram in test/local_worker.py.
+//
+// Clock: performance.now(). A deployed Worker only advances it across I/O (timers do not move
+// while code runs), so purely CPU-bound spans (decode, wav_build) read 0 there and are meaningful
+// under `wrangler dev`; spans that wait on AI.run or the network are accurate everywhere.
+
+export const now = () => performance.now();
+
+// Upper bounds (ms) shared by all latency histograms; +Inf is implied
+export const LATENCY_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 30000];
+
+const round1 = (ms) => Math.round(ms * 10) / 10;
+const escapeLabel = (v) => String(v).replace(/\\/g, '\\\\').replace(/\n/g, '\\n').replace(/"/g, '\\"');
+
+function labelText(names, values) {
+  if (names.length === 0) return '';
+  return '{' + names.map((name, i) => `${name}="${escapeLabel(values[i])}"`).join(',') + '}';
+}
+
+export class Histogram {
+  constructor(name, help, labelNames = [], buckets = LATENCY_BUCKETS_MS) {
+    this.name = name;
+    this.help = help;
+    this.labelNames = labelNames;
+    this.buckets = buckets;
+    this.series = new Map(); // label values joined by \u0000 -> { values, counts, sum, count }
+  }
+
+  observe(labels, value) {
+    const values = this.labelNames.map((name) => labels[name] ?? '');
+    const key = values.join('\u0000');
+    let s = this.series.get(key);
+    if (!s) {
+      s = { values, counts: new Array(this.buckets.length).fill(0), sum: 0, count: 0 };
+      this.series.set(key, s);
+    }
+    const i = this.buckets.findIndex((le) => value <= le);
+    if (i >= 0) s.counts[i]++;
+    s.sum += value;
+    s.count++;
+  }
+
+  // Estimated quantile of one series, interpolated inside its bucket (as histogram_quantile does)
+  quantile(labels, q) {
+    const s = this.series.get(this.labelNames.map((name) => labels[name] ?? '').join('\u0000'));
+    if (!s || s.count === 0) return null;
+    const rank = q * s.count;
+    let seen = 0;
+    for (let i = 0; i < this.buckets.length; i++) {
+      if (seen + s.counts[i] >= rank && s.counts[i] > 0) {
+        const lower = i === 0 ? 0 : this.buckets[i - 1];
+        return lower + (this.buckets[i] - lower) * (rank - seen) / s.counts[i];
+      }
+      seen += s.counts[i];
+    }
+    return this.buckets[this.buckets.length - 1];
+  }
+
+  render(lines) {
+    lines.push(`# HELP ${this.name} ${this.help}`, `# TYPE ${this.name} histogram`);
+    for (const s of this.series.values()) {
+      let cumulative = 0;
+      this.buckets.forEach((le, i) => {
+        cumulative += s.counts[i];
+        lines.push(`${this.name}_bucket${labelText([...this.labelNames, 'le'], [...s.values, le])} ${cumulative}`);
+      });
+      lines.push(`${this.name}_bucket${labelText([...this.labelNames, 'le'], [...s.values, '+Inf'])} ${s.count}`);
+      lines.push(`${this.name}_sum${labelText(this.labelNames, s.values)} ${round1(s.sum)}`);
+      lines.push(`${this.name}_count${labelText(this.labelNames, s.values)} ${s.count}`);
+    }
+  }
+}
+
+export class Counter {
+  constructor(name, help, labelNames = []) {
+    this.name = name;
+    this.help = help;
+    this.labelNames = labelNames;
+    this.series = new Map(); // label values joined by \u0000 -> { values, value }
+  }
+
+  inc(labels = {}, n = 1) {
+    const values = this.labelNames.map((name) => labels[name] ?? '');
+    const key = values.join('\u0000');
+    const s = this.series.get(key);
+    if (s) s.value += n;
+    else this.series.set(key, { values, value: n });
+  }
+
+  render(lines) {
+    lines.push(`# HELP ${this.name} ${this.help}`, `# TYPE ${this.name} counter`);
+    for (const s of this.series.values()) lines.push(`${this.name}${labelText(this.labelNames, s.values)} ${s.value}`);
+  }
+}
+
+export class MetricsRegistry {
+  constructor() {
+    this.metrics = [];
+  }
+
+  histogram(name, help, labelNames, buckets) {
+    const metric = new Histogram(name, help, labelNames, buckets);
+    this.metrics.push(metric);
+    return metric;
+  }
+
+  counter(name, help, labelNames) {
+    const metric = new Counter(name, help, labelNames);
+    this.metrics.push(metric);
+    return metric;
+  }
+
+  // Prometheus text exposition format (version 0.0.4)
+  render() {
+    const lines = [];
+    for (const metric of this.metrics) metric.render(lines);
+    return lines.join('\n') + '\n';
+  }
+}
+
+// Module scope: lives as long as the isolate, shared by every session it hosts
+export const metrics = new MetricsRegistry();
+
+// Stages: decode (per input chunk), queue (end_stream -> turn start), wav_build, stt,
+// llm_first_token (STT done -> first token), tts_first_byte / tts (per clause synthesized by the
+// model), first_audio (end_stream -> response_audio_start), turn (end_stream -> response_audio_end)
+export const stageLatency = metrics.histogram('voice_stage_duration_ms', 'Turn stage durations in milliseconds', ['stage']);
+export const aiRunLatency = metrics.histogram('voice_ai_run_duration_ms', 'AI.run calls in milliseconds by model, payload shape and outcome', ['model', 'shape', 'outcome']);
+export const turnsTotal = metrics.counter('voice_turns_total', 'Turns processed by outcome (ok, empty, error, interrupted)', ['outcome']);
+
+// GET /metrics (src/worker.js, and src/call_session.js for ?session_id=)
+export function metricsResponse() {
+  return new Response(metrics.render(), {
+    headers: { 'Content-Type': 'text/plain; version=0.0.4; charset=utf-8' }
+  });
+}
+
+export function observeStage(stage, ms) {
+  stageLatency.observe({ stage }, ms);
+}
+
+// How an AI.run call ended, for the `outcome` label ('lost' is set by src/scheduler.js for a hedge
+// whose twin won)
+export function aiRunOutcome(err, signal = null) {
+  if (!err) return 'ok';
+  if (signal?.aborted) return 'aborted';
+  return err.message === 'AI.run timed out' ? 'timeout' : 'error';
+}
+
+// Record one AI.run call started at `startedAt` (now()) in the histogram and, if given, the turn
+export function recordAiRun(timer, model, shape, outcome, startedAt) {
+  const ms = now() - startedAt;
+  aiRunLatency.observe({ model, shape, outcome }, ms);
+  timer?.aiRuns.push({ model, shape, outcome, start_ms: round1(startedAt - timer.origin), ms: round1(ms) });
+}
+
+// Marks of one turn, in ms since its first audio chunk. A turn's timer starts with the first chunk
+// buffered after the previous turn detached its audio, and moves with the audio to processAudioBuffer.
+export class TurnTimer {
+  constructor(origin = now()) {
+    this.origin = origin;
+    this.marks = { first_chunk: 0 };
+    this.aiRuns = [];
+  }
+
+  // The first mark of a name wins (a turn has one end_stream, one first TTS byte) unless `overwrite`
+  mark(name, overwrite = false) {
+    if (overwrite || this.marks[name] === undefined) this.marks[name] = now() - this.origin;
+    return this;
+  }
+
+  // Observe the span between two recorded marks as `stage`
+  span(stage, from, to) {
+    const a = this.marks[from];
+    const b = this.marks[to];
+    if (a !== undefined && b !== undefined) observeStage(stage, b - a);
+  }
+
+  // The `timings` field of outbound messages
+  toJSON() {
+    const marks = {};
+    for (const [name, ms] of Object.entries(this.marks)) marks[name] = round1(ms);
+    return { ...marks, ai_runs: this.aiRuns };
+  }
+}
@@ -0,0 +1,228 @@
+// Per-isolate AI.run scheduler. Every model call (STT, text generation, TTS; live turns, partial
+// windows, POST /transcribe) goes through scheduleAiRun, which
+//  - caps the calls in flight per model (AI_CONCURRENCY) and queues the rest by priority: 'live'
+//    (the turn a caller is waiting on), then 'background' (partial windows), then 'batch'
+//    (POST /transcribe), first come first served within a priority;
+//  - bounds a call by the smaller of its own timeout and what is left before its deadline (the
+//    turn budget): a call whose deadline has passed fails without being sent, also while queued;
+//  - optionally hedges it: if the call has not settled after the p95 latency of the model's last
+//    HEDGE_WINDOW successful calls with that shape (once there are HEDGE_MIN_SAMPLES), a duplicate
+//    is sent when a slot is free; the first success wins and the other result is released.
+//    The p95 is exact over the window, not read off the coarse buckets of voice_ai_run_duration_ms.
+// A slot is held from sending a call until it settles or is given up (timeout, abort, lost hedge);
+// a streamed result (LLM tokens, TTS audio) is read after its slot has been freed.
+// Every attempt is recorded like any AI.run call (recordAiRun); a lost hedge has outcome 'lost'.
+// Mirrored by AiScheduler in test/local_worker.py.
+import { aiRunOutcome, metrics, now, recordAiRun } from './metrics.js';
+
+export const AI_PRIORITIES = ['live', 'background', 'batch'];
+
+// Calls in flight per model in this isolate (AI_CONCURRENCY.default for models not listed)
+export const AI_CONCURRENCY = {
+  default: 4,
+  '@cf/openai/whisper': 6,
+  '@cf/meta/llama-3.1-8b-instruct': 4,
+  '@cf/deepgram/aura-1': 6
+};
+
+export const TURN_BUDGET_EXHAUSTED = 'turn budget exhausted';
+
+const HEDGE_QUANTILE = 0.95;
+const HEDGE_WINDOW = 100;
+const HEDGE_MIN_SAMPLES = 20;
+const HEDGE_MIN_DELAY_MS = 50;
+
+export const aiQueueWait = metrics.histogram('voice_ai_queue_wait_ms', 'Time AI.run calls waited for a concurrency slot in milliseconds', ['model', 'priority']);
+export const aiHedgesTotal = metrics.counter('voice_ai_hedges_total', 'Hedged AI.run calls by model and result (primary, hedge, failed, skipped)', ['model', 'result']);
+
+export class AiScheduler {
+  constructor(limits = AI_CONCURRENCY) {
+    this.limits = limits;
+    this.lanes = new Map(); // model -> { active, queues: { live: [], background: [], batch: [] } }
+    this.latencies = new Map(); // model + '\u0000' + shape -> ms of its last HEDGE_WINDOW successful calls
+  }
+
+  limit(model) {
+    return this.limits[model] ?? this.limits.default;
+  }
+
+  lane(model) {
+    let lane = this.lanes.get(model);
+    if (!lane) {
+      lane = { active: 0, queues: Object.fromEntries(AI_PRIORITIES.map((p) => [p, []])) };
+      this.lanes.set(model, lane);
+    }
+    return lane;
+  }
+
+  // Take a slot at once if one is free and nobody is queued (a hedge never waits for one)
+  tryAcquire(model) {
+    const lane = this.lane(model);
+    if (lane.active >= this.limit(model) || AI_PRIORITIES.some((p) => lane.queues[p].length > 0)) return false;
+    lane.active++;
+    return true;
+  }
+
+  // Resolves holding a slot of `model`; rejects if `signal` aborts or `deadline` passes first
+  acquire(model, priority, signal = null, deadline = null) {
+    signal?.throwIfAborted();
+    if (deadline !== null && deadline <= now()) return Promise.reject(new Error(TURN_BUDGET_EXHAUSTED));
+    if (this.tryAcquire(model)) return Promise.resolve();
+    const queue = this.lane(model).queues[priority] ?? this.lane(model).queues.live;
+    return new Promise((resolve, reject) => {
+      let timer = null;
+      const leave = () => {
+        const i = queue.indexOf(waiter);
+        if (i >= 0) queue.splice(i, 1);
+        clearTimeout(timer);
+        signal?.removeEventListener('abort', onAbort);
+      };
+      const onAbort = () => { leave(); reject(signal.reason); };
+      const waiter = () => { leave(); resolve(); };
+      queue.push(waiter);
+      signal?.addEventListener('abort', onAbort, { once: true });
+      if (deadline !== null) {
+        timer = setTimeout(() => { leave(); reject(new Error(TURN_BUDGET_EXHAUSTED)); }, deadline - now());
+      }
+    });
+  }
+
+  // Free a slot and hand it to the first waiter in priority order
+  release(model) {
+    const lane = this.lane(model);
+    lane.active--;
+    for (const priority of AI_PRIORITIES) {
+      const waiter = lane.queues[priority].shift();
+      if (waiter) {
+        lane.active++;
+        waiter();
+        return;
+      }
+    }
+  }
+
+  observeLatency(model, shape, ms) {
+    const key = model + '\u0000' + shape;
+    let window = this.latencies.get(key);
+    if (!window) this.latencies.set(key, window = []);
+    window.push(ms);
+    if (window.length > HEDGE_WINDOW) window.shift();
+  }
+
+  // Delay before a hedge: the p95 of the model's recent successful calls with this shape, null
+  // while there are too few of them to trust it
+  hedgeDelay(model, shape) {
+    const window = this.latencies.get(model + '\u0000' + shape);
+    if (!window || window.length < HEDGE_MIN_SAMPLES) return null;
+    const sorted = [...window].sort((a, b) => a - b);
+    return Math.max(HEDGE_MIN_DELAY_MS, sorted[Math.ceil(HEDGE_QUANTILE * sorted.length) - 1]);
+  }
+
+  // Result of call() (the promise of one env.AI.run) under this scheduler's limits. Options:
+  //   priority  'live' (default), 'background' or 'batch'
+  //   timeoutMs longest wait for the call once sent (hedges included)
+  //   deadline  now() after which the call is pointless (null: none); shortens timeoutMs
+  //   signal    aborting it rejects at once with its reason
+  //   hedge     send a duplicate after the p95 latency (call() must be safe to repeat)
+  //   shape     the `shape` label the attempts are recorded and the p95 looked up with
+  //   timer     TurnTimer that records the attempts too
+  //   release   called with a result that is not returned (late or lost), to free it
+  async run(model, call, { priority = 'live', timeoutMs = 15000, deadline = null, signal = null, hedge = false, shape = 'default', timer = null, release = null } = {}) {
+    const queuedAt = now();
+    await this.acquire(model, priority, signal, deadline);
+    aiQueueWait.observe({ model, priority }, now() - queuedAt);
+    const budget = deadline === null ? timeoutMs : Math.min(timeoutMs, deadline - now());
+    if (signal?.aborted || budget <= 0) {
+      this.release(model);
+      signal?.throwIfAborted();
+      throw new Error(TURN_BUDGET_EXHAUSTED);
+    }
+
+    return new Promise((resolve, reject) => {
+      const attempts = [];
+      let settled = false;
+      let hedgeTimer = null;
+      let timeoutTimer = null;
+
+      // Stop waiting for an attempt: free its slot and record how it ended
+      const end = (attempt, outcome) => {
+        if (attempt.done) return;
+        attempt.done = true;
+        this.release(model);
+        if (outcome === 'ok') this.observeLatency(model, shape, now() - attempt.startedAt);
+        recordAiRun(timer, model, shape, outcome, attempt.startedAt);
+      };
+      const finish = (outcome, settle) => {
+        settled = true;
+        clearTimeout(hedgeTimer);
+        clearTimeout(timeoutTimer);
+        signal?.removeEventListener('abort', onAbort);
+        for (const attempt of attempts) end(attempt, outcome);
+        settle();
+      };
+      const start = (hedged) => {
+        const attempt = { hedged, startedAt: now(), done: false };
+        attempts.push(attempt);
+        let pending;
+        try {
+          pending = Promise.resolve(call());
+        } catch (err) {
+          pending = Promise.reject(err);
+        }
+        pending.then((result) => {
+          if (settled) {
+            release?.(result);
+            return;
+          }
+          end(attempt, 'ok');
+          if (attempts.length > 1) aiHedgesTotal.inc({ model, result: hedged ? 'hedge' : 'primary' });
+          finish('lost', () => resolve(result));
+        }, (err) => {
+          if (settled) return;
+          end(attempt, aiRunOutcome(err, signal));
+          // Another attempt still in flight may yet succeed
+          if (attempts.some((a) => !a.done)) return;
+          if (attempts.length > 1) aiHedgesTotal.inc({ model, result: 'failed' });
+          finish('error', () => reject(err));
+        });
+      };
+      const onAbort = () => finish('aborted', () => reject(signal.reason));
+
+      signal?.addEventListener('abort', onAbort, { once: true });
+      timeoutTimer = setTimeout(() => {
+        if (attempts.length > 1) aiHedgesTotal.inc({ model, result: 'failed' });
+        finish('timeout', () => reject(new Error('AI.run timed out')));
+      }, budget);
+      start(false);
+
+      const delay = hedge ? this.hedgeDelay(model, shape) : null;
+      if (delay !== null && delay < budget) {
+        hedgeTimer = setTimeout(() => {
+          if (settled) return;
+          if (this.tryAcquire(model)) start(true);
+          else aiHedgesTotal.inc({ model, result: 'skipped' });
+        }, delay);
+      }
+    });
+  }
+
+  // GET /health: slots in use and calls queued per model
+  stats() {
+    const stats = {};
+    for (const [model, lane] of this.lanes) {
+      stats[model] = {
+        active: lane.active,
+        limit: this.limit(model),
+        queued: Object.fromEntries(AI_PRIORITIES.map((p) => [p, lane.queues[p].length]))
+      };
+    }
+    return stats;
+  }
+}
+
+// Module scope: one scheduler per isolate, shared by every session and POST /transcribe it hosts
+export const aiScheduler = new AiScheduler();
+
+export function scheduleAiRun(model, call, options) {
+  return aiScheduler.run(model, call, options);
+}
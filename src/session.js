@@ -0,0 +1,1391 @@
+// Call session protocol shared by both hosts of a call: the in-isolate fallback in src/worker.js and
+// the CallSession Durable Object (src/call_session.js). A session is a plain object (createSession);
+// handleMessage(ws, session, env, data) handles one client message and returns the promise of any
+// work it started, so a host can keep itself alive until that work settles.
+import { AudioStore } from './audio_store.js';
+import { INPUT_ENCODINGS, INPUT_SAMPLE_RATES, InputDecoder, OpusInputDecoder } from './codec.js';
+import { TranscriptStitcher } from './transcript.js';
+import { VAD_DEFAULTS, VoiceActivityDetector } from './vad.js';
+import { ClauseSplitter, FALLBACK_RESPONSES, LLM_HISTORY_TURNS, LLM_MODEL, cancelLlmResult, llmRequest, llmTextChunks } from './llm.js';
+import { TTS_LANGUAGE, TTS_MODEL, TTS_SAMPLE_RATE, TTS_VOICE, cancelTtsResult, ttsAudioChunks, ttsRequest, sniffAudioEncoding } from './tts.js';
+import { KvTtsStore, TtsCache, ttsCacheKey } from './tts_cache.js';
+import { TurnTimer, now, observeStage, turnsTotal } from './metrics.js';
+import { TURN_BUDGET_EXHAUSTED, scheduleAiRun } from './scheduler.js';
+
+// New session state for a call; `id` names the call (reconnects resume it through the Durable Object).
+// Options come from the query params of the upgrade URL (defaults when url is null).
+export function createSession(url, id = crypto.randomUUID()) {
+  const options = url ? sessionOptionsFromUrl(url) : { ...DEFAULT_SESSION_OPTIONS };
+  return {
+    id,
+    audioBuffer: new AudioStore(),
+    lastActivity: Date.now(),
+    isProcessing: false,
+    options,
+    partial: newPartialState(),
+    vad: createVad(options),
+    decoder: createInputDecoder(options),
+    utteranceStart: 0,
+    turnQueued: false,
+    responseSeq: 0,
+    acks: newAckState(), // audio chunks received and acknowledged on the current connection
+    stream: newStreamState(), // position and loss counters of the sequenced (0x05) input stream
+    history: [],  // recent { role, content } messages, context for the text-generation model
+    turn: null,   // AbortController of the turn in progress (STT, generation, TTS); aborted by barge-in
+    reply: null,  // the reply being spoken: its clauses and how much audio was sent (see interruptTurn)
+    timer: null,  // TurnTimer of the audio buffered for the next turn (src/metrics.js)
+    debug: url ? new URL(url).searchParams.get('debug') === '1' : false,
+    onBufferChange: null // host hook, called after the buffered audio grows, shrinks or is detached
+  };
+}
+
+// Session ids come from clients (?session_id=...) and name Durable Objects and storage keys
+export function validSessionId(id) {
+  return typeof id === 'string' && /^[A-Za-z0-9_-]{1,64}$/.test(id);
+}
+
+// Handle one message from the client (non-blocking): long-running work is started, not awaited, and
+// its promise is returned. Text messages are JSON; binary frames start with 0x01, then a uint16
+// sample count, then the samples in the session's input encoding (Int16 LE, or one G.711 byte each),
+// with 0x05 for the sequenced variant (see ingestSequenced), 0x06 for bulk uploads (flags, then a
+// uint32 sample count, so one frame can hold a whole recording), or with 0x03 for Opus sessions
+// (see parseOpusFrame).
+export function handleMessage(ws, session, env, raw) {
+  // Debug: inspect the incoming message briefly if enabled via ?debug=1
+  if (session.debug) logIncoming(raw);
+  session.lastActivity = Date.now();
+
+  // Robust binary message detection: accept ArrayBuffer, TypedArray views, and DataView
+  let buf = null;
+  if (typeof raw !== 'string') {
+    // ArrayBuffer
+    if (raw instanceof ArrayBuffer) {
+      buf = new Uint8Array(raw);
+    } else if (ArrayBuffer.isView(raw)) {
+      // TypedArray or DataView
+      buf = new Uint8Array(raw.buffer, raw.byteOffset || 0, raw.byteLength || raw.buffer.byteLength);
+    } else if (raw && raw.buffer instanceof ArrayBuffer) {
+      buf = new Uint8Array(raw.buffer);
+    }
+  }
+
+  if (buf) {
+    try {
+      if (buf.length >= 3 && buf[0] === FRAME_AUDIO) {
+        // audio binary frame
+        const dv = new DataView(buf.buffer, buf.byteOffset, buf.byteLength);
+        const sampleCount = dv.getUint16(1, true);
+        // Samples start at offset 3; ensure we have enough bytes
+        const expectedBytes = sampleCount * session.decoder.bytesPerSample;
+        if (buf.byteLength < 3 + expectedBytes) throw new Error('binary frame too short');
+        // Decoded and resampled to 16kHz Int16 (PCM16 is copied once: the 3-byte header leaves it unaligned)
+        const decodeStart = now();
+        const samples = session.decoder.decodeBytes(buf.subarray(3, 3 + expectedBytes));
+        // append samples into session buffer (through VAD when enabled)
+        const turn = ingestSamples(ws, session, env, samples, decodeStart);
+        ackChunk(ws, session, sampleCount, true);
+        return turn ?? maybeRunPartial(ws, session, env);
+      }
+      if (buf.length >= SEQ_AUDIO_HEADER_BYTES && buf[0] === FRAME_SEQ_AUDIO) {
+        if (buf[1] !== SEQ_AUDIO_VERSION) throw new Error(`unsupported sequenced frame version ${buf[1]}`);
+        const bytesPerSample = session.decoder.bytesPerSample;
+        if (!bytesPerSample) throw new Error('sequenced frames carry PCM or G.711 samples, not Opus');
+        const dv = new DataView(buf.buffer, buf.byteOffset, buf.byteLength);
+        const sampleCount = dv.getUint16(10, true);
+        const end = SEQ_AUDIO_HEADER_BYTES + sampleCount * bytesPerSample;
+        if (buf.byteLength < end) throw new Error('binary frame too short');
+        const turn = ingestSequenced(ws, session, env, dv.getUint32(2, true), dv.getUint32(6, true),
+          buf.subarray(SEQ_AUDIO_HEADER_BYTES, end), sampleCount);
+        ackChunk(ws, session, sampleCount, true);
+        return turn ?? maybeRunPartial(ws, session, env);
+      }
+      if (buf.length >= BULK_AUDIO_HEADER_BYTES && buf[0] === FRAME_BULK_AUDIO) {
+        // Bulk upload: a whole recording in one frame (uint32 count), optionally ending the turn
+        const bytesPerSample = session.decoder.bytesPerSample;
+        if (!bytesPerSample) throw new Error('bulk frames carry PCM or G.711 samples, not Opus');
+        const dv = new DataView(buf.buffer, buf.byteOffset, buf.byteLength);
+        const sampleCount = dv.getUint32(2, true);
+        const end = BULK_AUDIO_HEADER_BYTES + sampleCount * bytesPerSample;
+        if (buf.byteLength < end) throw new Error('binary frame too short');
+        const decodeStart = now();
+        const samples = session.decoder.decodeBytes(buf.subarray(BULK_AUDIO_HEADER_BYTES, end));
+        const turn = ingestSamples(ws, session, env, samples, decodeStart);
+        ackChunk(ws, session, sampleCount, true);
+        if (buf[1] & BULK_AUDIO_FLAG_END) return endStream(ws, session, env) ?? turn;
+        return turn ?? maybeRunPartial(ws, session, env);
+      }
+      if (buf.length >= 2 && buf[0] === FRAME_OPUS) {
+        if (session.decoder.encoding !== 'opus') throw new Error('Opus frame without input_encoding "opus"');
+        const decodeStart = now();
+        const samples = session.decoder.decodePackets(parseOpusFrame(buf));
+        const turn = ingestSamples(ws, session, env, samples, decodeStart);
+        ackChunk(ws, session, samples.length, true);
+        return turn ?? maybeRunPartial(ws, session, env);
+      }
+    } catch (err) {
+      console.error('Binary message handling error:', err?.message);
+      try { ws.send(JSON.stringify({ type: 'error', message: 'Invalid binary frame', error: { message: err?.message } })); } catch(e){}
+      return;
+    }
+  }
+
+  // Otherwise, assume text JSON
+  let data;
+  try {
+    data = JSON.parse(raw);
+  } catch (error) {
+    console.error('Message parse error:', error?.message);
+    try { ws.send(JSON.stringify({ type: 'error', message: 'Invalid message format', error: { message: error?.message } })); } catch(e){}
+    return;
+  }
+
+  try {
+    if (data.type === 'audio_chunk') {
+      // fire-and-forget: handle chunk asynchronously
+      return handleAudioChunk(ws, data, session, env).catch((err) => {
+        console.error('handleAudioChunk error:', err?.message, err?.stack);
+        try { ws.send(JSON.stringify({ type: 'error', message: 'Chunk handling failed', error: { message: err?.message } })); } catch(e){}
+      });
+    } else if (data.type === 'end_stream') {
+      return endStream(ws, session, env);
+    } else if (data.type === 'session_config') {
+      // Per-session options (e.g. incremental partial transcripts); unknown fields are ignored
+      const { inputEncoding, inputSampleRate } = session.options;
+      flushAcks(ws, session); // chunks received under the previous ack policy
+      applySessionConfig(session.options, data);
+      session.vad = createVad(session.options);
+      if (session.options.inputEncoding !== inputEncoding || session.options.inputSampleRate !== inputSampleRate) {
+        // Negotiation: an encoding whose decoder cannot load is refused and the previous one kept
+        const requested = session.options.inputEncoding;
+        return switchInputDecoder(session, inputEncoding).then((err) => {
+          sessionConfigured(ws, session, err ? codecRejection(requested, err) : null);
+        });
+      }
+      sessionConfigured(ws, session);
+    } else if (data.type === 'interrupt') {
+      // Barge-in from the client, optionally with how much of the reply it actually played
+      const playedMs = Number(data.played_ms);
+      interruptTurn(ws, session, 'client', Number.isFinite(playedMs) && playedMs >= 0 ? playedMs : null);
+    } else if (data.type === 'ping') {
+      // Keep-alive
+      const pong = { type: 'pong', session_id: session.id, timestamp: Date.now() };
+      if (session.stream.stats.frames > 0) pong.stream = describeStream(session.stream);
+      ws.send(JSON.stringify(pong));
+    } else if (data.type === 'dump_wav' || data.type === 'echo_wav') {
+      // Client requests the assembled WAV for debugging/inspection
+      dumpWav(ws, session);
+    }
+  } catch (error) {
+    console.error('Message handling error:', error?.message, error?.stack);
+    try { ws.send(JSON.stringify({ type: 'error', message: 'Failed to process message', error: { message: error?.message } })); } catch(e){}
+  }
+}
+
+function logIncoming(raw) {
+  try {
+    let info = { typeof: typeof raw };
+    if (typeof raw === 'string') {
+      info.preview = raw.slice(0, 256);
+    } else {
+      // try typed-array view
+      if (raw instanceof ArrayBuffer) {
+        const ua = new Uint8Array(raw);
+        const hex = Array.from(ua.subarray(0, Math.min(16, ua.length))).map(b => b.toString(16).padStart(2,'0')).join(' ');
+        info.previewHex = hex;
+      } else if (ArrayBuffer.isView(raw)) {
+        const ua = new Uint8Array(raw.buffer, raw.byteOffset || 0, Math.min(16, raw.byteLength || raw.buffer.byteLength));
+        const hex = Array.from(ua).map(b => b.toString(16).padStart(2,'0')).join(' ');
+        info.previewHex = hex;
+      }
+    }
+    console.log('incoming message info:', info);
+  } catch (e) { console.warn('incoming debug failed', e?.message); }
+}
+
+// Largest WAV dump_wav sends back (base64 in one JSON message)
+const MAX_DUMP_BYTES = 2 * 1024 * 1024;
+
+// dump_wav / echo_wav: send the buffered audio back as a base64 WAV
+function dumpWav(ws, session) {
+  try {
+    const sampleCount = session.audioBuffer?.length ?? 0;
+    if (sampleCount === 0) {
+      ws.send(JSON.stringify({ type: 'error', message: 'No audio buffered' }));
+      return;
+    }
+    // Refuse before assembling anything: the size is known from the sample count
+    const size = WAV_HEADER_BYTES + sampleCount * 2;
+    if (size > MAX_DUMP_BYTES) {
+      ws.send(JSON.stringify({ type: 'error', message: 'WAV too large to dump', size }));
+      return;
+    }
+    const wavBase64 = lazyWavEncodings(buildWav(session.audioBuffer)).base64();
+    ws.send(JSON.stringify({ type: 'echo_wav', wavBase64, sampleRate: SAMPLE_RATE, samples: sampleCount }));
+  } catch (err) {
+    console.error('dump_wav failed', err?.message);
+    try { ws.send(JSON.stringify({ type: 'error', message: 'dump_wav failed', error: { message: err?.message } })); } catch(e){}
+  }
+}
+
+const STT_MODEL = '@cf/openai/whisper';
+
+// Payload shapes we have seen (or suspect) the AI binding accepting for Whisper audio.
+// Each shape builds its payload lazily from memoized encodings, so only the attempts that
+// actually run pay for base64 / data URL / number-array conversions.
+const STT_PAYLOAD_SHAPES = [
+  { desc: 'object-audio-uint8', build: (enc) => ({ audio: enc.bytes }) },
+  { desc: 'object-audio-base64', build: (enc) => ({ audio: enc.base64() }) },
+  { desc: 'object-audio-dataUrl', build: (enc) => ({ audio: enc.dataUrl() }) },
+  { desc: 'string-dataUrl', build: (enc) => enc.dataUrl() },
+  { desc: 'object-audio-array', build: (enc) => ({ audio: enc.array() }) },
+  { desc: 'object-input-dataUrl', build: (enc) => ({ input: enc.dataUrl() }) },
+  // Additional plausible shapes
+  { desc: 'object-audio-content', build: (enc) => ({ audio: { content: enc.base64() } }) },
+  { desc: 'object-audio-data', build: (enc) => ({ audio: { data: enc.base64() } }) },
+  { desc: 'object-file-dataUrl', build: (enc) => ({ file: enc.dataUrl() }) },
+  { desc: 'object-content-dataUrl', build: (enc) => ({ content: enc.dataUrl() }) },
+  { desc: 'object-input-audio', build: (enc) => ({ input: { audio: enc.dataUrl() } }) },
+  { desc: 'object-audio_url', build: (enc) => ({ audio_url: enc.dataUrl() }) },
+  { desc: 'object-url', build: (enc) => ({ url: enc.dataUrl() }) },
+  { desc: 'object-media', build: (enc) => ({ media: enc.dataUrl() }) }
+];
+
+// Module scope (lives as long as the isolate): model -> desc of the last shape that succeeded
+const sttShapeCache = new Map();
+
+// Shapes in attempt order: the remembered shape for this model first, then the rest in declared order
+function sttPayloadShapes(model) {
+  const cached = sttShapeCache.get(model);
+  if (!cached) return STT_PAYLOAD_SHAPES;
+  const first = STT_PAYLOAD_SHAPES.find((shape) => shape.desc === cached);
+  return first ? [first, ...STT_PAYLOAD_SHAPES.filter((shape) => shape !== first)] : STT_PAYLOAD_SHAPES;
+}
+
+// Hoisted helper: convert Uint8Array to base64 (chunked to avoid call-size limits)
+function bytesToBase64(bytes) {
+  let binary = '';
+  const chunkSize = 0x8000; // 32KB chunk
+  for (let i = 0; i < bytes.length; i += chunkSize) {
+    const slice = bytes.subarray(i, i + chunkSize);
+    binary += String.fromCharCode.apply(null, slice);
+  }
+  return btoa(binary);
+}
+
+// Memoized encodings of a WAV: each one is computed on first use and at most once
+function lazyWavEncodings(wavBytes) {
+  let base64 = null;
+  let dataUrl = null;
+  let array = null;
+  const encodings = {
+    bytes: wavBytes,
+    base64: () => (base64 ??= bytesToBase64(wavBytes)),
+    dataUrl: () => (dataUrl ??= 'data:audio/wav;base64,' + encodings.base64()),
+    array: () => (array ??= Array.from(wavBytes))
+  };
+  return encodings;
+}
+
+// Rate of the buffered audio and of the WAV sent to STT; client audio is resampled to it on ingest
+const SAMPLE_RATE = 16000;
+const msToSamples = (ms) => Math.round(ms * SAMPLE_RATE / 1000);
+
+const DEFAULT_SESSION_OPTIONS = {
+  partials: false,        // transcribe overlapping windows while audio arrives
+  partialWindowMs: 6000,  // length of each partial window
+  partialHopMs: 2000,     // new audio required before the next window runs
+  vad: false,             // server-side VAD: trim silence and end turns automatically
+  vadThresholdDb: VAD_DEFAULTS.thresholdDb,
+  vadHangoverMs: VAD_DEFAULTS.hangoverMs,
+  responseAudio: 'binary', // 'binary' (0x02 frames) or 'json' (legacy response_audio array)
+  inputEncoding: 'pcm16', // client audio: 'pcm16', 'mulaw' or 'alaw' (G.711, e.g. telephony), 'opus' (0x03 frames)
+  inputSampleRate: SAMPLE_RATE, // client audio rate: 8000, 16000, 24000 or 48000
+  bargeIn: true,          // VAD speech onset interrupts the reply being spoken
+  timings: false,         // attach the turn's TurnTimer marks to transcription / response audio messages
+  ack: 'chunk',           // 'chunk' (ack every chunk), 'count', 'interval' (cumulative acks) or 'none'
+  ackEvery: 10,           // chunks per cumulative ack with ack 'count'
+  ackIntervalMs: 200,     // longest wait for a cumulative ack with ack 'interval'
+  ackBinary: false,       // acknowledge binary audio frames with 0x04 frames instead of chunk_received JSON
+  gapFill: 'zero',        // sequenced frames: fill a gap (up to MAX_GAP_FILL_MS) with silence ('zero') or only report it ('none')
+  turnBudgetMs: 30000,    // end_stream -> first reply audio: what STT, the LLM call and the first TTS call may take together
+  hedge: false            // send a duplicate of a model call still unanswered after its p95 latency (src/scheduler.js)
+};
+
+// Options can be set with query params (?partials=1&partial_window_ms=...) or a session_config message
+function sessionOptionsFromUrl(url) {
+  const params = new URL(url).searchParams;
+  const options = { ...DEFAULT_SESSION_OPTIONS };
+  applySessionConfig(options, Object.fromEntries(params.entries()));
+  return options;
+}
+
+function applySessionConfig(options, config) {
+  const flag = (v) => v === true || v === 1 || v === '1' || v === 'true';
+  const int = (v, min, max, fallback) => {
+    const n = Number(v);
+    return Number.isFinite(n) ? Math.min(max, Math.max(min, Math.round(n))) : fallback;
+  };
+  if (config.partials !== undefined) options.partials = flag(config.partials);
+  if (config.partial_window_ms !== undefined) options.partialWindowMs = int(config.partial_window_ms, 2000, 30000, options.partialWindowMs);
+  if (config.partial_hop_ms !== undefined) options.partialHopMs = int(config.partial_hop_ms, 500, 10000, options.partialHopMs);
+  if (config.vad !== undefined) options.vad = flag(config.vad);
+  if (config.vad_threshold_db !== undefined) {
+    const db = Number(config.vad_threshold_db);
+    if (Number.isFinite(db)) options.vadThresholdDb = Math.min(0, Math.max(-90, db));
+  }
+  if (config.vad_hangover_ms !== undefined) options.vadHangoverMs = int(config.vad_hangover_ms, 100, 5000, options.vadHangoverMs);
+  if (config.barge_in !== undefined) options.bargeIn = flag(config.barge_in);
+  if (config.timings !== undefined) options.timings = flag(config.timings);
+  if (ACK_POLICIES.includes(config.ack)) options.ack = config.ack;
+  if (config.ack_every !== undefined) options.ackEvery = int(config.ack_every, 1, 1000, options.ackEvery);
+  if (config.ack_interval_ms !== undefined) options.ackIntervalMs = int(config.ack_interval_ms, 20, 5000, options.ackIntervalMs);
+  if (config.ack_binary !== undefined) options.ackBinary = flag(config.ack_binary);
+  if (config.gap_fill === 'zero' || config.gap_fill === 'none') options.gapFill = config.gap_fill;
+  if (config.turn_budget_ms !== undefined) options.turnBudgetMs = int(config.turn_budget_ms, 2000, 120000, options.turnBudgetMs);
+  if (config.hedge !== undefined) options.hedge = flag(config.hedge);
+  if (config.response_audio === 'binary' || config.response_audio === 'json') options.responseAudio = config.response_audio;
+  if (INPUT_ENCODINGS.includes(config.input_encoding)) options.inputEncoding = config.input_encoding;
+  if (config.input_sample_rate !== undefined && INPUT_SAMPLE_RATES.includes(Number(config.input_sample_rate))) {
+    options.inputSampleRate = Number(config.input_sample_rate);
+  }
+  // A window must be longer than its hop so consecutive windows overlap
+  options.partialWindowMs = Math.max(options.partialWindowMs, options.partialHopMs + 1000);
+  return options;
+}
+
+function describeSessionOptions(options) {
+  return {
+    partials: options.partials,
+    partial_window_ms: options.partialWindowMs,
+    partial_hop_ms: options.partialHopMs,
+    vad: options.vad,
+    vad_threshold_db: options.vadThresholdDb,
+    vad_hangover_ms: options.vadHangoverMs,
+    response_audio: options.responseAudio,
+    input_encoding: options.inputEncoding,
+    input_sample_rate: options.inputSampleRate,
+    barge_in: options.bargeIn,
+    timings: options.timings,
+    ack: options.ack,
+    ack_every: options.ackEvery,
+    ack_interval_ms: options.ackIntervalMs,
+    ack_binary: options.ackBinary,
+    gap_fill: options.gapFill,
+    turn_budget_ms: options.turnBudgetMs,
+    hedge: options.hedge
+  };
+}
+
+export function createVad(options) {
+  if (!options.vad) return null;
+  return new VoiceActivityDetector({
+    sampleRate: SAMPLE_RATE,
+    thresholdDb: options.vadThresholdDb,
+    hangoverMs: options.vadHangoverMs
+  });
+}
+
+// session_configured with the effective options; `rejected` says what was refused, if anything
+export function sessionConfigured(ws, session, rejected = null) {
+  const reply = { type: 'session_configured', session_id: session.id, options: describeSessionOptions(session.options) };
+  if (rejected) reply.rejected = rejected;
+  try { ws.send(JSON.stringify(reply)); } catch(e){}
+}
+
+function codecRejection(inputEncoding, err) {
+  return { input_encoding: inputEncoding, reason: 'codec_unavailable', message: err.message };
+}
+
+export function createInputDecoder(options) {
+  if (options.inputEncoding === 'opus') return new OpusInputDecoder(SAMPLE_RATE);
+  return new InputDecoder(options.inputEncoding, options.inputSampleRate, SAMPLE_RATE);
+}
+
+// Replace the session's decoder after its input options changed. Opus frames are rejected until the
+// WASM decoder has loaded; if it cannot load, the session falls back to `fallback` and the load
+// error is returned (null otherwise).
+export async function switchInputDecoder(session, fallback = 'pcm16') {
+  session.decoder?.free?.();
+  session.decoder = createInputDecoder(session.options);
+  if (!session.decoder.ready) return null;
+  try {
+    await session.decoder.ready;
+    return null;
+  } catch (err) {
+    console.warn(`Session ${session.id}: ${session.options.inputEncoding} decoder unavailable:`, err?.message);
+    session.options.inputEncoding = fallback === session.options.inputEncoding ? 'pcm16' : fallback;
+    session.decoder = createInputDecoder(session.options);
+    return err;
+  }
+}
+
+// Load the decoder a session starts with before it handles any audio: Opus from the upgrade URL's
+// input_encoding, or from the options of a restored checkpoint. Without this, frames sent while the
+// WASM loads would be dropped. If it cannot load, the session falls back to pcm16 and the returned
+// rejection (null otherwise) is for the host to send with sessionConfigured, as a refused
+// session_config would be.
+export async function prepareInputDecoder(session) {
+  const requested = session.options.inputEncoding;
+  const err = await switchInputDecoder(session);
+  return err ? codecRejection(requested, err) : null;
+}
+
+// End of the caller's turn (end_stream, or a bulk frame with BULK_AUDIO_FLAG_END): place held
+// sequenced frames, close any open VAD utterance, then process the accumulated audio asynchronously
+function endStream(ws, session, env) {
+  // Frames still held past a gap belong to this turn: their gaps will not close now
+  const held = releaseHeld(ws, session, env, true);
+  const turn = (session.vad ? handleVadEvents(ws, session, env, session.vad.flush()) : undefined) ?? held;
+  session.timer?.mark('end_stream');
+  // Every chunk of the turn is acknowledged before its replies
+  flushAcks(ws, session);
+  return startTurn(ws, session, env) ?? turn;
+}
+
+// Common ingest for binary frames and JSON chunks: with VAD on, only utterance audio is buffered
+// (leading/trailing silence trimmed) and the end of an utterance starts a turn by itself.
+// `decodeStart` is when decoding of these samples began (now()), for the decode stage.
+function ingestSamples(ws, session, env, samples, decodeStart = null) {
+  if (decodeStart !== null) observeStage('decode', now() - decodeStart);
+  session.timer ??= new TurnTimer(decodeStart ?? now());
+  session.timer.mark('last_chunk', true);
+  let turn;
+  if (!session.vad) {
+    session.audioBuffer.append(samples);
+  } else {
+    turn = handleVadEvents(ws, session, env, session.vad.process(samples));
+  }
+  bufferChanged(session);
+  return turn;
+}
+
+// Sequenced frames (0x05) carry their position in the call's input stream: `seq` counts frames and
+// `offset` is the index of the first sample, at the input rate, since the first frame of the call.
+// Audio is placed by offset. A frame that lands past the next expected offset is held for up to
+// REORDER_WINDOW_MS of audio, so frames that were merely reordered still close the gap; once the
+// window is over (or the turn ends) the gap is reported with audio_gap and, with gap_fill "zero"
+// and up to MAX_GAP_FILL_MS, filled with silence, so the audio after it keeps its timing. Gaps
+// longer than that are skipped (the stream jumps). A frame wholly before the next expected offset
+// is a duplicate (a resend after a reconnect) and is dropped, unless it falls in a gap the stream
+// already moved past: it is then counted as late. A partial overlap is trimmed. A skipped seq that
+// turns up later is no longer counted in lost_frames.
+// The position survives reconnects and checkpoints, and session_resumed reports it, so a client
+// resumes from next_offset instead of re-sending the turn.
+const MAX_GAP_FILL_MS = 2000;
+const REORDER_WINDOW_MS = 200;
+const MAX_MISSING_SEQS = 256;   // skipped seq numbers remembered (the most recent)
+const MAX_PASSED_GAPS = 64;     // gaps the stream moved past, remembered to tell late frames from duplicates
+
+export function newStreamState() {
+  return {
+    nextSeq: 0,
+    nextOffset: 0,
+    missing: [],     // seq numbers skipped over and not seen since
+    passedGaps: [],  // [start, end) input offsets filled with silence or skipped
+    held: [],        // frames past a gap, by offset: { seq, offset, end, bytes }
+    stats: { frames: 0, duplicates: 0, late_frames: 0, reordered_frames: 0, lost_frames: 0, gaps: 0, gap_samples: 0, filled_samples: 0, overlap_samples: 0 }
+  };
+}
+
+export function describeStream(stream) {
+  return { next_seq: stream.nextSeq, next_offset: stream.nextOffset, held_frames: stream.held.length, ...stream.stats };
+}
+
+function ingestSequenced(ws, session, env, seq, offset, bytes, sampleCount) {
+  const stream = session.stream;
+  const stats = stream.stats;
+  stats.frames++;
+  noteSeq(stream, seq);
+  const end = offset + sampleCount;
+  if (end <= stream.nextOffset) {
+    if (stream.passedGaps.some(([a, b]) => offset < b && end > a)) stats.late_frames++;
+    else stats.duplicates++;
+    return;
+  }
+  if (offset > stream.nextOffset) {
+    // Only a frame the held ones cover whole is a duplicate; one that partly overlaps them is
+    // trimmed when it is placed
+    if (heldSamples(stream, offset, end) === end - offset) {
+      stats.duplicates++;
+      return;
+    }
+    // slice: the frame outlives the message (and may be checkpointed)
+    stream.held.push({ seq, offset, end, bytes: bytes.slice() });
+    stream.held.sort((a, b) => a.offset - b.offset);
+    if (heldSamples(stream) * 1000 < REORDER_WINDOW_MS * session.options.inputSampleRate) return;
+    return releaseHeld(ws, session, env, true);
+  }
+  const turn = placeFrame(ws, session, env, seq, offset, bytes);
+  return releaseHeld(ws, session, env, false) ?? turn;
+}
+
+// Samples in [from, to) that held frames cover, overlapping frames counted once
+function heldSamples(stream, from = 0, to = Infinity) {
+  let covered = 0;
+  let pos = from;
+  for (const f of stream.held) {
+    const start = Math.max(f.offset, pos);
+    const end = Math.min(f.end, to);
+    if (end > start) {
+      covered += end - start;
+      pos = end;
+    }
+  }
+  return covered;
+}
+
+// Track skipped seq numbers: lost until they turn up
+function noteSeq(stream, seq) {
+  if (seq >= stream.nextSeq) {
+    for (let s = Math.max(stream.nextSeq, seq - MAX_MISSING_SEQS); s < seq; s++) stream.missing.push(s);
+    if (stream.missing.length > MAX_MISSING_SEQS) stream.missing.splice(0, stream.missing.length - MAX_MISSING_SEQS);
+    stream.stats.lost_frames += seq - stream.nextSeq;
+    stream.nextSeq = seq + 1;
+    return;
+  }
+  const i = stream.missing.indexOf(seq);
+  if (i >= 0) {
+    stream.missing.splice(i, 1);
+    stream.stats.lost_frames--;
+    stream.stats.reordered_frames++;
+  }
+}
+
+// Place the held frames that now follow on; with `force` (reorder window over, end of turn) all of
+// them, gaps included
+function releaseHeld(ws, session, env, force) {
+  const stream = session.stream;
+  let turn;
+  while (stream.held.length > 0 && (force || stream.held[0].offset <= stream.nextOffset)) {
+    const frame = stream.held.shift();
+    if (frame.end <= stream.nextOffset) {
+      stream.stats.duplicates++;
+      continue;
+    }
+    turn = placeFrame(ws, session, env, frame.seq, frame.offset, frame.bytes) ?? turn;
+  }
+  return turn;
+}
+
+// Append a frame at its offset: trim what overlaps the stream, fill or skip the gap before it
+function placeFrame(ws, session, env, seq, offset, bytes) {
+  const stream = session.stream;
+  const stats = stream.stats;
+  const bytesPerSample = session.decoder.bytesPerSample;
+  const end = offset + bytes.length / bytesPerSample;
+  let skip = 0;
+  let filled;
+  if (offset < stream.nextOffset) {
+    skip = stream.nextOffset - offset;
+    stats.overlap_samples += skip;
+  } else if (offset > stream.nextOffset) {
+    const gap = offset - stream.nextOffset;
+    const rate = session.options.inputSampleRate;
+    const fill = session.options.gapFill === 'zero' && gap * 1000 <= MAX_GAP_FILL_MS * rate;
+    stats.gaps++;
+    stats.gap_samples += gap;
+    stream.passedGaps.push([stream.nextOffset, offset]);
+    if (stream.passedGaps.length > MAX_PASSED_GAPS) stream.passedGaps.shift();
+    try {
+      ws.send(JSON.stringify({ type: 'audio_gap', seq, offset: stream.nextOffset, samples: gap, filled: fill, timestamp: Date.now() }));
+    } catch(e){}
+    if (fill) {
+      stats.filled_samples += gap;
+      filled = ingestSamples(ws, session, env, new Int16Array(Math.round(gap * SAMPLE_RATE / rate)));
+    }
+  }
+  stream.nextOffset = end;
+  const decodeStart = now();
+  const samples = session.decoder.decodeBytes(bytes.subarray(skip * bytesPerSample));
+  return ingestSamples(ws, session, env, samples, decodeStart) ?? filled;
+}
+
+// Returns the promise of a turn started by the end of an utterance, if any
+function handleVadEvents(ws, session, env, events) {
+  let turn;
+  for (const ev of events) {
+    if (ev.type === 'audio') {
+      session.audioBuffer.append(ev.samples);
+    } else if (ev.type === 'start') {
+      session.utteranceStart = session.audioBuffer.length;
+      try { ws.send(JSON.stringify({ type: 'speech_started', timestamp: Date.now() })); } catch(e){}
+      // The caller talking over the reply stops it
+      if (session.options.bargeIn && session.reply) interruptTurn(ws, session, 'speech');
+    } else if (ev.type === 'end') {
+      try { ws.send(JSON.stringify({ type: 'speech_ended', speech_ms: ev.speechMs, discarded: ev.discard, timestamp: Date.now() })); } catch(e){}
+      if (ev.discard) {
+        // Too short to be an utterance (clicks, breaths): drop its audio from the buffer
+        session.audioBuffer.truncate(session.utteranceStart);
+        bufferChanged(session);
+      } else {
+        session.timer?.mark('end_stream');
+        turn = startTurn(ws, session, env) ?? turn;
+      }
+    }
+  }
+  return turn;
+}
+
+// Let the host know the buffered audio changed (the Durable Object checkpoints it)
+function bufferChanged(session) {
+  if (session.onBufferChange) session.onBufferChange(session);
+}
+
+// Process the buffered turn; if one is already running, run again once it finishes.
+// Returns a promise that settles after this turn and any turn queued behind it.
+function startTurn(ws, session, env) {
+  if (session.isProcessing) {
+    session.turnQueued = true;
+    return;
+  }
+  return processAudioBuffer(ws, session, env).catch((err) => {
+    console.error('processAudioBuffer error:', err?.message, err?.stack);
+    try { ws.send(JSON.stringify({ type: 'error', message: 'Processing failed', error: { message: err?.message } })); } catch(e){}
+  }).finally(() => {
+    if (session.turnQueued) {
+      session.turnQueued = false;
+      if (session.audioBuffer.length > 0) return startTurn(ws, session, env);
+    }
+  });
+}
+
+const WAV_HEADER_BYTES = 44;
+
+// The one WAV assembly routine (STT turns, partial windows, dump_wav): a minimal WAV (PCM 16-bit,
+// mono) of samples [start, end) of an AudioStore. The output is allocated once at its final size,
+// the 44-byte header is written in place and the samples are copied straight into the body.
+export function buildWav(store, start = 0, end = store.length, sampleRate = SAMPLE_RATE, numChannels = 1, bitsPerSample = 16) {
+  const sampleCount = Math.max(0, Math.min(end, store.length) - start);
+  const dataSize = sampleCount * 2; // bytes
+  const wav = new Uint8Array(WAV_HEADER_BYTES + dataSize);
+  const view = new DataView(wav.buffer);
+  const blockAlign = numChannels * bitsPerSample / 8;
+  const byteRate = sampleRate * blockAlign;
+
+  // RIFF identifier
+  writeString(view, 0, 'RIFF');
+  view.setUint32(4, 36 + dataSize, true); // file length - 8
+  writeString(view, 8, 'WAVE');
+  writeString(view, 12, 'fmt ');
+  view.setUint32(16, 16, true); // PCM chunk length
+  view.setUint16(20, 1, true); // Audio format (1 = PCM)
+  view.setUint16(22, numChannels, true);
+  view.setUint32(24, sampleRate, true);
+  view.setUint32(28, byteRate, true);
+  view.setUint16(32, blockAlign, true);
+  view.setUint16(34, bitsPerSample, true);
+  writeString(view, 36, 'data');
+  view.setUint32(40, dataSize, true);
+
+  store.copyTo(new Int16Array(wav.buffer, WAV_HEADER_BYTES, sampleCount), 0, start, start + sampleCount);
+  return wav;
+}
+
+function writeString(view, offset, str) {
+  for (let i = 0; i < str.length; i++) {
+    view.setUint8(offset + i, str.charCodeAt(i));
+  }
+}
+
+// Run Whisper on a WAV, trying payload shapes until the AI binding accepts one (remembered shape first).
+// Every attempt goes through the AI scheduler (src/scheduler.js) at `priority`, bounded by `deadline`,
+// and is recorded (voice_ai_run_duration_ms, and the turn's `timer` when given). With `hedge` the
+// remembered shape may be sent twice; shapes still being probed never are.
+export async function runStt(env, wavBytes, { signal = null, timer = null, priority = 'live', deadline = null, hedge = false } = {}) {
+  const encodings = lazyWavEncodings(wavBytes);
+  const knownShape = sttShapeCache.get(STT_MODEL);
+  let lastError = null;
+  for (const shape of sttPayloadShapes(STT_MODEL)) {
+    try {
+      const payload = shape.build(encodings);
+      console.log('AI.run attempt:', shape.desc, typeof payload, Array.isArray(payload) ? 'array' : Object.keys(payload || {}));
+      const sttResponse = await scheduleAiRun(STT_MODEL, () => env.AI.run(STT_MODEL, payload), {
+        priority, deadline, signal, timer,
+        timeoutMs: 20000,
+        shape: shape.desc,
+        hedge: hedge && shape.desc === knownShape
+      });
+      console.log('AI.run succeeded with attempt:', shape.desc);
+      sttShapeCache.set(STT_MODEL, shape.desc);
+      return sttResponse;
+    } catch (err) {
+      if (signal?.aborted || err?.message === TURN_BUDGET_EXHAUSTED) throw err;
+      // Log detailed error for this attempt so we can see why schema rejected it
+      console.warn('AI.run attempt failed:', shape.desc, err?.message);
+      console.warn(err?.stack || err);
+      lastError = err;
+      // keep trying next shapes
+    }
+  }
+  // cause: whether the model timed out or was over capacity (POST /transcribe answers 503 then)
+  const err = new Error('All AI.run payload attempts failed', { cause: lastError });
+  console.error(err);
+  throw err;
+}
+
+// Per-turn state for incremental (partial) transcription; replaced wholesale when a turn ends
+function newPartialState() {
+  return { stitcher: new TranscriptStitcher(), lastWindowEnd: 0, pending: null, seq: 0 };
+}
+
+// Start a partial transcription of the latest window if enough new audio arrived and none is running
+function maybeRunPartial(ws, session, env) {
+  const state = session.partial;
+  if (!session.options.partials || session.isProcessing || state.pending) return;
+  const end = session.audioBuffer.length;
+  if (end - state.lastWindowEnd < msToSamples(session.options.partialHopMs)) return;
+  const start = Math.max(0, end - msToSamples(session.options.partialWindowMs));
+  // Snapshot the window now; the buffer keeps growing while STT runs
+  const wavBytes = buildWav(session.audioBuffer, start, end);
+  state.lastWindowEnd = end;
+  state.pending = runPartialWindow(ws, session, env, state, wavBytes, start, end)
+    .finally(() => { state.pending = null; });
+  return state.pending;
+}
+
+async function runPartialWindow(ws, session, env, state, wavBytes, start, end) {
+  try {
+    const sttResponse = await runStt(env, wavBytes, { priority: 'background', hedge: session.options.hedge });
+    // The turn may have ended while STT ran; its partial state has then been replaced
+    if (session.partial !== state) return;
+    const text = state.stitcher.addWindow(sttResponse, start / SAMPLE_RATE, end / SAMPLE_RATE);
+    ws.send(JSON.stringify({
+      type: 'transcription_partial',
+      seq: ++state.seq,
+      text,
+      window_text: sttResponse?.text || '',
+      window_start_ms: Math.round(start * 1000 / SAMPLE_RATE),
+      window_end_ms: Math.round(end * 1000 / SAMPLE_RATE),
+      timestamp: Date.now()
+    }));
+  } catch (err) {
+    // Partials are best-effort; the end-of-turn pass still produces the final transcript
+    console.warn('Partial transcription failed:', err?.message);
+  }
+}
+
+async function handleAudioChunk(ws, data, session, env) {
+  // Add audio chunk to buffer (decoded to 16kHz Int16 once, appended with a single copy)
+  const decodeStart = now();
+  const turn = ingestSamples(ws, session, env, session.decoder.decodeValues(data.audio), decodeStart);
+
+  ackChunk(ws, session, data.audio.length, false);
+
+  // Do not auto-process the full buffer here; that occurs on explicit 'end_stream' from the client.
+  // In partials mode a window transcription may start in the background.
+  await (turn ?? maybeRunPartial(ws, session, env));
+}
+
+async function processAudioBuffer(ws, session, env) {
+  if (session.isProcessing || session.audioBuffer.length === 0) {
+    return;
+  }
+
+  session.isProcessing = true;
+  const turn = new AbortController();
+  session.turn = turn;
+
+  try {
+    // Settle an in-flight partial window first so its words land in this turn's transcript
+    const partial = session.options.partials ? session.partial : null;
+    if (partial?.pending) await partial.pending;
+
+    // Detach this turn's audio (an AudioStore of int16 samples); audio arriving while the turn
+    // is processed is buffered for the next one instead of being cleared with it
+    const store = session.audioBuffer;
+    session.audioBuffer = new AudioStore();
+    session.partial = newPartialState();
+    session.utteranceStart = 0;
+    bufferChanged(session);
+    const sampleCount = store.length;
+    // The turn's marks move with its audio; chunks arriving from now on start the next timer
+    const timer = session.timer ?? new TurnTimer();
+    session.timer = null;
+    timer.mark('turn_start');
+    timer.span('queue', 'end_stream', 'turn_start');
+    // STT, the LLM call and the first clause's TTS share the turn budget, counted from end_stream
+    // (turn_start when VAD ended the turn); each call's timeout is cut to what is left of it
+    const deadline = timer.origin + (timer.marks.end_stream ?? timer.marks.turn_start) + session.options.turnBudgetMs;
+
+    console.log(`Processing ${sampleCount * 2} bytes (${sampleCount} samples) of audio for session ${session.id}`);
+
+    // In partials mode only the tail not yet covered by a window (plus overlap) goes to STT
+    let start = 0;
+    if (partial && partial.lastWindowEnd > 0) {
+      const overlapMs = Math.max(session.options.partialWindowMs - session.options.partialHopMs, 1000);
+      start = Math.max(0, partial.lastWindowEnd - msToSamples(overlapMs));
+    }
+
+    const wavBytes = buildWav(store, start, sampleCount);
+    timer.mark('wav_built').span('wav_build', 'turn_start', 'wav_built');
+
+    // Diagnostics (head/tail + sizes) to correlate STT failures; only with ?debug=1, so a normal
+    // turn pays for no extra encoding or message
+    if (session.debug) sendProcessingDebug(ws, wavBytes, sampleCount - start);
+
+    const sttResponse = await runStt(env, wavBytes, { signal: turn.signal, timer, deadline, hedge: session.options.hedge });
+    turn.signal.throwIfAborted();
+    timer.mark('stt_done').span('stt', 'wav_built', 'stt_done');
+
+  // Log raw STT response for diagnostics and extract transcription
+  console.log('STT raw response:', typeof sttResponse, Object.keys(sttResponse || {}));
+  const transcription = partial
+    ? partial.stitcher.addWindow(sttResponse, start / SAMPLE_RATE, sampleCount / SAMPLE_RATE, { final: true })
+    : sttResponse && (sttResponse.text || sttResponse.transcript || '') || '';
+  console.log(`Transcription: "${transcription}"`);
+
+    // Send transcription back to client (stitched from the windows in partials mode)
+    ws.send(JSON.stringify({
+      type: partial ? 'transcription_final' : 'transcription',
+      text: transcription,
+      timings: turnTimings(session, timer),
+      timestamp: Date.now()
+    }));
+
+    // If we have a transcription, generate a response
+    if (transcription.trim()) {
+      const spoken = await generateResponse(ws, transcription, env, session, turn.signal, timer, deadline);
+      turnsTotal.inc({ outcome: turn.signal.aborted ? 'interrupted' : spoken ? 'ok' : 'error' });
+    } else {
+      turnsTotal.inc({ outcome: 'empty' });
+    }
+
+  } catch (error) {
+    // An interrupted turn has already been reported by interruptTurn
+    turnsTotal.inc({ outcome: turn.signal.aborted ? 'interrupted' : 'error' });
+    if (turn.signal.aborted) return;
+    console.error('Audio processing error:', error?.message, error?.stack);
+    ws.send(JSON.stringify({
+      type: 'error',
+      message: 'Failed to process audio',
+      error: {
+        message: error?.message || String(error),
+        stack: (error && error.stack) ? String(error.stack).split('\n').slice(0,5).join('\n') : undefined
+      }
+    }));
+  } finally {
+    session.isProcessing = false;
+    if (session.turn === turn) session.turn = null;
+  }
+}
+
+// The `timings` field of an outbound message: the turn's marks, with the `timings` option only
+function turnTimings(session, timer) {
+  return session.options.timings && timer ? timer.toJSON() : undefined;
+}
+
+function sendProcessingDebug(ws, wavBytes, samples) {
+  try {
+    const debugMsg = {
+      type: 'processing_debug',
+      bytesLength: wavBytes.length,
+      samples,
+      sampleRate: SAMPLE_RATE,
+      headBase64: bytesToBase64(wavBytes.subarray(0, Math.min(64, wavBytes.length))),
+      tailBase64: bytesToBase64(wavBytes.subarray(Math.max(0, wavBytes.length - 64))),
+      timestamp: Date.now()
+    };
+    // best-effort send; ignore failures
+    try { ws.send(JSON.stringify(debugMsg)); } catch(e){}
+    console.log('Processing debug:', { bytesLength: wavBytes.length, samples });
+  } catch (e) {
+    console.warn('Failed to generate processing debug', e?.message);
+  }
+}
+
+// Binary frame types (first byte)
+const FRAME_AUDIO = 0x01;           // client -> worker: uint16 sample count + Int16 samples
+const FRAME_RESPONSE_AUDIO = 0x02;  // worker -> client: flags + uint32 seq + TTS audio bytes
+const FRAME_OPUS = 0x03;            // client -> worker: uint8 packet count + (uint16 length + Opus packet)*
+const FRAME_ACK = 0x04;             // worker -> client: uint32 seq + uint16 chunks + uint32 buffer size
+const FRAME_SEQ_AUDIO = 0x05;       // client -> worker: version + uint32 seq + uint32 sample offset + uint16 count + samples
+const FRAME_BULK_AUDIO = 0x06;      // client -> worker: flags + uint32 sample count + samples (a whole recording)
+const SEQ_AUDIO_VERSION = 1;
+const SEQ_AUDIO_HEADER_BYTES = 12;
+const BULK_AUDIO_HEADER_BYTES = 6;  // even, so PCM16 samples stay 2-byte aligned in the message buffer
+const BULK_AUDIO_FLAG_END = 0x01;   // end the turn after this audio (as end_stream)
+const ACK_FRAME_BYTES = 11;
+const RESPONSE_AUDIO_FLAG_FINAL = 0x01;
+const RESPONSE_AUDIO_HEADER_BYTES = 6;
+const RESPONSE_AUDIO_MAX_PAYLOAD = 16 * 1024;
+
+function responseAudioFrame(seq, payload, final) {
+  const frame = new Uint8Array(RESPONSE_AUDIO_HEADER_BYTES + payload.length);
+  const view = new DataView(frame.buffer);
+  view.setUint8(0, FRAME_RESPONSE_AUDIO);
+  view.setUint8(1, final ? RESPONSE_AUDIO_FLAG_FINAL : 0);
+  view.setUint32(2, seq, true);
+  frame.set(payload, RESPONSE_AUDIO_HEADER_BYTES);
+  return frame;
+}
+
+// Chunk acknowledgements (the `ack` option). Every ack is cumulative: `seq` is the number of audio
+// chunks received on this connection and `chunks` how many of them this ack covers, so a client can
+// release its outstanding chunks whatever the policy. 'chunk' acks each chunk, 'count' every
+// ackEvery chunks, 'interval' at most ackIntervalMs after the first unacknowledged chunk, 'none'
+// never. end_stream and session_config flush whatever is pending.
+const ACK_POLICIES = ['chunk', 'count', 'interval', 'none'];
+
+function newAckState() {
+  return { seq: 0, acked: 0, samples: 0, binary: false, timer: null };
+}
+
+// A new connection starts counting again (the Durable Object keeps the session across sockets)
+export function resetAcks(session) {
+  clearTimeout(session.acks?.timer);
+  session.acks = newAckState();
+}
+
+// Count one received chunk of `chunkSize` samples and acknowledge it as the policy says
+function ackChunk(ws, session, chunkSize, binary) {
+  const acks = session.acks;
+  acks.seq++;
+  acks.samples += chunkSize;
+  acks.binary = binary;
+  const { ack, ackEvery, ackIntervalMs } = session.options;
+  if (ack === 'none') {
+    acks.acked = acks.seq;
+    acks.samples = 0;
+  } else if (ack === 'chunk' || (ack === 'count' && acks.seq - acks.acked >= ackEvery)) {
+    flushAcks(ws, session);
+  } else if (ack === 'interval' && acks.timer === null) {
+    acks.timer = setTimeout(() => flushAcks(ws, session), ackIntervalMs);
+  }
+}
+
+// Send one ack for every chunk not acknowledged yet (nothing if there are none)
+function flushAcks(ws, session) {
+  const acks = session.acks;
+  clearTimeout(acks.timer);
+  acks.timer = null;
+  const chunks = acks.seq - acks.acked;
+  if (chunks === 0) return;
+  const bufferSize = session.audioBuffer.length;
+  try {
+    if (acks.binary && session.options.ackBinary) {
+      const frame = new Uint8Array(ACK_FRAME_BYTES);
+      const view = new DataView(frame.buffer);
+      view.setUint8(0, FRAME_ACK);
+      view.setUint32(1, acks.seq, true);
+      view.setUint16(5, Math.min(chunks, 0xFFFF), true);
+      view.setUint32(7, bufferSize, true);
+      ws.send(frame);
+    } else {
+      ws.send(JSON.stringify({ type: 'chunk_received', seq: acks.seq, chunks, chunk_size: acks.samples, buffer_size: bufferSize }));
+    }
+  } catch(e){}
+  acks.acked = acks.seq;
+  acks.samples = 0;
+}
+
+// Opus packets of a 0x03 frame as subarray views (a frame batches e.g. five 20ms packets)
+function parseOpusFrame(buf) {
+  const count = buf[1];
+  const packets = [];
+  let offset = 2;
+  for (let i = 0; i < count; i++) {
+    if (offset + 2 > buf.length) throw new Error('opus frame too short');
+    const length = buf[offset] | (buf[offset + 1] << 8);
+    offset += 2;
+    if (length === 0 || offset + length > buf.length) throw new Error('opus frame too short');
+    packets.push(buf.subarray(offset, offset + length));
+    offset += length;
+  }
+  return packets;
+}
+
+// Module scope: synthesized speech shared by every session in this isolate (optional KV tier via env.TTS_CACHE)
+export const ttsCache = new TtsCache();
+
+// Audio for a clause as { cached, encoding, chunks, cancel }: replayed from the cache on a hit,
+// otherwise streamed from the TTS model (a live call, bounded by `deadline`, hedged with `hedge`)
+// and stored in the cache once the whole clip has been seen
+async function ttsAudioSource(env, text, signal = null, timer = null, { deadline = null, hedge = false } = {}) {
+  if (env.TTS_CACHE && !ttsCache.store) ttsCache.store = new KvTtsStore(env.TTS_CACHE);
+  const key = await ttsCacheKey(TTS_MODEL, TTS_VOICE, TTS_LANGUAGE, text);
+  const hit = await ttsCache.get(key);
+  if (hit) {
+    timer?.mark('tts_first_byte');
+    return { cached: true, encoding: hit.meta.encoding || sniffAudioEncoding(hit.bytes), chunks: [hit.bytes], cancel() {} };
+  }
+  const startedAt = now();
+  const ttsResult = await scheduleAiRun(TTS_MODEL, () => env.AI.run(TTS_MODEL, ttsRequest(text)), {
+    deadline, signal, timer, hedge,
+    timeoutMs: 15000,
+    shape: 'stream',
+    release: cancelTtsResult
+  });
+  return {
+    cached: false,
+    encoding: null,
+    chunks: cacheWhileStreaming(key, timedTtsChunks(ttsAudioChunks(ttsResult, 15000, signal), startedAt, timer)),
+    cancel: () => cancelTtsResult(ttsResult)
+  };
+}
+
+// TTS latency of a clause synthesized by the model. The first chunk is read as soon as the call
+// resolves, so a clause queued behind another still reports its own first byte (tts_first_byte);
+// the rest is read as it is forwarded, so `tts` (call -> last chunk) includes waiting for the
+// clauses ahead. Aborting the source's signal cancels the prefetched read like any other.
+function timedTtsChunks(chunks, startedAt, timer) {
+  const first = chunks.next();
+  first.then(({ done }) => {
+    if (done) return;
+    observeStage('tts_first_byte', now() - startedAt);
+    timer?.mark('tts_first_byte');
+  }, () => {});
+  return (async function* () {
+    const { done, value } = await first;
+    if (done) return;
+    yield value;
+    yield* chunks;
+    observeStage('tts', now() - startedAt);
+  })();
+}
+
+async function* cacheWhileStreaming(key, chunks) {
+  let parts = [];
+  let total = 0;
+  for await (const chunk of chunks) {
+    if (parts) {
+      parts.push(chunk);
+      total += chunk.length;
+      // Too large to cache: stop collecting, keep streaming
+      if (total > ttsCache.maxEntryBytes) parts = null;
+    }
+    yield chunk;
+  }
+  if (!parts || total === 0) return;
+  const bytes = new Uint8Array(total);
+  let offset = 0;
+  for (const part of parts) {
+    bytes.set(part, offset);
+    offset += part.length;
+  }
+  ttsCache.put(key, bytes, { encoding: sniffAudioEncoding(bytes), sample_rate: TTS_SAMPLE_RATE })
+    .catch((err) => console.warn('TTS cache put failed:', err?.message));
+}
+
+// Forward TTS audio as it is produced: response_audio_start, then 0x02 frames (<=16KB payload each,
+// the last one flagged final), then response_audio_end. One chunk is held back so the final flag
+// can ride on the last frame. Once `signal` aborts nothing more is sent (interruptTurn closes the
+// response); `reply` records what went out so an interruption can be accounted for, and its
+// `timer` gets the first_audio / audio_end marks.
+async function streamResponseAudio(ws, session, source, signal = null, reply = {}) {
+  const responseId = ++session.responseSeq;
+  let seq = 0;
+  let bytes = 0;
+  let pending = null;
+  let started = false;
+  const sendFrame = (payload, final) => {
+    ws.send(responseAudioFrame(seq++, payload, final));
+    bytes += payload.length;
+    reply.frames = seq;
+    reply.bytesSent = bytes;
+  };
+
+  for await (const chunk of source.chunks) {
+    signal?.throwIfAborted();
+    if (!started) {
+      started = true;
+      reply.responseId = responseId;
+      reply.encoding = source.encoding || sniffAudioEncoding(chunk);
+      reply.startedAt = Date.now();
+      reply.timer?.mark('first_audio').span('first_audio', 'end_stream', 'first_audio');
+      ws.send(JSON.stringify({
+        type: 'response_audio_start',
+        response_id: responseId,
+        encoding: reply.encoding,
+        sample_rate: TTS_SAMPLE_RATE,
+        channels: 1,
+        cached: source.cached,
+        timings: turnTimings(session, reply.timer),
+        timestamp: reply.startedAt
+      }));
+    }
+    for (let i = 0; i < chunk.length; i += RESPONSE_AUDIO_MAX_PAYLOAD) {
+      if (pending) sendFrame(pending, false);
+      pending = chunk.subarray(i, i + RESPONSE_AUDIO_MAX_PAYLOAD);
+    }
+  }
+  signal?.throwIfAborted();
+  if (!started) return;
+  sendFrame(pending ?? new Uint8Array(0), true);
+  reply.timer?.mark('audio_end').span('turn', 'end_stream', 'audio_end');
+  ws.send(JSON.stringify({
+    type: 'response_audio_end',
+    response_id: responseId,
+    frames: seq,
+    bytes,
+    timings: turnTimings(session, reply.timer),
+    timestamp: Date.now()
+  }));
+}
+
+// Legacy JSON delivery (response_audio option 'json'): the whole clip as an array of byte values
+async function sendResponseAudioJson(ws, session, source, signal = null, timer = null) {
+  const chunks = [];
+  let total = 0;
+  for await (const chunk of source.chunks) {
+    chunks.push(chunk);
+    total += chunk.length;
+  }
+  signal?.throwIfAborted();
+  if (total === 0) return;
+  const audio = new Uint8Array(total);
+  let offset = 0;
+  for (const chunk of chunks) {
+    audio.set(chunk, offset);
+    offset += chunk.length;
+  }
+  // The whole clip is the first audio the client gets
+  timer?.mark('first_audio').span('first_audio', 'end_stream', 'first_audio');
+  timer?.mark('audio_end').span('turn', 'end_stream', 'audio_end');
+  ws.send(JSON.stringify({
+    type: 'response_audio',
+    audio: Array.from(audio),
+    timings: turnTimings(session, timer),
+    timestamp: Date.now()
+  }));
+}
+
+// Replies come from a streaming text-generation model and are spoken clause by clause: each clause
+// goes to TTS as soon as the splitter completes it, at most RESPONSE_TTS_AHEAD clauses are being
+// synthesized or waiting their turn, and the audio goes out in clause order as one response while
+// later clauses are still being generated. `signal` is the turn's (session.turn); aborting it
+// stops generation, synthesis and forwarding. session.reply tracks what was said (interruptTurn).
+// Returns whether the whole reply was sent.
+const RESPONSE_TTS_AHEAD = 2;
+
+async function generateResponse(ws, userText, env, session, signal, timer = null, deadline = null) {
+  const reply = { userText, clauses: [], clauseOffsets: [], responseId: null, encoding: null, startedAt: 0, frames: 0, bytesSent: 0, done: false, timer };
+  session.reply = reply;
+  try {
+    const clauses = splitClauses(replyText(env, session, userText, signal, timer, deadline));
+    // Show each clause as it goes to TTS (response_text_delta), then the whole reply (response_text)
+    const audioSource = speakClauses(env, clauses, signal, {
+      clause(text) {
+        ws.send(JSON.stringify({ type: 'response_text_delta', text, index: reply.clauses.length, timestamp: Date.now() }));
+        reply.clauses.push(text);
+      },
+      done() {
+        ws.send(JSON.stringify({ type: 'response_text', text: reply.clauses.join(' '), clauses: reply.clauses.length, timestamp: Date.now() }));
+      }
+    }, timer, { deadline, hedge: session.options.hedge });
+    reply.clauseOffsets = audioSource.clauseOffsets;
+
+    // Send audio response back: binary frames as the model streams them, or legacy JSON
+    if (session.options.responseAudio === 'json') {
+      await sendResponseAudioJson(ws, session, audioSource, signal, timer);
+    } else {
+      await streamResponseAudio(ws, session, audioSource, signal, reply);
+    }
+    reply.done = true;
+    rememberTurn(session, userText, reply.clauses.join(' '));
+
+  } catch (error) {
+    if (signal.aborted) return;
+    console.error('Response generation error:', error?.message, error?.stack);
+    ws.send(JSON.stringify({
+      type: 'error',
+      message: 'Failed to generate response',
+      error: {
+        message: error?.message || String(error),
+        stack: (error && error.stack) ? String(error.stack).split('\n').slice(0,5).join('\n') : undefined
+      }
+    }));
+  } finally {
+    // A finished reply stays until the next one: it can still be interrupted while it plays
+    if (!reply.done && session.reply === reply) session.reply = null;
+  }
+  return reply.done;
+}
+
+// Text of the reply as the model produces it. A canned reply stands in when the model fails before
+// its first token (or the turn budget ends before the call is answered); a failure after that ends
+// the reply with what was generated so far.
+async function* replyText(env, session, userText, signal, timer = null, deadline = null) {
+  let produced = false;
+  try {
+    const request = llmRequest(userText, session.history);
+    const result = await scheduleAiRun(LLM_MODEL, () => env.AI.run(LLM_MODEL, request), {
+      deadline, signal, timer,
+      hedge: session.options.hedge,
+      timeoutMs: 15000,
+      shape: 'stream',
+      release: cancelLlmResult
+    });
+    for await (const text of llmTextChunks(result, 15000, signal)) {
+      if (!produced) timer?.mark('llm_first_token').span('llm_first_token', 'stt_done', 'llm_first_token');
+      produced = true;
+      yield text;
+    }
+  } catch (err) {
+    if (signal.aborted) throw err;
+    console.warn(`Text generation failed${produced ? ' mid-reply' : ''}:`, err?.message);
+  }
+  if (!produced) yield FALLBACK_RESPONSES[Math.floor(Math.random() * FALLBACK_RESPONSES.length)];
+}
+
+async function* splitClauses(texts) {
+  const splitter = new ClauseSplitter();
+  for await (const text of texts) yield* splitter.push(text);
+  yield* splitter.flush();
+}
+
+// Audio of a stream of clauses as one source ({ cached, encoding, chunks, clauseOffsets }, cached/
+// encoding those of the first clause, clauseOffsets the byte offset where each clause's audio
+// starts). A producer reads clauses and starts their TTS while fewer than RESPONSE_TTS_AHEAD are
+// pending (hooks.clause(text) as each starts, hooks.done() after the last); the chunks generator
+// forwards them in order. Either side failing, the consumer stopping early or `signal` aborting
+// stops both and releases unplayed syntheses. `timer` gets the TTS marks. The first clause's
+// synthesis is bounded by the turn's `deadline` (later ones play while it is spent); `hedge`
+// applies to all of them.
+function speakClauses(env, clauses, signal, hooks, timer = null, { deadline = null, hedge = false } = {}) {
+  const stop = new AbortController();
+  const onAbort = () => stop.abort(signal.reason);
+  if (signal.aborted) onAbort();
+  else signal.addEventListener('abort', onAbort, { once: true });
+
+  const queue = [];   // promises of TTS sources, in clause order, until forwarded
+  const waiters = [];
+  const changed = () => { for (const resolve of waiters.splice(0)) resolve(); };
+  const nextChange = () => new Promise((resolve) => waiters.push(resolve));
+  stop.signal.addEventListener('abort', changed, { once: true });
+  let producing = true;
+  let failure = null;
+  let first = true;
+
+  (async () => {
+    try {
+      for await (const clause of clauses) {
+        while (queue.length >= RESPONSE_TTS_AHEAD && !stop.signal.aborted) await nextChange();
+        if (stop.signal.aborted) break;
+        hooks.clause(clause);
+        const source = ttsAudioSource(env, clause, stop.signal, timer, { deadline: first ? deadline : null, hedge });
+        first = false;
+        source.catch(() => {}); // reported by the consumer, in clause order
+        queue.push(source);
+        changed();
+      }
+      if (!stop.signal.aborted) hooks.done();
+    } catch (err) {
+      failure = err;
+    } finally {
+      producing = false;
+      changed();
+    }
+  })();
+
+  const audio = { cached: false, encoding: null, chunks: null, clauseOffsets: [] };
+  audio.chunks = (async function* () {
+    let offset = 0;
+    try {
+      for (let index = 0; ; index++) {
+        while (queue.length === 0 && producing && !stop.signal.aborted) await nextChange();
+        stop.signal.throwIfAborted();
+        if (queue.length === 0) {
+          if (failure) throw failure;
+          timer?.mark('tts_done');
+          return;
+        }
+        const source = await queue[0];
+        if (index === 0) {
+          audio.cached = source.cached;
+          audio.encoding = source.encoding;
+        }
+        audio.clauseOffsets.push(offset);
+        for await (const chunk of source.chunks) {
+          offset += chunk.length;
+          yield chunk;
+        }
+        queue.shift();
+        changed();
+      }
+    } finally {
+      signal.removeEventListener('abort', onAbort);
+      stop.abort();
+      for (const source of queue) source.then((s) => s.cancel(), () => {});
+    }
+  })();
+  return audio;
+}
+
+// Keep the last LLM_HISTORY_TURNS exchanges as context for the next reply
+function rememberTurn(session, userText, reply) {
+  if (!reply) return;
+  session.history.push({ role: 'user', content: userText }, { role: 'assistant', content: reply });
+  session.history.splice(0, session.history.length - 2 * LLM_HISTORY_TURNS);
+}
+
+// Barge-in: an `interrupt` message, or speech onset while a reply is generated or heard. A reply
+// still in progress is stopped by aborting its turn, so pending AI.run calls are abandoned, their
+// streams cancelled and no further response frames sent; a reply whose audio was all sent may
+// still be playing on the client, so it is only accounted for. An explicit interrupt also stops a
+// turn that is still transcribing. The report says how much audio was sent and played (played_ms
+// from the client, else assumed real-time from response_audio_start); only the clauses that
+// started playing stay in the conversation history.
+function interruptTurn(ws, session, reason, clientPlayedMs = null) {
+  const reply = session.reply;
+  const turn = session.turn;
+  let stage = null;
+  if (reply && !reply.done) {
+    stage = 'reply';
+    turn.abort(new Error(`Turn interrupted (${reason})`));
+  } else if (reason === 'client' && turn && !turn.signal.aborted) {
+    stage = 'transcription';
+    turn.abort(new Error(`Turn interrupted (${reason})`));
+  } else if (reply && replyPlaying(reply)) {
+    stage = 'playback';
+  }
+  const report = { type: 'response_interrupted', reason, stage, response_id: null, sent_ms: null, played_ms: null, clauses_generated: 0, heard_text: '' };
+  if (stage === null) {
+    if (reason === 'client') try { ws.send(JSON.stringify({ ...report, timestamp: Date.now() })); } catch(e){}
+    return false;
+  }
+
+  if (stage !== 'transcription') {
+    session.reply = null;
+    const timed = reply.encoding === 'linear16';
+    const sentMs = timed ? audioBytesToMs(reply.bytesSent) : null;
+    const playedMs = reply.responseId && timed ? Math.min(sentMs, clientPlayedMs ?? (Date.now() - reply.startedAt)) : null;
+    const heard = !reply.responseId ? [] : reply.clauses.filter((_, i) => {
+      const offset = reply.clauseOffsets[i];
+      if (offset === undefined) return false;
+      return playedMs !== null ? audioBytesToMs(offset) < playedMs : offset < reply.bytesSent;
+    });
+    // A finished reply was remembered in full; keep only what was heard
+    if (reply.done && session.history.at(-1)?.content === reply.clauses.join(' ')) session.history.splice(-2, 2);
+    rememberTurn(session, reply.userText, heard.join(' '));
+    Object.assign(report, {
+      response_id: reply.responseId,
+      sent_ms: sentMs,
+      played_ms: playedMs,
+      clauses_generated: reply.clauses.length,
+      heard_text: heard.join(' ')
+    });
+  }
+
+  try {
+    if (stage === 'reply' && reply.responseId) {
+      ws.send(JSON.stringify({
+        type: 'response_audio_end',
+        response_id: reply.responseId,
+        frames: reply.frames,
+        bytes: reply.bytesSent,
+        interrupted: true,
+        timestamp: Date.now()
+      }));
+    }
+    ws.send(JSON.stringify({ ...report, timestamp: Date.now() }));
+  } catch(e){}
+  console.log(`Session ${session.id}: ${stage} interrupted (${reason}), ${report.played_ms ?? '?'} of ${report.sent_ms ?? '?'} ms played`);
+  return true;
+}
+
+const audioBytesToMs = (bytes) => Math.round(bytes / 2 * 1000 / TTS_SAMPLE_RATE);
+
+// Whether the client is presumably still playing a reply whose audio has all been sent (linear16 only)
+function replyPlaying(reply) {
+  return reply.encoding === 'linear16' && reply.responseId !== null && Date.now() - reply.startedAt < audioBytesToMs(reply.bytesSent);
+}
@@ -0,0 +1,88 @@
+// Stitch transcripts of overlapping audio windows into one running transcript.
+// When Whisper returns word timestamps, words are placed on the absolute timeline: words that end
+// more than `guardSeconds` before the window edge are committed, later ones stay provisional and
+// are replaced by the next window. Without timestamps the windows are merged on their longest
+// common run of (normalized) words.
+
+const TEXT_MERGE_LOOKBACK = 40; // words of the running transcript searched for an overlap
+
+const normalizeWord = (w) => w.toLowerCase().replace(/[^\p{L}\p{N}']+/gu, '');
+
+export class TranscriptStitcher {
+  constructor(guardSeconds = 1.0) {
+    this.guardSeconds = guardSeconds;
+    this.committed = [];
+    this.provisional = [];
+    this.committedUntil = 0; // seconds on the absolute timeline
+  }
+
+  get text() {
+    return this.committed.concat(this.provisional).map((w) => w.word).join(' ');
+  }
+
+  // Add the STT response for window [windowStart, windowEnd] (seconds); returns the stitched text
+  addWindow(sttResponse, windowStart, windowEnd, { final = false } = {}) {
+    const words = Array.isArray(sttResponse?.words) ? sttResponse.words : null;
+    if (words && words.length > 0) {
+      this.addTimedWords(words, windowStart, windowEnd, final);
+    } else {
+      const text = sttResponse?.text || sttResponse?.transcript || '';
+      this.mergeText(text.split(/\s+/).filter(Boolean));
+    }
+    return this.text;
+  }
+
+  addTimedWords(words, windowStart, windowEnd, final) {
+    const stableEnd = final ? Infinity : windowEnd - this.guardSeconds;
+    const provisional = [];
+    for (const w of words) {
+      const word = String(w.word ?? '').trim();
+      if (!word) continue;
+      const start = windowStart + (Number(w.start) || 0);
+      const end = windowStart + (Number(w.end) || 0);
+      // Words already covered by the committed transcript (midpoint before the commit point) are skipped
+      if ((start + end) / 2 < this.committedUntil) continue;
+      if (end <= stableEnd && provisional.length === 0) {
+        this.committed.push({ word, start, end });
+        this.committedUntil = end;
+      } else {
+        provisional.push({ word, start, end });
+      }
+    }
+    this.provisional = provisional;
+  }
+
+  mergeText(tokens) {
+    const current = this.committed.concat(this.provisional);
+    this.provisional = [];
+    if (tokens.length === 0) {
+      this.committed = current;
+      return;
+    }
+    const offset = Math.max(0, current.length - TEXT_MERGE_LOOKBACK);
+    const prev = current.slice(offset).map((w) => normalizeWord(w.word));
+    const next = tokens.map(normalizeWord);
+
+    // Longest common run of words between the tail of the transcript and the new window
+    let best = { len: 0, iEnd: 0, jEnd: 0 };
+    let row = new Array(next.length + 1).fill(0);
+    for (let i = 1; i <= prev.length; i++) {
+      const cur = new Array(next.length + 1).fill(0);
+      for (let j = 1; j <= next.length; j++) {
+        if (prev[i - 1] && prev[i - 1] === next[j - 1]) {
+          cur[j] = row[j - 1] + 1;
+          if (cur[j] > best.len) best = { len: cur[j], iEnd: i, jEnd: j };
+        }
+      }
+      row = cur;
+    }
+
+    const minMatch = Math.min(2, prev.length, next.length);
+    if (minMatch > 0 && best.len >= minMatch) {
+      // Keep the transcript up to the overlap, then take the new window from there on
+      this.committed = current.slice(0, offset + best.iEnd).concat(tokens.slice(best.jEnd).map((word) => ({ word })));
+    } else {
+      this.committed = current.concat(tokens.map((word) => ({ word })));
+    }
+  }
+}
@@ -0,0 +1,100 @@
+// Text-to-speech helpers: request parameters and normalization of the AI binding's TTS output
+// into a stream of Uint8Array chunks, so audio can be forwarded as soon as the model produces it.
+
+export const TTS_MODEL = '@cf/deepgram/aura-1';
+export const TTS_VOICE = 'angus';
+export const TTS_LANGUAGE = 'en';
+export const TTS_SAMPLE_RATE = 24000;
+
+// Ask for raw 16-bit PCM so clients can append frames straight into a WAV
+export function ttsRequest(text, voice = TTS_VOICE, language = TTS_LANGUAGE) {
+  return {
+    text,
+    speaker: voice,
+    language,
+    encoding: 'linear16',
+    container: 'none',
+    sample_rate: TTS_SAMPLE_RATE
+  };
+}
+
+// Yield the audio of a TTS result chunk by chunk. Accepts a ReadableStream, a Response, raw bytes,
+// or an object with an `audio` field holding any of those (or base64 text). Aborting `signal`
+// cancels the stream and makes the generator throw, so a partial clip is never mistaken for a whole one.
+export async function* ttsAudioChunks(result, readTimeoutMs = 15000, signal = null) {
+  const audio = result?.audio ?? result;
+  if (!audio) return;
+  if (typeof audio === 'string') {
+    yield base64ToBytes(audio);
+    return;
+  }
+  if (audio instanceof Uint8Array) {
+    yield audio;
+    return;
+  }
+  if (audio instanceof ArrayBuffer || ArrayBuffer.isView(audio)) {
+    yield toBytes(audio);
+    return;
+  }
+  const stream = audio instanceof Response ? audio.body : audio;
+  if (stream && typeof stream.getReader === 'function') {
+    const reader = stream.getReader();
+    const onAbort = () => reader.cancel().catch(() => {});
+    signal?.addEventListener('abort', onAbort, { once: true });
+    let finished = false;
+    try {
+      while (true) {
+        const { done, value } = await readWithTimeout(reader, readTimeoutMs);
+        signal?.throwIfAborted();
+        if (done) break;
+        if (value && value.byteLength > 0) yield toBytes(value);
+      }
+      finished = true;
+    } finally {
+      // Stopped early (reply cancelled, consumer gone): tell the model to stop producing audio
+      signal?.removeEventListener('abort', onAbort);
+      if (!finished) reader.cancel().catch(() => {});
+      reader.releaseLock();
+    }
+    return;
+  }
+  // Legacy shape: array of byte values
+  if (Array.isArray(audio)) yield Uint8Array.from(audio);
+}
+
+// Release a TTS result whose audio will not be read (its reply was cancelled before it was spoken)
+export function cancelTtsResult(result) {
+  const audio = result?.audio ?? result;
+  const stream = audio instanceof Response ? audio.body : audio;
+  if (stream && typeof stream.cancel === 'function' && !stream.locked) stream.cancel().catch(() => {});
+}
+
+// Identify the container/encoding of the first audio bytes (the model may ignore the requested encoding)
+export function sniffAudioEncoding(bytes) {
+  if (bytes.length >= 4 && bytes[0] === 0x52 && bytes[1] === 0x49 && bytes[2] === 0x46 && bytes[3] === 0x46) return 'wav';
+  if (bytes.length >= 3 && bytes[0] === 0x49 && bytes[1] === 0x44 && bytes[2] === 0x33) return 'mp3';
+  if (bytes.length >= 2 && bytes[0] === 0xff && (bytes[1] & 0xe0) === 0xe0) return 'mp3';
+  if (bytes.length >= 4 && bytes[0] === 0x4f && bytes[1] === 0x67 && bytes[2] === 0x67 && bytes[3] === 0x53) return 'ogg';
+  return 'linear16';
+}
+
+export function readWithTimeout(reader, ms, message = 'TTS stream read timed out') {
+  let timer;
+  return Promise.race([
+    reader.read(),
+    new Promise((_, rej) => { timer = setTimeout(() => rej(new Error(message)), ms); })
+  ]).finally(() => clearTimeout(timer));
+}
+
+function toBytes(value) {
+  if (value instanceof Uint8Array) return value;
+  if (value instanceof ArrayBuffer) return new Uint8Array(value);
+  return new Uint8Array(value.buffer, value.byteOffset, value.byteLength);
+}
+
+function base64ToBytes(b64) {
+  const binary = atob(b64);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+  return bytes;
+}
@@ -0,0 +1,118 @@
+// Content-addressed cache for synthesized speech.
+// Keys are SHA-256 over (model, voice, language, normalized text). Entries live in an in-isolate
+// LRU bounded by a byte budget, with an optional persistent tier behind a small interface:
+//
+//   store.get(key)              -> Promise<{ bytes: Uint8Array, meta: object } | null>
+//   store.put(key, bytes, meta) -> Promise<void>
+//
+// KvTtsStore implements it on a Workers KV namespace.
+
+const DEFAULT_MAX_BYTES = 8 * 1024 * 1024;
+const DEFAULT_MAX_ENTRY_BYTES = 1024 * 1024;
+
+// Whitespace and Unicode form do not change the spoken output; case and punctuation can (prosody)
+export function normalizeTtsText(text) {
+  return String(text).normalize('NFC').replace(/\s+/g, ' ').trim();
+}
+
+export async function ttsCacheKey(model, voice, language, text) {
+  const material = JSON.stringify([model, voice || '', language || '', normalizeTtsText(text)]);
+  const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(material));
+  return Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, '0')).join('');
+}
+
+export class TtsCache {
+  constructor({ maxBytes = DEFAULT_MAX_BYTES, maxEntryBytes = DEFAULT_MAX_ENTRY_BYTES, store = null } = {}) {
+    this.maxBytes = maxBytes;
+    this.maxEntryBytes = Math.min(maxEntryBytes, maxBytes);
+    this.store = store;
+    this.entries = new Map(); // key -> { bytes, meta }; Map order is LRU order (oldest first)
+    this.bytes = 0;
+    this.counters = { hits: 0, misses: 0, memory_hits: 0, store_hits: 0, puts: 0, evictions: 0, store_errors: 0 };
+  }
+
+  async get(key) {
+    const entry = this.entries.get(key);
+    if (entry) {
+      this.entries.delete(key);
+      this.entries.set(key, entry);
+      this.counters.hits++;
+      this.counters.memory_hits++;
+      return entry;
+    }
+    if (this.store) {
+      try {
+        const stored = await this.store.get(key);
+        if (stored) {
+          this.remember(key, stored);
+          this.counters.hits++;
+          this.counters.store_hits++;
+          return stored;
+        }
+      } catch (err) {
+        this.counters.store_errors++;
+        console.warn('TTS cache store get failed:', err?.message);
+      }
+    }
+    this.counters.misses++;
+    return null;
+  }
+
+  async put(key, bytes, meta = {}) {
+    if (bytes.length === 0 || bytes.length > this.maxEntryBytes) return;
+    this.counters.puts++;
+    this.remember(key, { bytes, meta });
+    if (this.store) {
+      try {
+        await this.store.put(key, bytes, meta);
+      } catch (err) {
+        this.counters.store_errors++;
+        console.warn('TTS cache store put failed:', err?.message);
+      }
+    }
+  }
+
+  remember(key, entry) {
+    const existing = this.entries.get(key);
+    if (existing) {
+      this.bytes -= existing.bytes.length;
+      this.entries.delete(key);
+    }
+    this.entries.set(key, entry);
+    this.bytes += entry.bytes.length;
+    for (const [oldKey, old] of this.entries) {
+      if (this.bytes <= this.maxBytes) break;
+      this.entries.delete(oldKey);
+      this.bytes -= old.bytes.length;
+      this.counters.evictions++;
+    }
+  }
+
+  stats() {
+    return {
+      ...this.counters,
+      entries: this.entries.size,
+      bytes: this.bytes,
+      max_bytes: this.maxBytes,
+      persistent: Boolean(this.store)
+    };
+  }
+}
+
+// Persistent tier on a KV namespace binding (metadata carries encoding / sample rate)
+export class KvTtsStore {
+  constructor(kv, { ttlSeconds = 30 * 24 * 3600, prefix = 'tts:' } = {}) {
+    this.kv = kv;
+    this.ttlSeconds = ttlSeconds;
+    this.prefix = prefix;
+  }
+
+  async get(key) {
+    const { value, metadata } = await this.kv.getWithMetadata(this.prefix + key, { type: 'arrayBuffer' });
+    return value ? { bytes: new Uint8Array(value), meta: metadata || {} } : null;
+  }
+
+  async put(key, bytes, meta) {
+    await this.kv.put(this.prefix + key, bytes, { expirationTtl: this.ttlSeconds, metadata: meta });
+  }
+}
@@ -0,0 +1,165 @@
+// Energy / zero-crossing voice activity detector for 16kHz Int16 audio.
+// Mirrors test/vad.py (same defaults, same decisions) so thresholds can be tuned offline.
+//
+// Audio is judged in fixed frames. A frame is speech when its RMS level clears the threshold
+// (the larger of thresholdDb and the tracked noise floor + noiseMarginDb); inside an utterance a
+// quieter frame with a high zero-crossing rate (fricatives) also counts. `process()` returns
+// events for the caller:
+//   { type: 'start' }                         speech onset confirmed
+//   { type: 'audio', samples }                audio belonging to the utterance (pre-roll included)
+//   { type: 'end', speechMs, discard }        hangover elapsed; discard=true for blips under minSpeechMs
+// Leading silence beyond preRollMs and trailing silence beyond postRollMs are never emitted.
+
+export const VAD_DEFAULTS = {
+  sampleRate: 16000,
+  frameMs: 20,
+  thresholdDb: -45,
+  noiseMarginDb: 10,
+  zcrThreshold: 0.3,
+  fricativeMarginDb: 6,
+  onsetMs: 60,
+  hangoverMs: 600,
+  preRollMs: 200,
+  postRollMs: 200,
+  minSpeechMs: 250
+};
+
+const NOISE_FLOOR_INIT_DB = -70;
+const NOISE_FLOOR_ALPHA = 0.05;
+
+export function frameLevels(frame) {
+  let sumSquares = 0;
+  let crossings = 0;
+  for (let i = 0; i < frame.length; i++) {
+    const v = frame[i];
+    sumSquares += v * v;
+    if (i > 0 && (v >= 0) !== (frame[i - 1] >= 0)) crossings++;
+  }
+  const meanSquare = sumSquares / Math.max(1, frame.length);
+  const db = meanSquare > 0 ? 10 * Math.log10(meanSquare / (32768 * 32768)) : -100;
+  return { db, zcr: crossings / Math.max(1, frame.length - 1) };
+}
+
+export class VoiceActivityDetector {
+  constructor(options = {}) {
+    this.options = { ...VAD_DEFAULTS, ...options };
+    const o = this.options;
+    const frames = (ms) => Math.max(1, Math.round(ms / o.frameMs));
+    this.frameSamples = Math.round(o.sampleRate * o.frameMs / 1000);
+    this.onsetFrames = frames(o.onsetMs);
+    this.hangoverFrames = frames(o.hangoverMs);
+    this.preRollFrames = Math.round(o.preRollMs / o.frameMs);
+    this.postRollFrames = Math.round(o.postRollMs / o.frameMs);
+    this.minSpeechFrames = frames(o.minSpeechMs);
+    this.reset();
+  }
+
+  reset() {
+    this.partial = new Int16Array(this.frameSamples);
+    this.partialFill = 0;
+    this.inSpeech = false;
+    this.noiseFloorDb = NOISE_FLOOR_INIT_DB;
+    this.preRoll = [];   // silence frames kept for the next onset
+    this.onset = [];     // speech frames not yet confirmed as an onset
+    this.held = [];      // silence frames inside an utterance, released if speech resumes
+    this.speechFrames = 0;
+  }
+
+  isSpeech(frame) {
+    const { db, zcr } = frameLevels(frame);
+    const o = this.options;
+    const threshold = Math.max(o.thresholdDb, this.noiseFloorDb + o.noiseMarginDb);
+    let speech = db >= threshold;
+    if (!speech && this.inSpeech) speech = db >= threshold - o.fricativeMarginDb && zcr >= o.zcrThreshold;
+    if (!speech) this.noiseFloorDb += NOISE_FLOOR_ALPHA * (db - this.noiseFloorDb);
+    return speech;
+  }
+
+  // Feed samples (Int16Array); returns a list of events
+  process(samples) {
+    const events = [];
+    let offset = 0;
+    while (offset < samples.length) {
+      const n = Math.min(this.frameSamples - this.partialFill, samples.length - offset);
+      this.partial.set(samples.subarray(offset, offset + n), this.partialFill);
+      this.partialFill += n;
+      offset += n;
+      if (this.partialFill === this.frameSamples) {
+        const frame = this.partial;
+        this.partial = new Int16Array(this.frameSamples);
+        this.partialFill = 0;
+        this.processFrame(frame, events);
+      }
+    }
+    return events;
+  }
+
+  processFrame(frame, events) {
+    const speech = this.isSpeech(frame);
+    if (!this.inSpeech) {
+      if (speech) {
+        this.onset.push(frame);
+        if (this.onset.length >= this.onsetFrames) {
+          this.inSpeech = true;
+          this.speechFrames = this.onset.length;
+          events.push({ type: 'start' });
+          events.push({ type: 'audio', samples: concatFrames(this.preRoll.concat(this.onset)) });
+          this.preRoll = [];
+          this.onset = [];
+        }
+      } else {
+        // A broken onset becomes pre-roll candidate audio
+        this.preRoll.push(...this.onset, frame);
+        this.onset = [];
+        if (this.preRoll.length > this.preRollFrames) this.preRoll.splice(0, this.preRoll.length - this.preRollFrames);
+      }
+      return;
+    }
+
+    if (speech) {
+      this.speechFrames++;
+      this.held.push(frame);
+      events.push({ type: 'audio', samples: concatFrames(this.held) });
+      this.held = [];
+      return;
+    }
+
+    this.held.push(frame);
+    if (this.held.length >= this.hangoverFrames) this.endUtterance(events);
+  }
+
+  endUtterance(events) {
+    const tail = this.held.slice(0, this.postRollFrames);
+    if (tail.length > 0) events.push({ type: 'audio', samples: concatFrames(tail) });
+    const speechMs = this.speechFrames * this.options.frameMs;
+    events.push({ type: 'end', speechMs, discard: this.speechFrames < this.minSpeechFrames });
+    this.preRoll = this.preRollFrames > 0 ? this.held.slice(-this.preRollFrames) : [];
+    this.held = [];
+    this.inSpeech = false;
+    this.speechFrames = 0;
+  }
+
+  // End of input (e.g. explicit end_stream): close an open utterance without waiting for hangover
+  flush() {
+    const events = [];
+    if (this.inSpeech) {
+      // The trailing partial frame still belongs to the utterance
+      if (this.partialFill > 0) this.held.push(this.partial.slice(0, this.partialFill));
+      this.endUtterance(events);
+    }
+    this.partialFill = 0;
+    this.onset = [];
+    return events;
+  }
+}
+
+function concatFrames(frames) {
+  if (frames.length === 1) return frames[0];
+  const out = new Int16Array(frames.reduce((n, f) => n + f.length, 0));
+  let offset = 0;
+  for (const f of frames) {
+    out.set(f, offset);
+    offset += f.length;
+  }
+  return out;
+}
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+Offline transcription through POST /transcribe, mirroring src/batch.js.
+
+The worker reads the request body (a WAV file, or raw audio described by
+?encoding= / ?sample_rate= / ?channels=) as a stream, cuts it at pauses into
+segments of at most max_segment_ms (SilenceSegmenter, same decisions as the
+JS), transcribes up to `concurrency` segments at once and answers with the
+segments in order, their words on the recording's timeline and the joined
+text. transcribe_body() is the same pipeline for the stand-in
+(local_worker.py serves it on --http-port), with the same statuses: 400 only
+for a body that is not supported audio (BatchInputError), 503 when the model
+was out of time or capacity, 502 when every segment failed otherwise, 500
+for anything else.
+
+Usage:
+  python3 batch.py segments path/to/call.wav [--max-segment-ms 30000] [--min-silence-ms 300] [--silence-db -45]
+  python3 batch.py transcribe call1.wav call2.wav ... [--url https://...] [--concurrency 4] [--files 2] [--hedge] [--json out.json]
+
+`segments` previews the cuts offline (no worker needed). `transcribe` uploads
+each file as one streamed request, --files at a time, and prints each
+transcript with its segment timings.
+"""
+
+import argparse
+import array
+import asyncio
+import concurrent.futures
+import http.client
+import json
+import os
+import ssl
+import struct
+import sys
+import time
+from urllib.parse import urlsplit
+
+import codec
+import endpoints
+import pcm
+import vad
+
+SAMPLE_RATE = pcm.SAMPLE_RATE
+FRAME_MS = vad.VAD_DEFAULTS['frame_ms']
+FRAME_SAMPLES = SAMPLE_RATE * FRAME_MS // 1000
+MAX_WAV_HEADER_BYTES = 64 * 1024
+WAV_FORMATS = {1: 'pcm16', 6: 'alaw', 7: 'mulaw'}  # WAVE format tag -> input encoding
+UPLOAD_BLOCK_BYTES = 64 * 1024
+
+BATCH_DEFAULTS = {
+    'concurrency': 4,
+    'max_segment_ms': 30000,
+    'min_silence_ms': 300,
+    'silence_db': vad.VAD_DEFAULTS['threshold_db'],
+    'min_speech_ms': vad.VAD_DEFAULTS['min_speech_ms'],
+    'hedge': False,
+}
+
+
+def batch_options(params):
+    """BATCH_DEFAULTS overridden by query params, clamped as batchOptionsFromUrl does."""
+    def clamp(name, lo, hi):
+        try:
+            value = float(params[name])
+        except (KeyError, TypeError, ValueError):
+            return BATCH_DEFAULTS[name]
+        return min(hi, max(lo, round(value)))
+    return dict(BATCH_DEFAULTS, concurrency=clamp('concurrency', 1, 10),
+                max_segment_ms=clamp('max_segment_ms', 5000, 30000),
+                min_silence_ms=clamp('min_silence_ms', 100, 2000),
+                silence_db=clamp('silence_db', -90, -10),
+                hedge=params.get('hedge') in ('1', 'true'))
+
+
+class SilenceSegmenter:
+    """Cuts a 16 kHz stream at pauses (SilenceSegmenter in src/batch.js).
+
+    A segment may end once it is a third of max_segment_ms long, in the middle
+    of the first pause of min_silence_ms; one that reaches max_segment_ms
+    without such a pause is cut at its quietest frame past that third. push()
+    and flush() return the closed segments as dicts: index, start (sample
+    offset), samples, speech_ms.
+    """
+
+    def __init__(self, **options):
+        o = dict(BATCH_DEFAULTS, **options)
+        self.silence_db = o['silence_db']
+        self.max_frames = round(o['max_segment_ms'] / FRAME_MS)
+        self.min_frames = self.max_frames // 3
+        self.min_silence_frames = max(1, round(o['min_silence_ms'] / FRAME_MS))
+        self.samples = array.array('h')
+        self.levels = []  # dBFS of each whole frame of the current segment
+        self.start = 0
+        self.index = 0
+
+    def push(self, samples):
+        closed = []
+        self.samples.extend(samples)
+        while len(self.samples) >= (len(self.levels) + 1) * FRAME_SAMPLES:
+            i = len(self.levels) * FRAME_SAMPLES
+            self.levels.append(vad.frame_levels(self.samples[i:i + FRAME_SAMPLES])[0])
+            cut = self.cut_frame()
+            if cut is not None:
+                closed.append(self.cut(cut))
+        return closed
+
+    def flush(self):
+        return [self.cut(len(self.levels), everything=True)] if self.samples else []
+
+    def cut_frame(self):
+        n = len(self.levels)
+        if n < self.min_frames:
+            return None
+        run = 0
+        while run < n and self.levels[n - 1 - run] < self.silence_db:
+            run += 1
+        if run >= self.min_silence_frames and n - run >= self.min_frames:
+            return n - (run + 1) // 2
+        if n < self.max_frames:
+            return None
+        return min(range(self.min_frames, n), key=lambda i: (self.levels[i], i))
+
+    def cut(self, frame, everything=False):
+        end = len(self.samples) if everything else frame * FRAME_SAMPLES
+        speech_frames = sum(1 for db in self.levels[:frame] if db >= self.silence_db)
+        segment = {'index': self.index, 'start': self.start, 'samples': self.samples[:end],
+                   'speech_ms': speech_frames * FRAME_MS}
+        self.index += 1
+        self.samples = self.samples[end:]
+        self.levels = self.levels[frame:]
+        self.start += end
+        return segment
+
+
+class BatchInputError(ValueError):
+    """The request body is not audio in a supported format (the client's fault: 400)."""
+
+
+def is_overload(err):
+    """Out of time (timeout, turn budget) or model capacity: worth retrying later."""
+    reason = err.__cause__ or err
+    return isinstance(reason, TimeoutError) or str(reason) == 'turn budget exhausted' or \
+        getattr(reason, 'code', None) == 3040
+
+
+def parse_wav_header(data):
+    """Format of the WAV header at the start of data, or None while more bytes are needed."""
+    if len(data) < 12:
+        return None
+    if data[0:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise BatchInputError('not a RIFF/WAVE file')
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id = bytes(data[offset:offset + 4])
+        size = struct.unpack_from('<I', data, offset + 4)[0]
+        if chunk_id == b'data':
+            if fmt is None:
+                raise BatchInputError('WAV data chunk before its fmt chunk')
+            # Streamed WAVs leave the data size 0 or 0xFFFFFFFF: read to the end of the body then
+            return dict(fmt, data_offset=offset + 8, data_bytes=size if 0 < size < 0xFFFFFFFF else None)
+        if chunk_id == b'fmt ':
+            if offset + 8 + 16 > len(data):
+                return None
+            tag, channels, sample_rate = struct.unpack_from('<HHI', data, offset + 8)
+            bits = struct.unpack_from('<H', data, offset + 22)[0]
+            encoding = WAV_FORMATS.get(tag)
+            if encoding is None or bits != (16 if encoding == 'pcm16' else 8):
+                raise BatchInputError(f"unsupported WAV format {tag} with {bits}-bit samples "
+                                 f"(16-bit PCM, 8-bit mu-law or A-law)")
+            fmt = {'encoding': encoding, 'channels': channels, 'sample_rate': sample_rate}
+        offset += 8 + size + (size & 1)
+    if len(data) > MAX_WAV_HEADER_BYTES:
+        raise BatchInputError('no WAV data chunk in the first 64 KB')
+    return None
+
+
+def body_decoder(fmt):
+    if fmt['encoding'] not in codec.INPUT_ENCODINGS or fmt['encoding'] == 'opus':
+        raise BatchInputError(f"unsupported encoding {fmt['encoding']} (pcm16, mulaw or alaw)")
+    if fmt['sample_rate'] not in codec.INPUT_SAMPLE_RATES:
+        rates = ', '.join(map(str, codec.INPUT_SAMPLE_RATES))
+        raise BatchInputError(f"unsupported sample rate {fmt['sample_rate']} ({rates} Hz)")
+    if fmt['channels'] not in (1, 2):
+        raise BatchInputError(f"unsupported channel count {fmt['channels']}")
+    try:
+        return codec.InputDecoder(fmt['encoding'], fmt['sample_rate'], SAMPLE_RATE, fmt['channels'])
+    except ValueError as err:
+        raise BatchInputError(str(err)) from None
+
+
+def decode_body(decoder, data):
+    try:
+        return decoder.decode_bytes(data)
+    except ValueError as err:
+        raise BatchInputError(f"undecodable {decoder.encoding} audio: {err}") from None
+
+
+def raw_format(params):
+    try:
+        return {'encoding': params.get('encoding', 'pcm16'), 'sample_rate': int(params.get('sample_rate', SAMPLE_RATE)),
+                'channels': int(params.get('channels', 1)), 'data_offset': 0, 'data_bytes': None}
+    except ValueError as err:
+        raise BatchInputError(f"bad raw audio format: {err}") from None
+
+
+def to_ms(samples):
+    return round(samples * 1000 / SAMPLE_RATE)
+
+
+async def transcribe_segment(stt, segment, options):
+    result = {'index': segment['index'], 'start_ms': to_ms(segment['start']),
+              'end_ms': to_ms(segment['start'] + len(segment['samples'])), 'text': ''}
+    if segment['speech_ms'] < options['min_speech_ms']:
+        return dict(result, skipped=True)
+    started_at = time.perf_counter()
+    try:
+        stt_result = await stt(pcm.build_wav_bytes(segment['samples']), hedge=options['hedge'])
+        offset = segment['start'] / SAMPLE_RATE
+        result['text'] = (stt_result.get('text') or '').strip()
+        if isinstance(stt_result.get('words'), list):
+            result['words'] = [{'word': w['word'], 'start': round(w['start'] + offset, 3),
+                                'end': round(w['end'] + offset, 3)} for w in stt_result['words']]
+    except Exception as err:  # every failure of the STT call is reported on its segment
+        result['error'] = str(err)
+        if is_overload(err):
+            result['overloaded'] = True
+    result['stt_ms'] = round((time.perf_counter() - started_at) * 1000)
+    return result
+
+
+async def transcribe_body(chunks, params, stt):
+    """(status, reply) for a POST /transcribe body; chunks is an async iterator of bytes and
+    stt(wav_bytes, hedge) an async STT call (the stand-in's FakeStt, behind its AI scheduler)."""
+    options = batch_options(params)
+    segmenter = SilenceSegmenter(**options)
+    limit = asyncio.Semaphore(options['concurrency'])
+    results = {}
+    in_flight = set()
+    active = 0
+    max_active = 0
+    started_at = time.perf_counter()
+    decoder = None
+    head = b''
+    carry = b''
+    remaining = None
+
+    async def run(segment):
+        nonlocal active, max_active
+        async with limit:
+            active += 1
+            max_active = max(max_active, active)
+            try:
+                results[segment['index']] = await transcribe_segment(stt, segment, options)
+            finally:
+                active -= 1
+
+    def submit(segments):
+        for segment in segments:
+            task = asyncio.ensure_future(run(segment))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+    try:
+        async for data in chunks:
+            if decoder is None:
+                head += data
+                if len(head) < 4:
+                    continue
+                fmt = parse_wav_header(head) if head[:4] == b'RIFF' else raw_format(params)
+                if fmt is None:
+                    continue
+                decoder = body_decoder(fmt)
+                data = head[fmt['data_offset']:]
+                remaining = fmt['data_bytes']
+                head = b''
+            # Chunks after the WAV data chunk (LIST metadata) are not audio
+            if remaining is not None:
+                data = data[:remaining]
+                remaining -= len(data)
+            data = carry + data
+            whole = len(data) - len(data) % decoder.bytes_per_sample
+            carry = data[whole:]
+            submit(segmenter.push(decode_body(decoder, data[:whole])))
+            # Backpressure: stop reading while the model is behind
+            while len(in_flight) >= 2 * options['concurrency']:
+                await asyncio.wait(set(in_flight), return_when=asyncio.FIRST_COMPLETED)
+    except Exception as err:
+        if in_flight:
+            await asyncio.wait(set(in_flight))
+        return (400 if isinstance(err, BatchInputError) else 503 if is_overload(err) else 500), {'error': str(err)}
+    if decoder is None:
+        return 400, {'error': 'body too short for audio'}
+    submit(segmenter.flush())
+    if in_flight:
+        await asyncio.wait(set(in_flight))
+
+    segments = [results[i] for i in sorted(results)]
+    transcribed = [r for r in segments if not r.get('skipped') and not r.get('error')]
+    failed = sum(1 for r in segments if r.get('error'))
+    reply = {
+        'text': ' '.join(r['text'] for r in transcribed if r['text']),
+        'duration_ms': to_ms(segmenter.start),
+        'segments': segments,
+        'stats': {
+            'segments': len(segments),
+            'transcribed': len(transcribed),
+            'skipped': sum(1 for r in segments if r.get('skipped')),
+            'failed': failed,
+            'concurrency': options['concurrency'],
+            'max_in_flight': max_active,
+            'stt_ms': sum(r.get('stt_ms', 0) for r in segments),
+            'elapsed_ms': round((time.perf_counter() - started_at) * 1000),
+        },
+    }
+    # Partial results are still worth having; only a recording with no segment transcribed is an error
+    status = 200
+    if failed and not transcribed:
+        status = 503 if all(r.get('overloaded') for r in segments if r.get('error')) else 502
+    return status, reply
+
+
+# -- offline preview ----------------------------------------------------------
+
+def preview(samples, **options):
+    """The segments SilenceSegmenter cuts from 16 kHz samples, without their audio."""
+    segmenter = SilenceSegmenter(**options)
+    segments = []
+    for start in range(0, len(samples), SAMPLE_RATE):
+        segments += segmenter.push(samples[start:start + SAMPLE_RATE])
+    segments += segmenter.flush()
+    return [{'index': s['index'], 'start_ms': to_ms(s['start']), 'end_ms': to_ms(s['start'] + len(s['samples'])),
+             'speech_ms': s['speech_ms']} for s in segments]
+
+
+# -- client -------------------------------------------------------------------
+
+def transcribe_url(base_url, options):
+    """POST /transcribe URL with the segmentation options as query params."""
+    url = endpoints.http_url(base_url).rstrip('/') + '/transcribe'
+    return endpoints.with_params(url, options) if options else url
+
+
+def post_file(url, path, timeout_s=600):
+    """Stream a file to POST /transcribe; returns (status, reply dict, seconds)."""
+    parts = urlsplit(url)
+    if parts.scheme == 'https':
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        conn = http.client.HTTPSConnection(parts.netloc, timeout=timeout_s, context=context,
+                                           blocksize=UPLOAD_BLOCK_BYTES)
+    else:
+        conn = http.client.HTTPConnection(parts.netloc, timeout=timeout_s, blocksize=UPLOAD_BLOCK_BYTES)
+    started = time.monotonic()
+    try:
+        with open(path, 'rb') as body:
+            conn.request('POST', parts.path + ('?' + parts.query if parts.query else ''), body=body,
+                         headers={'Content-Type': 'audio/wav', 'Content-Length': str(os.path.getsize(path))},
+                         encode_chunked=False)
+            response = conn.getresponse()
+            raw = response.read()
+    finally:
+        conn.close()
+    try:
+        reply = json.loads(raw)
+    except ValueError:
+        reply = {'error': raw.decode('utf-8', 'replace')[:300]}
+    return response.status, reply, time.monotonic() - started
+
+
+def print_reply(path, status, reply, seconds):
+    if 'segments' not in reply:
+        print(f"{path}: HTTP {status} {reply.get('error', '')}")
+        return
+    stats = reply['stats']
+    print(f"{path}:{'' if status == 200 else f' HTTP {status},'} {reply['duration_ms'] / 1000:.1f}s of audio in {seconds:.1f}s, {stats['segments']} segments "
+          f"({stats['transcribed']} transcribed, {stats['skipped']} silent, {stats['failed']} failed, "
+          f"up to {stats['max_in_flight']} at once, {stats['stt_ms']} ms STT)")
+    for seg in reply['segments']:
+        note = ' [silence]' if seg.get('skipped') else f" [error: {seg['error']}]" if seg.get('error') else ''
+        print(f"  {seg['start_ms'] / 1000:7.2f}-{seg['end_ms'] / 1000:7.2f}s{note} {seg['text']}")
+    print(f"  text: {reply['text']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    seg = sub.add_parser('segments', help='preview the silence cuts of a WAV offline')
+    up = sub.add_parser('transcribe', help='upload WAV files to POST /transcribe')
+    for p in (seg, up):
+        p.add_argument('--max-segment-ms', type=int, default=BATCH_DEFAULTS['max_segment_ms'])
+        p.add_argument('--min-silence-ms', type=int, default=BATCH_DEFAULTS['min_silence_ms'])
+        p.add_argument('--silence-db', type=int, default=BATCH_DEFAULTS['silence_db'])
+    seg.add_argument('file')
+    up.add_argument('files', nargs='+')
+    up.add_argument('--url', '-u', default=endpoints.worker_url(),
+                    help='worker URL (ws(s):// or http(s)://; the stand-in answers on its --http-port)')
+    up.add_argument('--concurrency', type=int, default=BATCH_DEFAULTS['concurrency'],
+                    help='segments transcribed at once per file (worker side, 1-10)')
+    up.add_argument('--files', type=int, default=1, dest='parallel_files', help='files uploaded at once')
+    up.add_argument('--hedge', action='store_true', help="resend segments still unanswered after Whisper's p95 latency")
+    up.add_argument('--json', help='write every reply here')
+    args = parser.parse_args()
+
+    options = {'max_segment_ms': args.max_segment_ms, 'min_silence_ms': args.min_silence_ms,
+               'silence_db': args.silence_db}
+    if args.command == 'segments':
+        samples, sr = pcm.read_wav(args.file, mix=True)
+        if sr != SAMPLE_RATE:
+            samples = codec.PolyphaseResampler(sr, SAMPLE_RATE).process(samples)
+        segments = preview(array.array('h', samples), **options)
+        for s in segments:
+            print(f"{s['index']:3d} {s['start_ms'] / 1000:8.2f}-{s['end_ms'] / 1000:8.2f}s "
+                  f"({(s['end_ms'] - s['start_ms']) / 1000:5.2f}s, {s['speech_ms']} ms above {args.silence_db} dBFS)")
+        print(f"{len(segments)} segments")
+        return
+
+    url = transcribe_url(args.url, dict(options, concurrency=args.concurrency, **({'hedge': 1} if args.hedge else {})))
+    replies = []  # (path, status, reply) in completion order
+    started = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.parallel_files)) as pool:
+        futures = {pool.submit(post_file, url, path): path for path in args.files}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                status, reply, seconds = future.result()
+            except OSError as err:
+                print(f"{path}: {err}")
+                continue
+            replies.append((path, status, reply))
+            print_reply(path, status, reply, seconds)
+    print(f"{len(replies)}/{len(args.files)} files in {time.monotonic() - started:.1f}s")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([dict(reply, file=path, status=status) for path, status, reply in replies], f, indent=2)
+    if len(replies) < len(args.files) or any(status != 200 for _, status, _ in replies):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
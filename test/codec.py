@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+G.711 (mu-law / A-law) codecs and a streaming polyphase resampler, mirroring
+src/codec.js (same decode tables, same filter design), plus Opus through
+opuslib when it is installed.
+
+The clients encode with it when a session declares input_encoding=mulaw/alaw;
+the stand-in (local_worker.py) decodes and resamples to 16 kHz with it like
+the worker does. Encoding is a lookup in a 64K-entry table built once.
+
+Opus needs opuslib and the libopus shared library (pip install opuslib;
+apt install libopus0). Without them opus_available() is False: clients fall
+back to pcm16 and the stand-in refuses Opus like a worker whose decoder
+cannot load. There is no pure-Python Opus codec.
+
+Usage as a script (encode a WAV file and report sizes and round-trip error):
+  python3 codec.py ../samples/OSR_us_000_0011_8k.wav [--encoding mulaw] [--rate 16000]
+"""
+
+import array
+import math
+
+import pcm
+
+try:
+    import opuslib
+except Exception:  # ImportError, or opuslib's own error when libopus is missing
+    opuslib = None
+
+INPUT_ENCODINGS = ('pcm16', 'mulaw', 'alaw', 'opus')
+INPUT_SAMPLE_RATES = (8000, 16000, 24000, 48000)
+
+RESAMPLER_ZERO_CROSSINGS = 8  # sinc lobes each side of the centre tap
+RESAMPLER_CUTOFF = 0.9        # fraction of the lower Nyquist frequency kept
+
+OPUS_FRAME_MS = 20
+OPUS_BITRATE = 24000
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+
+MULAW_BIAS = 0x84
+MULAW_CLIP = 32635
+
+
+def mulaw_to_linear(byte):
+    u = ~byte & 0xFF
+    exponent = (u >> 4) & 0x07
+    sample = ((((u & 0x0F) << 3) + MULAW_BIAS) << exponent) - MULAW_BIAS
+    return -sample if u & 0x80 else sample
+
+
+def alaw_to_linear(byte):
+    a = byte ^ 0x55
+    exponent = (a >> 4) & 0x07
+    mantissa = a & 0x0F
+    sample = (mantissa << 4) + 8 if exponent == 0 else ((mantissa << 4) + 0x108) << (exponent - 1)
+    return sample if a & 0x80 else -sample
+
+
+def linear_to_mulaw(sample):
+    sign = 0x80 if sample < 0 else 0
+    magnitude = min(-sample if sample < 0 else sample, MULAW_CLIP) + MULAW_BIAS
+    exponent = min(7, (magnitude >> 7).bit_length() - 1)
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    return ~(sign | (exponent << 4) | mantissa) & 0xFF
+
+
+def linear_to_alaw(sample):
+    sign = 0x80 if sample >= 0 else 0
+    magnitude = min(sample if sample >= 0 else -sample - 1, 32767)
+    if magnitude >= 256:
+        exponent = min(7, (magnitude >> 8).bit_length())
+        mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    else:
+        exponent = 0
+        mantissa = magnitude >> 4
+    return (sign | (exponent << 4) | mantissa) ^ 0x55
+
+
+MULAW_TABLE = array.array('h', (mulaw_to_linear(b) for b in range(256)))
+ALAW_TABLE = array.array('h', (alaw_to_linear(b) for b in range(256)))
+DECODE_TABLES = {'mulaw': MULAW_TABLE, 'alaw': ALAW_TABLE}
+
+_encode_tables = {}
+
+
+def _encode_table(encoding):
+    """Byte for every int16 value, indexed by sample + 32768 (built on first use)."""
+    if encoding not in _encode_tables:
+        encode = {'mulaw': linear_to_mulaw, 'alaw': linear_to_alaw}[encoding]
+        _encode_tables[encoding] = bytes(encode(s) for s in range(-32768, 32768))
+    return _encode_tables[encoding]
+
+
+def encode(samples, encoding):
+    """Wire bytes for int16 samples: G.711 bytes, or little-endian PCM16."""
+    if encoding == 'pcm16':
+        return pcm.pcm_bytes(samples)
+    if encoding == 'opus':
+        raise ValueError('Opus is stateful: encode with OpusEncoder')
+    table = _encode_table(encoding)
+    return bytes(table[s + 32768] for s in samples)
+
+
+def decode(data, encoding):
+    """int16 samples (array('h')) from wire bytes in the given encoding."""
+    if encoding == 'pcm16':
+        return array.array('h', pcm.samples_from_bytes(bytes(data)))
+    table = DECODE_TABLES[encoding]
+    return array.array('h', (table[b] for b in data))
+
+
+def _design_phases(up, taps, cutoff):
+    """Same windowed-sinc (Blackman) low-pass as designPhases in src/codec.js."""
+    length = up * taps
+    centre = (length - 1) / 2
+    phases = [[0.0] * taps for _ in range(up)]
+    for i in range(length):
+        x = i - centre
+        sinc = 2 * cutoff if x == 0 else math.sin(2 * math.pi * cutoff * x) / (math.pi * x)
+        w = (0.42 - 0.5 * math.cos(2 * math.pi * i / (length - 1))
+             + 0.08 * math.cos(4 * math.pi * i / (length - 1)))
+        phases[i % up][i // up] = sinc * w * up
+    return phases
+
+
+class PolyphaseResampler:
+    """Streaming rational-ratio resampler; process() keeps state across chunks."""
+
+    def __init__(self, in_rate, out_rate):
+        g = math.gcd(in_rate, out_rate)
+        self.up = out_rate // g
+        self.down = in_rate // g
+        self.passthrough = self.up == 1 and self.down == 1
+        span = max(self.up, self.down)
+        self.taps = 2 * RESAMPLER_ZERO_CROSSINGS * span // self.up
+        self.phases = _design_phases(self.up, self.taps, RESAMPLER_CUTOFF * 0.5 / span)
+        self.history = [0.0] * (self.taps - 1)
+        self.pos = (self.taps - 1) * self.up
+
+    def process(self, samples):
+        if self.passthrough:
+            return samples
+        up, down, taps, phases = self.up, self.down, self.taps, self.phases
+        keep = taps - 1
+        buf = self.history + list(samples)
+        limit = len(buf) * up
+        out = array.array('h')
+        pos = self.pos
+        while pos < limit:
+            base = pos // up
+            h = phases[pos - base * up]
+            acc = sum(h[k] * buf[base - k] for k in range(taps))
+            out.append(max(-32768, min(32767, math.floor(acc + 0.5))))
+            pos += down
+        self.history = buf[len(buf) - keep:]
+        self.pos = pos - (len(buf) - keep) * up
+        return out
+
+
+class InputDecoder:
+    """Per-session decoder from a declared input format to int16 samples at out_rate.
+
+    channels > 1 (POST /transcribe WAV uploads) is downmixed; bytes_per_sample
+    then counts one sample of each channel.
+    """
+
+    def __init__(self, encoding, sample_rate, out_rate=pcm.SAMPLE_RATE, channels=1):
+        self.encoding = encoding
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bytes_per_sample = (2 if encoding == 'pcm16' else 1) * channels
+        self.resampler = PolyphaseResampler(sample_rate, out_rate)
+
+    def decode_bytes(self, data):
+        samples = decode(data, self.encoding)
+        if self.channels > 1:
+            samples = array.array('h', pcm.downmix(samples, self.channels))
+        return self.resampler.process(samples)
+
+    def decode_values(self, values):
+        """JSON audio_chunk values: int16 samples, or G.711 byte values."""
+        if self.encoding == 'pcm16':
+            samples = array.array('h', (((int(v) + 32768) & 0xFFFF) - 32768 for v in values))
+        else:
+            table = DECODE_TABLES[self.encoding]
+            samples = array.array('h', (table[int(v) & 0xFF] for v in values))
+        return self.resampler.process(samples)
+
+
+def opus_available():
+    return opuslib is not None
+
+
+class OpusEncoder:
+    """Mono Opus encoder for 0x03 frames: one packet per 20 ms of input.
+
+    Chunks should be a whole number of frames; a trailing partial frame is
+    padded with silence (fine for the last chunk of a stream).
+    """
+
+    def __init__(self, sample_rate=pcm.SAMPLE_RATE, bitrate=OPUS_BITRATE):
+        if opuslib is None:
+            raise RuntimeError('Opus encoding needs opuslib and libopus')
+        if sample_rate not in OPUS_SAMPLE_RATES:
+            raise ValueError(f"Opus does not support {sample_rate} Hz")
+        self.frame_samples = sample_rate * OPUS_FRAME_MS // 1000
+        self._encoder = opuslib.Encoder(sample_rate, 1, opuslib.APPLICATION_VOIP)
+        self._encoder.bitrate = bitrate
+
+    def encode(self, samples):
+        """List of Opus packets (bytes) for a chunk of int16 samples."""
+        packets = []
+        for pos in range(0, len(samples), self.frame_samples):
+            frame = pcm.pcm_bytes(samples[pos:pos + self.frame_samples])
+            frame += bytes(self.frame_samples * 2 - len(frame))
+            packets.append(self._encoder.encode(frame, self.frame_samples))
+        return packets
+
+
+class OpusInputDecoder:
+    """Stand-in counterpart of OpusInputDecoder in src/codec.js (decodes straight to out_rate)."""
+
+    encoding = 'opus'
+    bytes_per_sample = 0
+
+    def __init__(self, out_rate=pcm.SAMPLE_RATE):
+        if opuslib is None:
+            raise RuntimeError('opuslib (and libopus) not installed')
+        self.out_rate = out_rate
+        self._decoder = opuslib.Decoder(out_rate, 1)
+        self._max_samples = out_rate * 120 // 1000  # longest Opus packet
+
+    def decode_packets(self, packets):
+        samples = array.array('h')
+        for packet in packets:
+            samples.extend(pcm.samples_from_bytes(self._decoder.decode(bytes(packet), self._max_samples)))
+        return samples
+
+    def decode_bytes(self, data):
+        raise ValueError('Opus sessions send audio in 0x03 frames')
+
+    decode_values = decode_bytes
+
+
+def main():
+    import argparse
+    import time
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', help='Path to WAV file (16-bit PCM)')
+    parser.add_argument('--encoding', choices=INPUT_ENCODINGS, default='mulaw')
+    parser.add_argument('--rate', type=int, default=pcm.SAMPLE_RATE, help='resample the decoded audio to this rate')
+    args = parser.parse_args()
+
+    samples, sr = pcm.read_wav(args.file)
+    start = time.perf_counter()
+    wire = encode(samples, args.encoding)
+    decoded = decode(wire, args.encoding)
+    coded = time.perf_counter()
+    resampled = PolyphaseResampler(sr, args.rate).process(decoded)
+    done = time.perf_counter()
+    err = math.sqrt(sum((a - b) ** 2 for a, b in zip(samples, decoded)) / max(1, len(samples)))
+    print(f"{len(samples)} samples at {sr} Hz: {len(wire)} {args.encoding} bytes "
+          f"({len(wire) / max(1, 2 * len(samples)):.2f}x PCM16), round-trip RMS error {err:.1f}, "
+          f"codec {(coded - start) * 1000:.1f} ms")
+    print(f"resampled to {args.rate} Hz: {len(resampled)} samples in {(done - coded) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -6,19 +6,16 @@ Test with correct field names
 import asyncio
 import websockets
 import json
-import ssl
 import base64
 
+import endpoints
+
 async def test_correct_format():
-    ssl_context = ssl.create_default_context()
-    ssl_context.check_hostname = False
-    ssl_context.verify_mode = ssl.CERT_NONE
-    
-    websocket_url = "wss://solitary-boat-0723.timtimtim001021.workers.dev"
+    websocket_url = endpoints.worker_url()
     
     try:
         print("🔗 Connecting to:", websocket_url)
-        async with websockets.connect(websocket_url, ssl=ssl_context) as websocket:
+        async with websockets.connect(websocket_url, ssl=endpoints.ssl_context_for(websocket_url)) as websocket:
             print("✅ Connected successfully!")
             
             # Generate some fake audio samples (array of numbers)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Where the test clients connect.
+
+Every client defaults to the deployed worker; set WORKER_WS_URL (or pass
+--url where a script supports it) to target another deployment or the local
+stand-in server (python3 local_worker.py -> ws://127.0.0.1:8787).
+"""
+
+import os
+import ssl
+from urllib.parse import urlencode
+
+DEFAULT_URL = "wss://solitary-boat-0723.timtimtim001021.workers.dev"
+
+
+def worker_url(default=DEFAULT_URL):
+    return os.environ.get('WORKER_WS_URL', default)
+
+
+def http_url(ws_url):
+    """HTTP(S) base URL for the same worker (for /health and POST endpoints)."""
+    if ws_url.startswith('wss://'):
+        return 'https://' + ws_url[len('wss://'):]
+    if ws_url.startswith('ws://'):
+        return 'http://' + ws_url[len('ws://'):]
+    return ws_url
+
+
+def with_params(url, params):
+    """url with params appended to its query string (session options, e.g. {'timings': 1})."""
+    return url + ('&' if '?' in url else '?') + urlencode(params)
+
+
+def ssl_context_for(url):
+    """Unverified TLS context for wss:// URLs (matches the existing scripts); None for ws://."""
+    if not url.startswith('wss://'):
+        return None
+    ssl_context = ssl.create_default_context()
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Wire framing shared by the test clients (mirrors src/session.js).
+
+Binary audio frame (client -> worker):
+  byte 0      0x01
+  bytes 1-2   uint16 LE sample count
+  bytes 3..   samples in the session's input encoding: Int16 LE (pcm16),
+              or one byte each for G.711 (mulaw / alaw)
+
+Sequenced audio frame (client -> worker), placed by offset and resumable:
+  byte 0      0x05
+  byte 1      version (1)
+  bytes 2-5   uint32 LE seq (frames since the start of the call)
+  bytes 6-9   uint32 LE offset of the first sample, in input-rate samples since the start of the call
+  bytes 10-11 uint16 LE sample count
+  bytes 12..  samples in the session's input encoding (not Opus)
+
+Bulk audio frame (client -> worker), a whole recording in one message:
+  byte 0      0x06
+  byte 1      flags (0x01 = end the turn after this audio, as end_stream)
+  bytes 2-5   uint32 LE sample count
+  bytes 6..   samples in the session's input encoding (not Opus); the even
+              header keeps PCM16 aligned, so the worker reads it in place
+
+Opus audio frame (client -> worker, sessions with input_encoding "opus"):
+  byte 0      0x03
+  byte 1      uint8 packet count
+  then per packet: uint16 LE length, Opus packet bytes (20 ms each from codec.OpusEncoder)
+
+Response audio frame (worker -> client), between response_audio_start and
+response_audio_end JSON messages:
+  byte 0      0x02
+  byte 1      flags (0x01 = final frame of the response)
+  bytes 2-5   uint32 LE sequence number (0-based per response)
+  bytes 6..   TTS audio bytes (encoding given by response_audio_start)
+A response cut short by barge-in ends with response_audio_end
+{"interrupted": true} and no final-flagged frame.
+
+Chunk ack frame (worker -> client, sessions with ack_binary, for binary frames):
+  byte 0      0x04
+  bytes 1-4   uint32 LE seq: audio chunks received on this connection
+  bytes 5-6   uint16 LE chunks acknowledged by this ack
+  bytes 7-10  uint32 LE buffered 16 kHz samples
+The JSON chunk_received carries the same seq / chunks (plus chunk_size, the
+samples those chunks held); the session's ack policy decides how often either
+is sent (see ACK_POLICIES).
+
+The legacy JSON transport sends {"type": "audio_chunk", "audio": [...]} with
+every sample as decimal text (G.711 byte values for mulaw / alaw sessions).
+The input encoding and rate are declared per session (input_encoding,
+input_sample_rate); see codec.py.
+"""
+
+import json
+import os
+import struct
+
+import codec
+import pcm
+
+FRAME_AUDIO = 0x01
+FRAME_RESPONSE_AUDIO = 0x02
+FRAME_OPUS = 0x03
+FRAME_ACK = 0x04
+FRAME_SEQ_AUDIO = 0x05
+FRAME_BULK_AUDIO = 0x06
+SEQ_AUDIO_VERSION = 1
+BULK_AUDIO_FLAG_END = 0x01
+MAX_OPUS_PACKETS = 0xFF
+RESPONSE_AUDIO_FLAG_FINAL = 0x01
+MAX_FRAME_SAMPLES = 0xFFFF
+
+TRANSPORTS = ('binary', 'json')
+ACK_POLICIES = ('chunk', 'count', 'interval', 'none')
+
+_AUDIO_HEADER = struct.Struct('<BH')
+_RESPONSE_AUDIO_HEADER = struct.Struct('<BBI')
+_ACK = struct.Struct('<BIHI')
+_SEQ_AUDIO_HEADER = struct.Struct('<BBIIH')
+_BULK_AUDIO_HEADER = struct.Struct('<BBI')
+
+
+def audio_frame(samples, encoding='pcm16'):
+    """Encode a chunk of int16 samples as a binary audio frame in the given input encoding."""
+    if len(samples) > MAX_FRAME_SAMPLES:
+        raise ValueError(f"binary frame holds at most {MAX_FRAME_SAMPLES} samples, got {len(samples)}")
+    return _AUDIO_HEADER.pack(FRAME_AUDIO, len(samples)) + codec.encode(samples, encoding)
+
+
+def sequenced_audio_frame(seq, offset, samples, encoding='pcm16'):
+    """A 0x05 frame: samples placed at `offset` (input-rate samples since the start of the call)."""
+    if len(samples) > MAX_FRAME_SAMPLES:
+        raise ValueError(f"binary frame holds at most {MAX_FRAME_SAMPLES} samples, got {len(samples)}")
+    return _SEQ_AUDIO_HEADER.pack(FRAME_SEQ_AUDIO, SEQ_AUDIO_VERSION, seq, offset, len(samples)) + \
+        codec.encode(samples, encoding)
+
+
+def parse_sequenced_audio_frame(data):
+    """(version, seq, offset, sample count, payload memoryview) of a 0x05 frame."""
+    if len(data) < _SEQ_AUDIO_HEADER.size or data[0] != FRAME_SEQ_AUDIO:
+        raise ValueError("not a sequenced audio frame")
+    _, version, seq, offset, count = _SEQ_AUDIO_HEADER.unpack_from(data)
+    return version, seq, offset, count, memoryview(data)[_SEQ_AUDIO_HEADER.size:]
+
+
+def bulk_audio_frame(samples, encoding='pcm16', end=False):
+    """A 0x06 frame with every sample of a recording; end=True ends the turn (no end_stream needed)."""
+    flags = BULK_AUDIO_FLAG_END if end else 0
+    return _BULK_AUDIO_HEADER.pack(FRAME_BULK_AUDIO, flags, len(samples)) + codec.encode(samples, encoding)
+
+
+def parse_bulk_audio_frame(data):
+    """(flags, sample count, payload memoryview) of a 0x06 frame."""
+    if len(data) < _BULK_AUDIO_HEADER.size or data[0] != FRAME_BULK_AUDIO:
+        raise ValueError("not a bulk audio frame")
+    _, flags, count = _BULK_AUDIO_HEADER.unpack_from(data)
+    return flags, count, memoryview(data)[_BULK_AUDIO_HEADER.size:]
+
+
+def audio_chunk_json(samples, session_id=None, encoding='pcm16'):
+    """Encode a chunk of int16 samples as a legacy JSON audio_chunk message."""
+    audio = pcm.to_list(samples) if encoding == 'pcm16' else list(codec.encode(samples, encoding))
+    msg = {"type": "audio_chunk", "audio": audio}
+    if session_id is not None:
+        msg["session_id"] = session_id
+    return json.dumps(msg)
+
+
+def opus_frame(packets):
+    """Batch Opus packets into one 0x03 frame."""
+    if not 0 < len(packets) <= MAX_OPUS_PACKETS:
+        raise ValueError(f"opus frame holds 1-{MAX_OPUS_PACKETS} packets, got {len(packets)}")
+    parts = [bytes((FRAME_OPUS, len(packets)))]
+    for packet in packets:
+        parts.append(struct.pack('<H', len(packet)))
+        parts.append(bytes(packet))
+    return b''.join(parts)
+
+
+def parse_opus_frame(data):
+    """Opus packets of a 0x03 frame (memoryviews into data)."""
+    if len(data) < 2 or data[0] != FRAME_OPUS:
+        raise ValueError("not an opus frame")
+    view = memoryview(data)
+    packets = []
+    offset = 2
+    for _ in range(data[1]):
+        if offset + 2 > len(data):
+            raise ValueError("opus frame too short")
+        length = struct.unpack_from('<H', data, offset)[0]
+        offset += 2
+        if length == 0 or offset + length > len(data):
+            raise ValueError("opus frame too short")
+        packets.append(view[offset:offset + length])
+        offset += length
+    return packets
+
+
+def encode_chunk(samples, transport, session_id=None, encoding='pcm16'):
+    if transport == 'binary':
+        return audio_frame(samples, encoding)
+    if transport == 'json':
+        return audio_chunk_json(samples, session_id, encoding)
+    raise ValueError(f"Unknown transport: {transport}")
+
+
+def ack_frame(seq, chunks, buffer_size):
+    return _ACK.pack(FRAME_ACK, seq, min(chunks, 0xFFFF), buffer_size)
+
+
+def parse_ack_frame(data):
+    """A 0x04 frame as the equivalent chunk_received message."""
+    _, seq, chunks, buffer_size = _ACK.unpack_from(data)
+    return {'type': 'chunk_received', 'seq': seq, 'chunks': chunks, 'buffer_size': buffer_size, 'binary': True}
+
+
+def parse_response_audio_frame(data):
+    """Decode a 0x02 frame into (seq, final, payload); payload is a zero-copy memoryview."""
+    if len(data) < _RESPONSE_AUDIO_HEADER.size or data[0] != FRAME_RESPONSE_AUDIO:
+        raise ValueError("not a response audio frame")
+    _, flags, seq = _RESPONSE_AUDIO_HEADER.unpack_from(data)
+    return seq, bool(flags & RESPONSE_AUDIO_FLAG_FINAL), memoryview(data)[_RESPONSE_AUDIO_HEADER.size:]
+
+
+class ResponseAudioReceiver:
+    """Reassemble streamed TTS responses into files as frames arrive.
+
+    linear16 responses are written to a WAV that is playable while still
+    streaming; other encodings (mp3, ogg, wav) are written as-is.
+    Feed it every message: handle() returns True for the messages it consumed.
+    """
+
+    EXTENSIONS = {'linear16': 'wav', 'wav': 'wav', 'mp3': 'mp3', 'ogg': 'ogg'}
+
+    def __init__(self, out_dir='.', prefix='response'):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.current = None
+        self.writer = None
+        self.expected_seq = 0
+        self.completed = []  # (path, bytes) per finished response
+        self.interrupted = []  # paths of responses cut short by barge-in
+
+    def handle(self, message):
+        if isinstance(message, (bytes, bytearray, memoryview)):
+            if len(message) and message[0] == FRAME_RESPONSE_AUDIO:
+                self._frame(message)
+                return True
+            return False
+        data = json.loads(message) if isinstance(message, str) else message
+        if data.get('type') == 'response_audio_start':
+            self._start(data)
+            return True
+        if data.get('type') == 'response_audio_end':
+            self._finish(data)
+            return True
+        return False
+
+    def _start(self, data):
+        self._close()
+        encoding = data.get('encoding', 'linear16')
+        ext = self.EXTENSIONS.get(encoding, 'bin')
+        path = os.path.join(self.out_dir, f"{self.prefix}_{data.get('response_id', len(self.completed) + 1)}.{ext}")
+        if encoding == 'linear16':
+            self.writer = pcm.WavStreamWriter(path, data.get('sample_rate', 24000), data.get('channels', 1))
+        else:
+            self.writer = open(path, 'wb')
+        self.current = {'path': path, 'bytes': 0, 'encoding': encoding}
+        self.expected_seq = 0
+
+    def _frame(self, message):
+        seq, final, payload = parse_response_audio_frame(message)
+        if self.writer is None:
+            raise RuntimeError("response audio frame before response_audio_start")
+        if seq != self.expected_seq:
+            raise RuntimeError(f"response audio frame out of order: got {seq}, expected {self.expected_seq}")
+        self.expected_seq += 1
+        self.writer.write(payload)
+        self.current['bytes'] += len(payload)
+        if final:
+            self.current['final'] = True
+
+    def _finish(self, data):
+        if self.current is not None and data.get('bytes') not in (None, self.current['bytes']):
+            print(f"Warning: response audio size mismatch ({self.current['bytes']} received, {data['bytes']} sent)")
+        if self.current is not None and data.get('interrupted'):
+            self.interrupted.append(self.current['path'])
+        self._close()
+
+    def _close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.completed.append((self.current['path'], self.current['bytes']))
+        self.writer = None
+        self.current = None
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Concurrent call load generator with latency percentiles.
+
+Replays simulated calls (WAV files or a synthetic tone) at real-time pacing.
+Concurrency ramps up to --concurrency, holds, then ramps back down; each
+active slot runs calls back to back. Every message is timestamped and the run
+ends with p50/p95/p99 for:
+  ack_rtt_ms          chunk sent -> its chunk_received (with --ack count/interval
+                      this includes the wait for the batch to be acknowledged)
+  transcription_ms    end_stream -> transcription (or transcription_final)
+  first_audio_ms      end_stream -> first response audio (start message, 0x02 frame or legacy array)
+plus throughput, printed as a table and written as JSON. With --timings the
+calls ask for the worker's per-turn marks (the `timings` session option) and
+the report adds where the server spent the time:
+  server_queue_ms          end_stream -> turn started
+  server_stt_ms            WAV built -> STT done
+  server_llm_ms            STT done -> first LLM token
+  server_tts_ms            first LLM token -> first TTS byte (first clause + synthesis)
+  server_first_audio_ms    end_stream -> response_audio_start sent
+--adaptive-chunks lets every call size its chunks from its own ack RTT and
+queue depth (stream_client.ChunkSizer); the report counts the resizes and the
+chunks sent at each duration.
+
+Usage:
+  python3 load_test.py --concurrency 20 --ramp-up-s 30 --hold-s 60 --ramp-down-s 30
+  python3 load_test.py --file a.wav --file b.wav --transport json --json results.json
+  python3 load_test.py --file ../samples/OSR_us_000_0011_8k.wav --encoding mulaw   # telephony-style calls
+  python3 load_test.py --concurrency 20 --timings   # p95 per server stage
+  python3 load_test.py --concurrency 20 --adaptive-chunks --latency-budget-ms 250
+  python3 load_test.py --concurrency 50 --ack count --ack-every 10   # a tenth of the acks
+  python3 local_worker.py --seed 1 &   # offline target
+  WORKER_WS_URL=ws://127.0.0.1:8787 python3 load_test.py --concurrency 50 --hold-s 20
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import sys
+import time
+import uuid
+
+import websockets
+
+import codec
+import endpoints
+import frames
+import pcm
+from stream_client import StreamingClient
+
+CHUNK_SAMPLES = 1600  # 100ms at 16kHz
+RESULT_TIMEOUT_S = 30.0
+# session_id joins the URL, so a run must not resume the calls of an earlier one
+RUN_ID = uuid.uuid4().hex[:8]
+METRICS = ('ack_rtt_ms', 'transcription_ms', 'first_audio_ms', 'call_ms')
+# name -> (from mark, to mark) in the worker's `timings` (src/metrics.js)
+SERVER_STAGES = {
+    'server_queue_ms': ('end_stream', 'turn_start'),
+    'server_stt_ms': ('wav_built', 'stt_done'),
+    'server_llm_ms': ('stt_done', 'llm_first_token'),
+    'server_tts_ms': ('llm_first_token', 'tts_first_byte'),
+    'server_first_audio_ms': ('end_stream', 'first_audio'),
+}
+
+
+def percentile(sorted_values, p):
+    """Linear-interpolated percentile of an already sorted list (None when empty)."""
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': values[-1] if values else None,
+    }
+
+
+class CallResult:
+    """Timestamps (time.monotonic seconds) of one simulated call."""
+
+    def __init__(self, call_id, clip):
+        self.call_id = call_id
+        self.clip = clip
+        self.started = None
+        self.transcription_at = None
+        self.first_audio_at = None
+        self.finished = None
+        self.client = None
+        self.error = None
+        self.timings = {}  # the latest `timings` the worker sent (--timings)
+
+    def on_message(self, message, received_at):
+        msg_type = message.get('type') if isinstance(message, dict) else 'response_audio_frame'
+        if msg_type != 'response_audio_frame' and message.get('timings'):
+            self.timings = message['timings']
+        if msg_type in ('transcription', 'transcription_final'):
+            self.transcription_at = self.transcription_at or received_at
+        elif msg_type in ('response_audio_start', 'response_audio', 'response_audio_frame'):
+            self.first_audio_at = self.first_audio_at or received_at
+        elif msg_type == 'error':
+            self.error = message.get('message')
+
+    def metrics(self):
+        ms = lambda a, b: (b - a) * 1000 if a is not None and b is not None else None
+        end_stream_at = self.client.end_stream_at if self.client else None
+        metrics = {
+            'ack_rtt_ms': [rtt * 1000 for rtt in self.client.ack_rtts] if self.client else [],
+            'transcription_ms': ms(end_stream_at, self.transcription_at),
+            'first_audio_ms': ms(end_stream_at, self.first_audio_at),
+            'call_ms': ms(self.started, self.finished),
+        }
+        for name, (start, end) in SERVER_STAGES.items():
+            if start in self.timings and end in self.timings:
+                metrics[name] = self.timings[end] - self.timings[start]
+        return metrics
+
+    def to_json(self, t0):
+        stats = self.client.stats() if self.client else {}
+        return {
+            'call_id': self.call_id,
+            'clip': self.clip,
+            'error': self.error,
+            'client': stats,
+            'events': [{'t_ms': round((t - t0) * 1000, 3), 'dir': d, 'kind': k, 'size': n}
+                       for t, d, k, n in (self.client.events if self.client else [])],
+        }
+
+
+async def run_call(call_id, args, clip, samples, sample_rate):
+    result = CallResult(call_id, clip)
+    result.started = time.monotonic()
+    url = args.url + ('&' if '?' in args.url else '?') + 'timings=1' if args.timings else args.url
+    client = StreamingClient(url, transport=args.transport, chunk_samples=args.chunk_samples,
+                             sample_rate=sample_rate, pace=args.pace, max_outstanding=args.max_outstanding,
+                             session_id=f"load-{RUN_ID}-{call_id}", record_events=True, encoding=args.encoding,
+                             adaptive_chunks=args.adaptive_chunks, min_chunk_ms=args.min_chunk_ms,
+                             max_chunk_ms=args.max_chunk_ms, latency_budget_ms=args.latency_budget_ms,
+                             ack=args.ack, ack_every=args.ack_every, ack_interval_ms=args.ack_interval_ms)
+    result.client = client
+    try:
+        async with client:
+            for msg_type in ('transcription', 'transcription_final', 'response_audio_start', 'response_audio',
+                             'response_audio_frame', 'response_audio_end', 'error'):
+                client.on(msg_type, result.on_message)
+            done = client.queue('response_audio_end', 'response_audio', 'transcription', 'error')
+            await client.stream(samples)
+            await client.end_stream()
+            deadline = time.monotonic() + RESULT_TIMEOUT_S
+            while True:
+                message, received_at = await asyncio.wait_for(done.get(), deadline - time.monotonic())
+                # A transcription ends the call only when no reply follows (empty text);
+                # errors from before end_stream are recorded but do not end it
+                if message['type'] == 'transcription' and message.get('text', '').strip():
+                    continue
+                if message['type'] == 'error' and received_at < client.end_stream_at:
+                    continue
+                break
+    except asyncio.TimeoutError:
+        result.error = 'timeout waiting for response'
+    except (OSError, RuntimeError, websockets.exceptions.WebSocketException) as err:
+        result.error = f"{type(err).__name__}: {err}"
+    result.finished = time.monotonic()
+    return result
+
+
+def target_concurrency(elapsed, peak, ramp_up_s, hold_s, ramp_down_s):
+    """Trapezoid profile: 0 -> peak over ramp_up_s, hold, peak -> 0 over ramp_down_s."""
+    if elapsed < ramp_up_s:
+        return max(1, round(peak * elapsed / ramp_up_s))
+    elapsed -= ramp_up_s
+    if elapsed < hold_s:
+        return peak
+    elapsed -= hold_s
+    if elapsed < ramp_down_s:
+        return max(1, round(peak * (1 - elapsed / ramp_down_s)))
+    return 0
+
+
+async def run_load(args, clips):
+    tasks = []
+    active = set()
+    started = 0
+    t0 = time.monotonic()
+    peak_active = 0
+
+    while True:
+        elapsed = time.monotonic() - t0
+        target = target_concurrency(elapsed, args.concurrency, args.ramp_up_s, args.hold_s, args.ramp_down_s)
+        if target == 0 or (args.max_calls and started >= args.max_calls):
+            break
+        while len(active) < target and not (args.max_calls and started >= args.max_calls):
+            clip, samples, sr = clips[started % len(clips)]
+            task = asyncio.ensure_future(run_call(started, args, clip, samples, sr))
+            task.add_done_callback(active.discard)
+            active.add(task)
+            tasks.append(task)
+            started += 1
+        peak_active = max(peak_active, len(active))
+        await asyncio.sleep(0.1)
+
+    results = await asyncio.gather(*tasks)
+    wall_s = time.monotonic() - t0
+    return results, wall_s, peak_active, t0
+
+
+def build_report(results, wall_s, peak_active, args):
+    names = METRICS + (tuple(SERVER_STAGES) if args.timings else ())
+    values = {name: [] for name in names}
+    for r in results:
+        m = r.metrics()
+        values['ack_rtt_ms'].extend(m['ack_rtt_ms'])
+        for name in names[1:]:
+            if m.get(name) is not None:
+                values[name].append(m[name])
+    errors = {}
+    for r in results:
+        if r.error:
+            errors[r.error] = errors.get(r.error, 0) + 1
+    stats = [r.client.stats() for r in results if r.client]
+    audio_s = sum(s.get('audio_s_sent', 0) for s in stats)
+    chunk_ms_used = collections.Counter()
+    for s in stats:
+        chunk_ms_used.update(s.get('chunk_ms_used', {}))
+    return {
+        'url': args.url,
+        'transport': args.transport,
+        'encoding': args.encoding,
+        'ack': args.ack or 'chunk',
+        'peak_concurrency': args.concurrency,
+        'peak_active': peak_active,
+        'calls': len(results),
+        'failed_calls': sum(1 for r in results if r.error),
+        'errors': errors,
+        'wall_s': wall_s,
+        'backpressure_waits': sum(s.get('backpressure_waits', 0) for s in stats),
+        'max_send_lag_ms': max((s.get('max_lag_ms', 0) for s in stats), default=0),
+        'adaptive_chunks': args.adaptive_chunks,
+        'chunk_resizes': sum(s.get('chunk_resizes', 0) for s in stats),
+        'chunk_ms_used': dict(sorted(chunk_ms_used.items())),
+        'latency_ms': {name: summarize(values[name]) for name in names},
+        'throughput': {
+            'calls_per_s': len(results) / wall_s if wall_s else 0,
+            'audio_s_per_s': audio_s / wall_s if wall_s else 0,
+            'chunks_per_s': sum(s.get('chunks_sent', 0) for s in stats) / wall_s if wall_s else 0,
+            'bytes_sent_per_s': sum(s.get('bytes_sent', 0) for s in stats) / wall_s if wall_s else 0,
+            'messages_received_per_s': sum(s.get('messages_received', 0) for s in stats) / wall_s if wall_s else 0,
+            'acks_per_s': sum(s.get('acks', 0) for s in stats) / wall_s if wall_s else 0,
+        },
+    }
+
+
+def print_table(report):
+    fmt = lambda v: '-' if v is None else f"{v:.1f}"
+    print(f"{report['calls']} calls ({report['failed_calls']} failed) over {report['wall_s']:.1f}s, "
+          f"peak {report['peak_active']} concurrent, {report['transport']} transport, {report['encoding']}")
+    print(f"{'metric':<22}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name, s in report['latency_ms'].items():
+        print(f"{name:<22}{s['count']:>8}{fmt(s['p50']):>10}{fmt(s['p95']):>10}{fmt(s['p99']):>10}{fmt(s['max']):>10}")
+    t = report['throughput']
+    print(f"throughput: {t['calls_per_s']:.2f} calls/s, {t['audio_s_per_s']:.2f} audio s/s, "
+          f"{t['chunks_per_s']:.1f} chunks/s, {t['bytes_sent_per_s'] / 1024:.1f} KB/s sent")
+    print(f"received: {t['messages_received_per_s']:.1f} messages/s, {t['acks_per_s']:.1f} acks/s ({report['ack']} acks)")
+    print(f"sender: {report['backpressure_waits']} backpressure waits, max lag {report['max_send_lag_ms']} ms")
+    if report['adaptive_chunks']:
+        print(f"adaptive chunks: {report['chunk_resizes']} resizes, chunks per duration (ms) {report['chunk_ms_used']}")
+    for error, count in report['errors'].items():
+        print(f"  error x{count}: {error}")
+
+
+def load_clips(args):
+    if not args.file:
+        samples, sr = pcm.generate_sine(duration_s=args.duration_s)
+        return [('sine', samples, sr)]
+    clips = []
+    for path in args.file:
+        samples, sr = pcm.read_wav(path)
+        if sr not in codec.INPUT_SAMPLE_RATES:
+            sys.exit(f"{path} is {sr} Hz; the worker accepts {', '.join(map(str, codec.INPUT_SAMPLE_RATES))} Hz")
+        clips.append((path, samples, sr))
+    return clips
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent simulated calls with latency percentiles')
+    parser.add_argument('--url', '-u', default=endpoints.worker_url(), help='WebSocket URL')
+    parser.add_argument('--file', '-f', action='append', help='WAV clip to replay (repeatable; calls rotate)')
+    parser.add_argument('--duration-s', type=float, default=3.0, help='synthetic tone length without --file')
+    parser.add_argument('--transport', choices=frames.TRANSPORTS, default='binary')
+    parser.add_argument('--encoding', choices=codec.INPUT_ENCODINGS, default='pcm16',
+                        help='wire encoding (clips at other rates than 16kHz are declared and resampled by the worker)')
+    parser.add_argument('--chunk-samples', type=int, default=CHUNK_SAMPLES)
+    parser.add_argument('--ack', choices=frames.ACK_POLICIES,
+                        help='ack policy to ask for (default: the worker acks every chunk)')
+    parser.add_argument('--ack-every', type=int, default=10, help='chunks per cumulative ack with --ack count')
+    parser.add_argument('--ack-interval-ms', type=int, default=200, help='ack interval with --ack interval')
+    parser.add_argument('--adaptive-chunks', action='store_true',
+                        help='size chunks from ack RTT and queue depth (starting at --chunk-samples)')
+    parser.add_argument('--min-chunk-ms', type=int, default=40)
+    parser.add_argument('--max-chunk-ms', type=int, default=400)
+    parser.add_argument('--latency-budget-ms', type=int, help='with --adaptive-chunks: keep chunk + ack RTT under this')
+    parser.add_argument('--pace', type=float, default=1.0, help='audio clock speed (1.0 = real time)')
+    parser.add_argument('--max-outstanding', type=int, default=32,
+                        help='unacknowledged chunks before a call pauses sending (0 = no limit)')
+    parser.add_argument('--concurrency', '-c', type=int, default=10, help='peak concurrent calls')
+    parser.add_argument('--ramp-up-s', type=float, default=10.0)
+    parser.add_argument('--hold-s', type=float, default=30.0)
+    parser.add_argument('--ramp-down-s', type=float, default=10.0)
+    parser.add_argument('--max-calls', type=int, default=0, help='stop launching after this many calls (0 = no limit)')
+    parser.add_argument('--json', help='write the report here (default: stdout after the table)')
+    parser.add_argument('--events', help='write per-message timestamps here as JSON lines (one call per line)')
+    parser.add_argument('--timings', action='store_true',
+                        help='ask the worker for per-turn stage timings and report server_* percentiles')
+    args = parser.parse_args()
+
+    if args.transport == 'binary' and args.chunk_samples > frames.MAX_FRAME_SAMPLES:
+        parser.error(f"--chunk-samples must be <= {frames.MAX_FRAME_SAMPLES} for binary transport")
+
+    clips = load_clips(args)
+    results, wall_s, peak_active, t0 = asyncio.run(run_load(args, clips))
+    report = build_report(results, wall_s, peak_active, args)
+    print_table(report)
+
+    if args.events:
+        with open(args.events, 'w') as f:
+            for r in sorted(results, key=lambda r: r.call_id):
+                f.write(json.dumps(r.to_json(t0)) + '\n')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
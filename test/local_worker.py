@@ -0,0 +1,1643 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for src/worker.js: an asyncio WebSocket server that speaks the
+same protocol (docs/protocol.md) with fake, pluggable STT/LLM/TTS backends, so
+the clients can run offline against a deterministic target.
+
+Usage:
+  python3 local_worker.py [--port 8787] [--stt-latency-ms 300] [--tts-latency-ms 150]
+                          [--llm-latency-ms 200] [--llm-token-ms 30]
+                          [--stt-failure-rate 0.1] [--fail-code 3010] [--seed 1]
+  WORKER_WS_URL=ws://127.0.0.1:8787 python3 stream_audio.py
+
+Implemented: binary 0x01 frames, JSON audio_chunk, end_stream, ping,
+dump_wav/echo_wav, session_config (vad, vad_threshold_db, vad_hangover_ms,
+response_audio, input_encoding, input_sample_rate, barge_in, timings, ack, ack_every,
+ack_interval_ms, ack_binary, gap_fill, turn_budget_ms, hedge; partial windows are not
+emulated, so partials: true is refused with an error, or a 1008 close on the URL), model calls through AiScheduler (per-model caps, priorities, turn
+deadlines, hedging after the p95, as src/scheduler.js), 0x03 Opus
+frames (when opuslib is installed; otherwise Opus is refused with
+codec_unavailable), 0x06 bulk frames (a whole recording, optionally ending the turn),
+0x05 sequenced frames (placed by offset: duplicates dropped, frames past a gap
+held for a reorder window, then gaps reported with audio_gap and zero-filled,
+see SequencedStream),
+chunk_received or 0x04 acks under the session's ack policy,
+processing_debug (with ?debug=1), transcription, response_text_delta / response_text
+(the reply is generated token by token and spoken clause by clause, like
+generateResponse), response_audio_start / 0x02 frames / response_audio_end (or
+legacy response_audio), speech_started /
+speech_ended (VAD via vad.py), barge-in (interrupt, or VAD speech onset during
+a reply) with response_interrupted, error, session_closed on idle, GET /health
+and GET /metrics (the stage and AI.run histograms of src/metrics.js, measured
+around the fakes; see TurnTimer). POST /transcribe (batch.py: the body cut at
+pauses, segments transcribed by FakeStt concurrently) is served on a second,
+plain HTTP port (--http-port), since the WebSocket server only parses GET.
+Reconnecting with the same ?session_id= resumes the call (session_resumed),
+like the CallSession Durable Object; see SessionStore.
+
+Backend failures surface the way the worker reports them: a failed STT call
+ends the turn with "Failed to process audio", a failed TTS call with
+"Failed to generate response" carrying the synthetic AiError text
+(e.g. "3010: Invalid or incomplete input for the model"); a failed LLM call
+falls back to a canned reply.
+
+In-process use (e.g. a regression test):
+  worker = LocalWorker(stt=FakeStt(latency_ms=0), llm=FakeLlm(token_ms=0), tts=FakeTts(latency_ms=0))
+  async with worker.serving() as url:
+      ...
+"""
+
+import argparse
+import array
+import asyncio
+import base64
+import collections
+import contextlib
+import json
+import math
+import random
+import re
+import struct
+import time
+import uuid
+from urllib.parse import parse_qs, parse_qsl, urlsplit
+
+import websockets
+
+import batch
+import codec
+import frames
+import pcm
+import vad
+
+SAMPLE_RATE = 16000
+TTS_SAMPLE_RATE = 24000
+STT_TIMEOUT_S = 20
+LLM_TIMEOUT_S = 15
+TTS_TIMEOUT_S = 15
+RESPONSE_TTS_AHEAD = 2  # clauses synthesizing or waiting to be forwarded, as in src/session.js
+LLM_HISTORY_TURNS = 6
+MIN_CLAUSE_CHARS = 40
+MAX_CLAUSE_CHARS = 200
+ABBREVIATIONS = {'mr', 'mrs', 'ms', 'dr', 'st', 'vs', 'etc', 'e.g', 'i.e', 'no', 'jr', 'sr'}
+IDLE_TIMEOUT_S = 120
+RESUME_WINDOW_S = 600
+SESSION_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+MAX_DUMP_BYTES = 2 * 1024 * 1024
+MAX_GAP_FILL_MS = 2000  # sequenced frames: longest gap filled with silence
+REORDER_WINDOW_MS = 200  # sequenced frames: audio held past a gap, waiting for the frames that close it
+MAX_MISSING_SEQS = 256
+MAX_PASSED_GAPS = 64
+RESPONSE_AUDIO_MAX_PAYLOAD = 16 * 1024
+STT_MODEL = '@cf/openai/whisper'
+LLM_MODEL = '@cf/meta/llama-3.1-8b-instruct'
+TTS_MODEL = '@cf/deepgram/aura-1'
+AI_PRIORITIES = ('live', 'background', 'batch')
+AI_CONCURRENCY = {'default': 4, STT_MODEL: 6, LLM_MODEL: 4, TTS_MODEL: 6}  # as src/scheduler.js
+HEDGE_QUANTILE = 0.95
+HEDGE_WINDOW = 100
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY_MS = 50
+LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 30000)
+
+RESPONSES = [
+    "I understand. Can you tell me more?",
+    "That's interesting. How can I help you?",
+    "Thank you for that information. What else would you like to know?",
+    "I see. Let me help you with that.",
+]
+
+PARTIALS_UNSUPPORTED = 'partial windows are not emulated by the stand-in'
+
+# Workers AI error codes the fakes can inject
+AI_ERRORS = {
+    3010: 'Invalid or incomplete input for the model',
+    3040: 'Capacity temporarily exceeded, please try again.',
+}
+
+DEFAULT_SESSION_OPTIONS = {
+    'partials': False,
+    'partial_window_ms': 6000,
+    'partial_hop_ms': 2000,
+    'vad': False,
+    'vad_threshold_db': vad.VAD_DEFAULTS['threshold_db'],
+    'vad_hangover_ms': vad.VAD_DEFAULTS['hangover_ms'],
+    'response_audio': 'binary',
+    'input_encoding': 'pcm16',
+    'input_sample_rate': SAMPLE_RATE,
+    'barge_in': True,
+    'timings': False,
+    'ack': 'chunk',
+    'ack_every': 10,
+    'ack_interval_ms': 200,
+    'ack_binary': False,
+    'gap_fill': 'zero',
+    'turn_budget_ms': 30000,
+    'hedge': False,
+}
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class AiError(Exception):
+    """What env.AI.run rejects with: '<code>: <message>'."""
+
+    def __init__(self, code, message=None):
+        super().__init__(f"{code}: {message or AI_ERRORS.get(code, 'Synthetic AI error')}")
+        self.code = code
+
+
+class TurnBudgetExhausted(RuntimeError):
+    """A call's deadline passed before it was sent (TURN_BUDGET_EXHAUSTED in src/scheduler.js)."""
+
+    def __init__(self):
+        super().__init__('turn budget exhausted')
+
+
+class FakeBackend:
+    """Latency (fixed + uniform jitter) and failure injection shared by the fakes.
+
+    Failures happen with probability failure_rate, or deterministically for the
+    next N calls after fail_next(N).
+    """
+
+    def __init__(self, latency_ms=0, jitter_ms=0, failure_rate=0.0, fail_code=3010, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.fail_code = fail_code
+        self.rng = random.Random(seed)
+        self.forced_failures = 0
+        self.calls = 0
+        self.failures = 0
+
+    def fail_next(self, count=1):
+        self.forced_failures += count
+
+    async def _call(self):
+        self.calls += 1
+        delay = self.latency_ms + (self.rng.uniform(0, self.jitter_ms) if self.jitter_ms else 0)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if self.forced_failures > 0 or (self.failure_rate and self.rng.random() < self.failure_rate):
+            self.forced_failures = max(0, self.forced_failures - 1)
+            self.failures += 1
+            raise AiError(self.fail_code)
+
+    def stats(self):
+        return {'calls': self.calls, 'failures': self.failures}
+
+
+class FakeStt(FakeBackend):
+    """Whisper stand-in: returns {text, word_count, words} for a 16-bit mono WAV.
+
+    `transcript` is a fixed string or a callable(duration_s) -> str; by default
+    the text names the audio duration so clients can check what arrived.
+    """
+
+    def __init__(self, transcript=None, **kwargs):
+        super().__init__(**kwargs)
+        self.transcript = transcript
+
+    def text_for(self, duration_s):
+        if callable(self.transcript):
+            return self.transcript(duration_s)
+        if self.transcript is not None:
+            return self.transcript
+        return f"test audio of {duration_s:.1f} seconds"
+
+    async def transcribe(self, wav_bytes):
+        await self._call()
+        sample_rate = struct.unpack_from('<I', wav_bytes, 24)[0]
+        duration_s = (len(wav_bytes) - 44) / 2 / sample_rate
+        text = self.text_for(duration_s)
+        words = text.split()
+        step = duration_s / max(1, len(words))
+        return {
+            'text': text,
+            'word_count': len(words),
+            'words': [{'word': w, 'start': round(i * step, 3), 'end': round((i + 1) * step, 3)}
+                      for i, w in enumerate(words)],
+        }
+
+
+class FakeLlm(FakeBackend):
+    """Streaming text-generation stand-in: yields the reply word by word.
+
+    latency_ms is the time to the first token; each token then follows after
+    token_ms. `reply` is a fixed string or a callable(user_text) -> str; by
+    default a canned response is picked.
+    """
+
+    def __init__(self, reply=None, token_ms=30, **kwargs):
+        super().__init__(**kwargs)
+        self.reply = reply
+        self.token_ms = token_ms
+
+    def reply_for(self, user_text):
+        if callable(self.reply):
+            return self.reply(user_text)
+        if self.reply is not None:
+            return self.reply
+        return self.rng.choice(RESPONSES)
+
+    async def generate(self, user_text, history=()):
+        """Wait for the first token (may raise AiError), then return an async iterator of text pieces."""
+        await self._call()
+        return self._tokens(re.findall(r'\S+\s*', self.reply_for(user_text)))
+
+    async def _tokens(self, tokens):
+        for i, token in enumerate(tokens):
+            if i and self.token_ms:
+                await asyncio.sleep(self.token_ms / 1000)
+            yield token
+
+
+class ClauseSplitter:
+    """Same rules as ClauseSplitter in src/llm.js: sentences, and long stretches up to , ; or :."""
+
+    def __init__(self, min_clause_chars=MIN_CLAUSE_CHARS, max_clause_chars=MAX_CLAUSE_CHARS):
+        self.min_clause_chars = min_clause_chars
+        self.max_clause_chars = max_clause_chars
+        self.text = ''
+
+    def push(self, text):
+        self.text += text
+        clauses = []
+        start = 0
+        for i in range(len(self.text) - 1):
+            ch = self.text[i]
+            if not self.text[i + 1].isspace():
+                continue
+            if ch in '.!?':
+                boundary = not self._is_abbreviation(start, i)
+            else:
+                boundary = ch in ',;:' and i + 1 - start >= self.min_clause_chars
+            if boundary:
+                self._take(clauses, start, i + 1)
+                start = i + 1
+        while len(self.text) - start > self.max_clause_chars:
+            cut = self.text.rfind(' ', start, start + self.max_clause_chars + 1)
+            end = cut if cut > start else start + self.max_clause_chars
+            self._take(clauses, start, end)
+            start = end
+        self.text = self.text[start:]
+        return clauses
+
+    def flush(self):
+        rest = self.text.strip()
+        self.text = ''
+        return [rest] if rest else []
+
+    def _take(self, clauses, start, end):
+        clause = self.text[start:end].strip()
+        if clause:
+            clauses.append(clause)
+
+    def _is_abbreviation(self, start, dot):
+        if self.text[dot] != '.':
+            return False
+        match = re.search(r'(?:[^\W\d_]|\.)+$', self.text[start:dot])
+        word = match.group(0) if match else ''
+        return word.lower() in ABBREVIATIONS or (len(word) == 1 and word.isupper() and word != 'I')
+
+
+class FakeTts(FakeBackend):
+    """Aura stand-in: streams a linear16 tone whose length follows the text.
+
+    latency_ms is the time to first byte; chunks of chunk_ms audio then follow
+    every chunk_interval_ms.
+    """
+
+    def __init__(self, ms_per_char=60, chunk_ms=100, chunk_interval_ms=10, freq=220, **kwargs):
+        super().__init__(**kwargs)
+        self.ms_per_char = ms_per_char
+        self.chunk_ms = chunk_ms
+        self.chunk_interval_ms = chunk_interval_ms
+        self.freq = freq
+
+    def audio_for(self, text):
+        samples, _ = pcm.generate_sine(len(text) * self.ms_per_char / 1000, self.freq, TTS_SAMPLE_RATE)
+        return pcm.pcm_bytes(samples)
+
+    async def synthesize(self, text):
+        """Wait for the first byte (may raise AiError), then return an async iterator of chunks."""
+        await self._call()
+        return self._chunks(self.audio_for(text))
+
+    async def _chunks(self, audio):
+        chunk_bytes = max(2, TTS_SAMPLE_RATE * self.chunk_ms // 1000 * 2)
+        for pos in range(0, len(audio), chunk_bytes):
+            if pos and self.chunk_interval_ms:
+                await asyncio.sleep(self.chunk_interval_ms / 1000)
+            yield audio[pos:pos + chunk_bytes]
+
+
+class Histogram:
+    """Prometheus histogram with fixed buckets, as in src/metrics.js."""
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS_MS):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self.series = {}  # label values -> [bucket counts, sum, count]
+
+    def observe(self, labels, value):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        counts = self.series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+        for i, le in enumerate(self.buckets):
+            if value <= le:
+                counts[0][i] += 1
+                break
+        counts[1] += value
+        counts[2] += 1
+
+    def render(self, lines):
+        lines += [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for le, n in zip(self.buckets + ('+Inf',), counts + [count]):
+                cumulative = count if le == '+Inf' else cumulative + n
+                lines.append(f"{self.name}_bucket{label_text(self.label_names + ('le',), values + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{label_text(self.label_names, values)} {round(total, 1)}")
+            lines.append(f"{self.name}_count{label_text(self.label_names, values)} {count}")
+
+
+def label_text(names, values):
+    if not names:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Metrics:
+    """The stand-in's /metrics: same series names and stages as src/metrics.js."""
+
+    def __init__(self):
+        self.stages = Histogram('voice_stage_duration_ms', 'Turn stage durations in milliseconds', ('stage',))
+        self.ai_runs = Histogram('voice_ai_run_duration_ms',
+                                 'AI.run calls in milliseconds by model, payload shape and outcome',
+                                 ('model', 'shape', 'outcome'))
+        self.ai_queue_wait = Histogram('voice_ai_queue_wait_ms',
+                                       'Time AI.run calls waited for a concurrency slot in milliseconds',
+                                       ('model', 'priority'))
+        self.turns = collections.Counter()
+        self.hedges = collections.Counter()  # (model, result) -> calls
+
+    def render(self):
+        lines = []
+        self.stages.render(lines)
+        self.ai_runs.render(lines)
+        lines += ['# HELP voice_turns_total Turns processed by outcome (ok, empty, error, interrupted)',
+                  '# TYPE voice_turns_total counter']
+        lines += [f'voice_turns_total{{outcome="{outcome}"}} {n}' for outcome, n in self.turns.items()]
+        self.ai_queue_wait.render(lines)
+        lines += ['# HELP voice_ai_hedges_total Hedged AI.run calls by model and result (primary, hedge, failed, skipped)',
+                  '# TYPE voice_ai_hedges_total counter']
+        lines += [f'voice_ai_hedges_total{label_text(("model", "result"), key)} {n}' for key, n in self.hedges.items()]
+        return '\n'.join(lines) + '\n'
+
+
+class TurnTimer:
+    """Marks of one turn in ms since its first chunk, as TurnTimer in src/metrics.js."""
+
+    def __init__(self, metrics, origin=None):
+        self.metrics = metrics
+        self.origin = time.perf_counter() if origin is None else origin
+        self.marks = {'first_chunk': 0.0}
+        self.ai_runs = []
+
+    def mark(self, name, overwrite=False):
+        if overwrite or name not in self.marks:
+            self.marks[name] = (time.perf_counter() - self.origin) * 1000
+        return self
+
+    def span(self, stage, start, end):
+        if start in self.marks and end in self.marks:
+            self.metrics.stages.observe({'stage': stage}, self.marks[end] - self.marks[start])
+
+    def ai_run(self, model, shape, outcome, started_at):
+        ms = (time.perf_counter() - started_at) * 1000
+        self.metrics.ai_runs.observe({'model': model, 'shape': shape, 'outcome': outcome}, ms)
+        self.ai_runs.append({'model': model, 'shape': shape, 'outcome': outcome,
+                             'start_ms': round((started_at - self.origin) * 1000, 1), 'ms': round(ms, 1)})
+
+    def to_json(self):
+        return dict({name: round(ms, 1) for name, ms in self.marks.items()}, ai_runs=self.ai_runs)
+
+
+def ai_run_outcome(err):
+    if err is None:
+        return 'ok'
+    if isinstance(err, asyncio.CancelledError):
+        return 'aborted'
+    return 'timeout' if isinstance(err, asyncio.TimeoutError) else 'error'
+
+
+class AiScheduler:
+    """Per-model concurrency caps, priority queues, deadlines and hedging around the fakes, as AiScheduler
+    in src/scheduler.js. Deadlines are time.perf_counter() values; a lost hedge is cancelled."""
+
+    def __init__(self, metrics, limits=AI_CONCURRENCY):
+        self.metrics = metrics
+        self.limits = limits
+        self.lanes = {}  # model -> {'active': n, 'queues': {priority: deque of futures}}
+        self.latencies = {}  # (model, shape) -> ms of its last HEDGE_WINDOW successful calls
+
+    def limit(self, model):
+        return self.limits.get(model, self.limits['default'])
+
+    def lane(self, model):
+        return self.lanes.setdefault(model, {'active': 0, 'queues': {p: collections.deque() for p in AI_PRIORITIES}})
+
+    def try_acquire(self, model):
+        lane = self.lane(model)
+        if lane['active'] >= self.limit(model) or any(lane['queues'].values()):
+            return False
+        lane['active'] += 1
+        return True
+
+    async def acquire(self, model, priority, deadline=None):
+        if deadline is not None and deadline <= time.perf_counter():
+            raise TurnBudgetExhausted()
+        if self.try_acquire(model):
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.lane(model)['queues'].get(priority, self.lane(model)['queues']['live']).append(waiter)
+        try:
+            await asyncio.wait_for(waiter, None if deadline is None else deadline - time.perf_counter())
+        except (asyncio.TimeoutError, asyncio.CancelledError) as err:
+            # Granted while giving up: hand the slot on
+            if waiter.done() and not waiter.cancelled():
+                self.release(model)
+            if isinstance(err, asyncio.TimeoutError):
+                raise TurnBudgetExhausted() from None
+            raise
+
+    def release(self, model):
+        lane = self.lane(model)
+        lane['active'] -= 1
+        for priority in AI_PRIORITIES:
+            queue = lane['queues'][priority]
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    lane['active'] += 1
+                    waiter.set_result(None)
+                    return
+
+    def hedge_delay(self, model, shape):
+        window = self.latencies.get((model, shape))
+        if not window or len(window) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(window)
+        return max(HEDGE_MIN_DELAY_MS, ordered[math.ceil(HEDGE_QUANTILE * len(ordered)) - 1])
+
+    def record(self, timer, model, shape, outcome, started_at):
+        if timer is not None:
+            timer.ai_run(model, shape, outcome, started_at)
+        else:
+            self.metrics.ai_runs.observe({'model': model, 'shape': shape, 'outcome': outcome},
+                                         (time.perf_counter() - started_at) * 1000)
+
+    async def run(self, model, call, priority='live', timeout_s=15, deadline=None, hedge=False, shape='default',
+                  timer=None):
+        """Result of call() (a coroutine function, one fake AI.run) under the caps; raises like the worker:
+        asyncio.TimeoutError past the timeout, TurnBudgetExhausted when the deadline passed unsent."""
+        queued_at = time.perf_counter()
+        await self.acquire(model, priority, deadline)
+        self.metrics.ai_queue_wait.observe({'model': model, 'priority': priority},
+                                           (time.perf_counter() - queued_at) * 1000)
+        budget = timeout_s if deadline is None else min(timeout_s, deadline - time.perf_counter())
+        if budget <= 0:
+            self.release(model)
+            raise TurnBudgetExhausted()
+        give_up_at = time.perf_counter() + budget
+        delay = self.hedge_delay(model, shape) if hedge else None
+        hedge_at = None if delay is None or delay / 1000 >= budget else time.perf_counter() + delay / 1000
+        attempts = {}  # task -> (started_at, hedged)
+        rest = 'aborted'  # how attempts still in flight are recorded when this call stops waiting
+
+        def start(hedged):
+            attempts[asyncio.ensure_future(call())] = (time.perf_counter(), hedged)
+
+        def end(task, outcome):
+            started_at, _hedged = attempts.pop(task)
+            self.release(model)
+            if outcome == 'ok':
+                window = self.latencies.setdefault((model, shape), collections.deque(maxlen=HEDGE_WINDOW))
+                window.append((time.perf_counter() - started_at) * 1000)
+            self.record(timer, model, shape, outcome, started_at)
+
+        start(False)
+        hedged = False
+        try:
+            while True:
+                wake = give_up_at if hedge_at is None else min(give_up_at, hedge_at)
+                done, _ = await asyncio.wait(set(attempts), timeout=max(0, wake - time.perf_counter()),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                error = None
+                for task in done:
+                    if task.exception() is None:
+                        is_hedge = attempts[task][1]
+                        end(task, 'ok')
+                        if hedged:
+                            self.metrics.hedges[(model, 'hedge' if is_hedge else 'primary')] += 1
+                        rest = 'lost'
+                        return task.result()
+                    error = task.exception()
+                    end(task, ai_run_outcome(error))
+                if not attempts:
+                    if hedged:
+                        self.metrics.hedges[(model, 'failed')] += 1
+                    raise error
+                if time.perf_counter() >= give_up_at:
+                    if hedged:
+                        self.metrics.hedges[(model, 'failed')] += 1
+                    rest = 'timeout'
+                    raise asyncio.TimeoutError()
+                if hedge_at is not None and time.perf_counter() >= hedge_at:
+                    hedge_at = None
+                    if self.try_acquire(model):
+                        hedged = True
+                        start(True)
+                    else:
+                        self.metrics.hedges[(model, 'skipped')] += 1
+        finally:
+            for task in list(attempts):
+                task.cancel()
+                end(task, rest)
+
+    def stats(self):
+        return {model: {'active': lane['active'], 'limit': self.limit(model),
+                        'queued': {p: sum(not w.done() for w in q) for p, q in lane['queues'].items()}}
+                for model, lane in self.lanes.items()}
+
+
+def apply_session_config(options, config):
+    """Same parsing and clamping as applySessionConfig in src/session.js.
+
+    Raises ValueError, leaving options untouched, for partials: true: the
+    stand-in has no partial windows, and silently reporting them off would let
+    a test of partial transcripts pass without any.
+    """
+    def flag(v):
+        return v is True or v == 1 or v == '1' or v == 'true'
+
+    if flag(config.get('partials')):
+        raise ValueError(PARTIALS_UNSUPPORTED)
+
+    def clamp_int(v, lo, hi, fallback):
+        try:
+            n = float(v)
+        except (TypeError, ValueError):
+            return fallback
+        return min(hi, max(lo, math.floor(n + 0.5))) if math.isfinite(n) else fallback
+
+    if 'partials' in config:
+        options['partials'] = flag(config['partials'])
+    if 'partial_window_ms' in config:
+        options['partial_window_ms'] = clamp_int(config['partial_window_ms'], 2000, 30000, options['partial_window_ms'])
+    if 'partial_hop_ms' in config:
+        options['partial_hop_ms'] = clamp_int(config['partial_hop_ms'], 500, 10000, options['partial_hop_ms'])
+    if 'vad' in config:
+        options['vad'] = flag(config['vad'])
+    if 'vad_threshold_db' in config:
+        try:
+            options['vad_threshold_db'] = min(0, max(-90, float(config['vad_threshold_db'])))
+        except (TypeError, ValueError):
+            pass
+    if 'vad_hangover_ms' in config:
+        options['vad_hangover_ms'] = clamp_int(config['vad_hangover_ms'], 100, 5000, options['vad_hangover_ms'])
+    if 'barge_in' in config:
+        options['barge_in'] = flag(config['barge_in'])
+    if 'timings' in config:
+        options['timings'] = flag(config['timings'])
+    if config.get('ack') in frames.ACK_POLICIES:
+        options['ack'] = config['ack']
+    if 'ack_every' in config:
+        options['ack_every'] = clamp_int(config['ack_every'], 1, 1000, options['ack_every'])
+    if 'ack_interval_ms' in config:
+        options['ack_interval_ms'] = clamp_int(config['ack_interval_ms'], 20, 5000, options['ack_interval_ms'])
+    if 'ack_binary' in config:
+        options['ack_binary'] = flag(config['ack_binary'])
+    if config.get('gap_fill') in ('zero', 'none'):
+        options['gap_fill'] = config['gap_fill']
+    if 'turn_budget_ms' in config:
+        options['turn_budget_ms'] = clamp_int(config['turn_budget_ms'], 2000, 120000, options['turn_budget_ms'])
+    if 'hedge' in config:
+        options['hedge'] = flag(config['hedge'])
+    if config.get('response_audio') in ('binary', 'json'):
+        options['response_audio'] = config['response_audio']
+    if config.get('input_encoding') in codec.INPUT_ENCODINGS:
+        options['input_encoding'] = config['input_encoding']
+    if 'input_sample_rate' in config:
+        try:
+            rate = float(config['input_sample_rate'])
+        except (TypeError, ValueError):
+            rate = None
+        if rate in codec.INPUT_SAMPLE_RATES:
+            options['input_sample_rate'] = int(rate)
+    options['partial_window_ms'] = max(options['partial_window_ms'], options['partial_hop_ms'] + 1000)
+    return options
+
+
+def session_options_from_path(path):
+    options = dict(DEFAULT_SESSION_OPTIONS)
+    return apply_session_config(options, dict(parse_qsl(urlsplit(path).query)))
+
+
+class SequencedStream:
+    """Position and loss counters of the 0x05 input stream; kept across reconnects (newStreamState)."""
+
+    COUNTERS = ('frames', 'duplicates', 'late_frames', 'reordered_frames', 'lost_frames', 'gaps', 'gap_samples',
+                'filled_samples', 'overlap_samples')
+
+    def __init__(self):
+        self.next_seq = 0
+        self.next_offset = 0
+        self.missing = collections.deque(maxlen=MAX_MISSING_SEQS)  # skipped seq numbers not seen since
+        self.passed_gaps = collections.deque(maxlen=MAX_PASSED_GAPS)  # (start, end) filled or skipped
+        self.held = []  # frames past a gap, by offset: (offset, end, seq, payload)
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+
+    def note_seq(self, seq):
+        if seq >= self.next_seq:
+            self.missing.extend(range(max(self.next_seq, seq - MAX_MISSING_SEQS), seq))
+            self.lost_frames += seq - self.next_seq
+            self.next_seq = seq + 1
+        elif seq in self.missing:
+            self.missing.remove(seq)
+            self.lost_frames -= 1
+            self.reordered_frames += 1
+
+    def held_samples(self, start=0, stop=math.inf):
+        """Samples in [start, stop) that held frames cover, overlapping frames counted once."""
+        covered, pos = 0, start
+        for f_offset, f_end, _, _ in self.held:
+            a, b = max(f_offset, pos), min(f_end, stop)
+            if b > a:
+                covered += b - a
+                pos = b
+        return covered
+
+    def describe(self):
+        return dict({'next_seq': self.next_seq, 'next_offset': self.next_offset, 'held_frames': len(self.held)},
+                    **{name: getattr(self, name) for name in self.COUNTERS})
+
+
+class AckState:
+    """Chunks received and acknowledged on the current connection (the ack state of src/session.js)."""
+
+    def __init__(self):
+        self.timer = None
+        self.reset()
+
+    def reset(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.seq = 0
+        self.acked = 0
+        self.samples = 0
+        self.binary = False
+        self.timer = None
+
+
+def codec_rejection(input_encoding, err):
+    return {'input_encoding': input_encoding, 'reason': 'codec_unavailable', 'message': str(err)}
+
+
+class Session:
+    def __init__(self, worker, ws, path, session_id=None):
+        self.worker = worker
+        self.ws = ws
+        self.id = session_id or str(uuid.uuid4())
+        self.detached_at = None
+        self.audio = array.array('h')
+        self.options = session_options_from_path(path)
+        self.debug = dict(parse_qsl(urlsplit(path).query)).get('debug') == '1'
+        self.vad = self.create_vad()
+        self.decoder = None
+        # An opus input_encoding from the URL that cannot load is reported once connected (prepareInputDecoder)
+        requested, err = self.options['input_encoding'], self.switch_decoder()
+        self.decoder_rejected = codec_rejection(requested, err) if err is not None else None
+        self.utterance_start = 0
+        self.is_processing = False
+        self.turn_queued = False
+        self.response_seq = 0
+        self.history = []  # recent {role, content} messages, passed to the LLM
+        self.turn = None  # task running the current turn (STT, generation, TTS)
+        self.reply = None  # the reply being spoken: clauses and audio sent, as in src/session.js
+        self.reply_task = None
+        self.timer = None  # TurnTimer of the audio buffered for the next turn
+        self.acks = AckState()
+        self.stream = SequencedStream()
+        self.tasks = set()
+
+    def create_vad(self):
+        if not self.options['vad']:
+            return None
+        return vad.VoiceActivityDetector(sample_rate=SAMPLE_RATE,
+                                         threshold_db=self.options['vad_threshold_db'],
+                                         hangover_ms=self.options['vad_hangover_ms'])
+
+    def create_decoder(self):
+        if self.options['input_encoding'] == 'opus':
+            return codec.OpusInputDecoder(SAMPLE_RATE)
+        return codec.InputDecoder(self.options['input_encoding'], self.options['input_sample_rate'], SAMPLE_RATE)
+
+    def switch_decoder(self, fallback='pcm16'):
+        """Same negotiation as switchInputDecoder in src/session.js: returns the error on fallback."""
+        try:
+            self.decoder = self.create_decoder()
+            return None
+        except RuntimeError as err:
+            self.options['input_encoding'] = 'pcm16' if fallback == self.options['input_encoding'] else fallback
+            self.decoder = self.create_decoder()
+            return err
+
+    async def session_configured(self, rejected=None):
+        reply = {'type': 'session_configured', 'session_id': self.id, 'options': dict(self.options)}
+        if rejected is not None:
+            reply['rejected'] = rejected
+        await self.send(reply)
+
+    async def send(self, message):
+        try:
+            await self.ws.send(json.dumps(message) if isinstance(message, dict) else message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def ack_chunk(self, chunk_size, binary):
+        """Count a received chunk and acknowledge it as the ack option says (ackChunk in src/session.js)."""
+        acks = self.acks
+        acks.seq += 1
+        acks.samples += chunk_size
+        acks.binary = binary
+        policy = self.options['ack']
+        if policy == 'none':
+            acks.acked, acks.samples = acks.seq, 0
+        elif policy == 'chunk' or (policy == 'count' and acks.seq - acks.acked >= self.options['ack_every']):
+            await self.flush_acks()
+        elif policy == 'interval' and acks.timer is None:
+            acks.timer = asyncio.get_running_loop().call_later(
+                self.options['ack_interval_ms'] / 1000, lambda: self.spawn(self.flush_acks()))
+
+    async def flush_acks(self):
+        """One cumulative ack for every chunk not acknowledged yet."""
+        acks = self.acks
+        if acks.timer is not None:
+            acks.timer.cancel()
+            acks.timer = None
+        chunks = acks.seq - acks.acked
+        if chunks == 0:
+            return
+        seq, samples = acks.seq, acks.samples
+        acks.acked, acks.samples = acks.seq, 0
+        if acks.binary and self.options['ack_binary']:
+            await self.send(frames.ack_frame(seq, chunks, len(self.audio)))
+        else:
+            await self.send({'type': 'chunk_received', 'seq': seq, 'chunks': chunks, 'chunk_size': samples,
+                             'buffer_size': len(self.audio)})
+
+    async def error(self, message, err=None, **extra):
+        self.worker.stats['errors_sent'] += 1
+        payload = {'type': 'error', 'message': message}
+        if err is not None:
+            payload['error'] = {'message': str(err)}
+        payload.update(extra)
+        await self.send(payload)
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, message):
+        if not isinstance(message, str):
+            data = bytes(message)
+            if len(data) >= 2 and data[0] == frames.FRAME_OPUS:
+                if self.decoder.encoding != 'opus':
+                    await self.error('Invalid binary frame', 'Opus frame without input_encoding "opus"')
+                    return
+                decode_start = time.perf_counter()
+                try:
+                    samples = self.decoder.decode_packets(frames.parse_opus_frame(data))
+                except Exception as err:  # malformed frame or opuslib.OpusError
+                    await self.error('Invalid binary frame', err)
+                    return
+                await self.ingest(samples, decode_start)
+                await self.ack_chunk(len(samples), binary=True)
+                return
+            if len(data) >= 12 and data[0] == frames.FRAME_SEQ_AUDIO:
+                version, seq, offset, count, payload = frames.parse_sequenced_audio_frame(data)
+                size = count * self.decoder.bytes_per_sample
+                if version != frames.SEQ_AUDIO_VERSION:
+                    await self.error('Invalid binary frame', f'unsupported sequenced frame version {version}')
+                    return
+                if not self.decoder.bytes_per_sample:
+                    await self.error('Invalid binary frame', 'sequenced frames carry PCM or G.711 samples, not Opus')
+                    return
+                if len(payload) < size:
+                    await self.error('Invalid binary frame', 'binary frame too short')
+                    return
+                await self.ingest_sequenced(seq, offset, bytes(payload[:size]), count)
+                await self.ack_chunk(count, binary=True)
+                return
+            if len(data) >= 6 and data[0] == frames.FRAME_BULK_AUDIO:
+                flags, count, payload = frames.parse_bulk_audio_frame(data)
+                size = count * self.decoder.bytes_per_sample
+                if not self.decoder.bytes_per_sample:
+                    await self.error('Invalid binary frame', 'bulk frames carry PCM or G.711 samples, not Opus')
+                    return
+                if len(payload) < size:
+                    await self.error('Invalid binary frame', 'binary frame too short')
+                    return
+                decode_start = time.perf_counter()
+                await self.ingest(self.decoder.decode_bytes(payload[:size]), decode_start)
+                await self.ack_chunk(count, binary=True)
+                if flags & frames.BULK_AUDIO_FLAG_END:
+                    await self.end_stream()
+                return
+            if len(data) >= 3 and data[0] == frames.FRAME_AUDIO:
+                count = struct.unpack_from('<H', data, 1)[0]
+                size = count * self.decoder.bytes_per_sample
+                if len(data) < 3 + size:
+                    await self.error('Invalid binary frame', 'binary frame too short')
+                    return
+                decode_start = time.perf_counter()
+                try:
+                    samples = self.decoder.decode_bytes(data[3:3 + size])
+                except ValueError as err:
+                    await self.error('Invalid binary frame', err)
+                    return
+                await self.ingest(samples, decode_start)
+                await self.ack_chunk(count, binary=True)
+                return
+            await self.error('Invalid message format', 'binary message is not an audio frame')
+            return
+
+        try:
+            data = json.loads(message)
+        except ValueError as err:
+            await self.error('Invalid message format', err)
+            return
+
+        msg_type = data.get('type') if isinstance(data, dict) else None
+        if msg_type == 'audio_chunk':
+            decode_start = time.perf_counter()
+            try:
+                count = len(data['audio'])
+                chunk = self.decoder.decode_values(data['audio'])
+            except (KeyError, TypeError, ValueError) as err:
+                await self.error('Chunk handling failed', err)
+                return
+            await self.ingest(chunk, decode_start)
+            await self.ack_chunk(count, binary=False)
+        elif msg_type == 'end_stream':
+            await self.end_stream()
+        elif msg_type == 'session_config':
+            input_format = (self.options['input_encoding'], self.options['input_sample_rate'])
+            await self.flush_acks()
+            try:
+                apply_session_config(self.options, data)
+            except ValueError as err:
+                await self.error(str(err))
+                return
+            self.vad = self.create_vad()
+            requested, err = self.options['input_encoding'], None
+            if (requested, self.options['input_sample_rate']) != input_format:
+                err = self.switch_decoder(input_format[0])
+            await self.session_configured(codec_rejection(requested, err) if err is not None else None)
+        elif msg_type == 'interrupt':
+            played_ms = data.get('played_ms')
+            valid = isinstance(played_ms, (int, float)) and not isinstance(played_ms, bool) and played_ms >= 0
+            await self.interrupt_turn('client', played_ms if valid else None)
+        elif msg_type == 'ping':
+            pong = {'type': 'pong', 'session_id': self.id, 'timestamp': now_ms()}
+            if self.stream.frames:
+                pong['stream'] = self.stream.describe()
+            await self.send(pong)
+        elif msg_type in ('dump_wav', 'echo_wav'):
+            await self.dump_wav()
+
+    async def end_stream(self):
+        """End of the caller's turn: end_stream, or a bulk frame flagged end (endStream in src/session.js)."""
+        await self.release_held(force=True)
+        if self.vad:
+            await self.handle_vad_events(self.vad.flush())
+        if self.timer is not None:
+            self.timer.mark('end_stream')
+        await self.flush_acks()
+        self.start_turn()
+
+    async def ingest(self, samples, decode_start=None):
+        self.worker.stats['samples_received'] += len(samples)
+        if decode_start is not None:
+            self.worker.metrics.stages.observe({'stage': 'decode'}, (time.perf_counter() - decode_start) * 1000)
+        if self.timer is None:
+            self.timer = TurnTimer(self.worker.metrics, decode_start)
+        self.timer.mark('last_chunk', overwrite=True)
+        if not self.vad:
+            self.audio.extend(samples)
+            return
+        await self.handle_vad_events(self.vad.process(samples))
+
+    async def ingest_sequenced(self, seq, offset, payload, count):
+        """Place a 0x05 frame's samples at its offset, holding it for the reorder window if it lands
+        past a gap (ingestSequenced in src/session.js)."""
+        stream = self.stream
+        stream.frames += 1
+        stream.note_seq(seq)
+        end = offset + count
+        if end <= stream.next_offset:
+            if any(offset < b and end > a for a, b in stream.passed_gaps):
+                stream.late_frames += 1
+            else:
+                stream.duplicates += 1
+            return
+        if offset > stream.next_offset:
+            # Only a frame the held ones cover whole is a duplicate; a partial overlap is trimmed when placed
+            if stream.held_samples(offset, end) == end - offset:
+                stream.duplicates += 1
+                return
+            stream.held.append((offset, end, seq, bytes(payload)))
+            stream.held.sort(key=lambda f: f[0])
+            if stream.held_samples() * 1000 >= REORDER_WINDOW_MS * self.options['input_sample_rate']:
+                await self.release_held(force=True)
+            return
+        await self.place_frame(seq, offset, payload)
+        await self.release_held()
+
+    async def release_held(self, force=False):
+        """Place the held frames that now follow on; with force (window over, end of turn) all of them."""
+        stream = self.stream
+        while stream.held and (force or stream.held[0][0] <= stream.next_offset):
+            offset, end, seq, payload = stream.held.pop(0)
+            if end <= stream.next_offset:
+                stream.duplicates += 1
+                continue
+            await self.place_frame(seq, offset, payload)
+
+    async def place_frame(self, seq, offset, payload):
+        stream = self.stream
+        bytes_per_sample = self.decoder.bytes_per_sample
+        skip = 0
+        if offset < stream.next_offset:
+            skip = stream.next_offset - offset
+            stream.overlap_samples += skip
+        elif offset > stream.next_offset:
+            gap = offset - stream.next_offset
+            rate = self.options['input_sample_rate']
+            fill = self.options['gap_fill'] == 'zero' and gap * 1000 <= MAX_GAP_FILL_MS * rate
+            stream.gaps += 1
+            stream.gap_samples += gap
+            stream.passed_gaps.append((stream.next_offset, offset))
+            await self.send({'type': 'audio_gap', 'seq': seq, 'offset': stream.next_offset, 'samples': gap,
+                             'filled': fill, 'timestamp': now_ms()})
+            if fill:
+                stream.filled_samples += gap
+                await self.ingest(array.array('h', bytes(2 * round(gap * SAMPLE_RATE / rate))))
+        stream.next_offset = offset + len(payload) // bytes_per_sample
+        decode_start = time.perf_counter()
+        await self.ingest(self.decoder.decode_bytes(payload[skip * bytes_per_sample:]), decode_start)
+
+    async def handle_vad_events(self, events):
+        for event in events:
+            if event[0] == 'audio':
+                self.audio.extend(event[1])
+            elif event[0] == 'start':
+                self.utterance_start = len(self.audio)
+                await self.send({'type': 'speech_started', 'timestamp': now_ms()})
+                if self.options['barge_in'] and self.reply is not None:
+                    await self.interrupt_turn('speech')
+            elif event[0] == 'end':
+                _, speech_ms, discard = event
+                await self.send({'type': 'speech_ended', 'speech_ms': speech_ms, 'discarded': discard,
+                                 'timestamp': now_ms()})
+                if discard:
+                    del self.audio[self.utterance_start:]
+                else:
+                    if self.timer is not None:
+                        self.timer.mark('end_stream')
+                    self.start_turn()
+
+    async def dump_wav(self):
+        if not self.audio:
+            await self.error('No audio buffered')
+            return
+        wav_bytes = pcm.build_wav_bytes(memoryview(self.audio), SAMPLE_RATE)
+        if len(wav_bytes) > MAX_DUMP_BYTES:
+            await self.error('WAV too large to dump', size=len(wav_bytes))
+            return
+        await self.send({'type': 'echo_wav', 'wavBase64': base64.b64encode(wav_bytes).decode('ascii'),
+                         'sampleRate': SAMPLE_RATE, 'samples': len(self.audio)})
+
+    def start_turn(self):
+        """Process the buffered turn; if one is already running, run again once it finishes."""
+        if self.is_processing:
+            self.turn_queued = True
+            return
+        if not self.audio:
+            return
+        self.is_processing = True
+        self.spawn(self.run_turn())
+
+    async def run_turn(self):
+        task = self.turn = asyncio.current_task()
+        try:
+            await self.process_audio_buffer()
+        except asyncio.CancelledError:
+            if self.turn is task:  # cancelled by close(), not interrupted
+                raise
+        except Exception as err:
+            await self.error('Processing failed', err)
+        finally:
+            if self.turn is task:
+                self.turn = None
+            self.is_processing = False
+            if self.turn_queued:
+                self.turn_queued = False
+                self.start_turn()
+
+    async def process_audio_buffer(self):
+        # Detach this turn's audio; audio arriving meanwhile belongs to the next turn
+        audio, self.audio = self.audio, array.array('h')
+        self.utterance_start = 0
+        self.worker.stats['turns'] += 1
+        timer, self.timer = self.timer or TurnTimer(self.worker.metrics), None
+        timer.mark('turn_start').span('queue', 'end_stream', 'turn_start')
+        # STT, the LLM call and the first clause's TTS share the turn budget, counted from end_stream
+        deadline = (timer.origin + timer.marks.get('end_stream', timer.marks['turn_start']) / 1000
+                    + self.options['turn_budget_ms'] / 1000)
+        wav_bytes = pcm.build_wav_bytes(memoryview(audio), SAMPLE_RATE)
+        timer.mark('wav_built').span('wav_build', 'turn_start', 'wav_built')
+        if self.debug:
+            await self.send({
+                'type': 'processing_debug',
+                'bytesLength': len(wav_bytes),
+                'samples': len(audio),
+                'sampleRate': SAMPLE_RATE,
+                'headBase64': base64.b64encode(wav_bytes[:64]).decode('ascii'),
+                'tailBase64': base64.b64encode(wav_bytes[-64:]).decode('ascii'),
+                'timestamp': now_ms(),
+            })
+
+        try:
+            result = await self.worker.scheduler.run(
+                STT_MODEL, lambda: self.worker.stt.transcribe(wav_bytes), timeout_s=STT_TIMEOUT_S, deadline=deadline,
+                hedge=self.options['hedge'], shape='object-audio-uint8', timer=timer)
+        except (AiError, asyncio.TimeoutError, TurnBudgetExhausted, asyncio.CancelledError) as err:
+            if isinstance(err, asyncio.CancelledError):
+                self.worker.metrics.turns['interrupted'] += 1
+                raise
+            self.worker.stats['stt_failures'] += 1
+            self.worker.metrics.turns['error'] += 1
+            # The worker tries every payload shape and reports only that they all failed, or that the
+            # budget ran out before the next one could be sent
+            spent = isinstance(err, TurnBudgetExhausted) or time.perf_counter() >= deadline
+            await self.error('Failed to process audio',
+                             TurnBudgetExhausted() if spent else 'All AI.run payload attempts failed')
+            return
+        timer.mark('stt_done').span('stt', 'wav_built', 'stt_done')
+
+        text = result.get('text') or result.get('transcript') or ''
+        await self.send({'type': 'transcription', 'text': text, **self.timings(timer), 'timestamp': now_ms()})
+        if not text.strip():
+            self.worker.metrics.turns['empty'] += 1
+            return
+        try:
+            spoken = await self.generate_response(text, timer, deadline)
+        except asyncio.CancelledError:
+            self.worker.metrics.turns['interrupted'] += 1
+            raise
+        self.worker.metrics.turns['ok' if spoken else 'error'] += 1
+
+    def timings(self, timer):
+        """The `timings` field of an outbound message, as a dict to merge in (empty without the option)."""
+        return {'timings': timer.to_json()} if self.options['timings'] and timer is not None else {}
+
+    async def generate_response(self, user_text, timer=None, deadline=None):
+        """Stream the reply: LLM tokens -> clauses -> TTS per clause, audio forwarded in clause order.
+
+        Returns whether the whole reply was sent.
+        """
+        reply = self.reply = {'user_text': user_text, 'clauses': [], 'clause_offsets': [], 'response_id': None,
+                              'encoding': None, 'started_at': 0, 'frames': 0, 'bytes_sent': 0, 'done': False,
+                              'timer': timer, 'deadline': deadline}
+        self.reply_task = asyncio.ensure_future(self._reply(reply))
+        try:
+            await asyncio.wait({self.reply_task})
+        finally:
+            self.reply_task.cancel()
+            # A finished reply stays until the next one: it can still be interrupted while it plays
+            if not reply['done'] and self.reply is reply:
+                self.reply = None
+        return reply['done']
+
+    async def _reply(self, reply):
+        timer = reply['timer']
+        chunks = self.speak_clauses(self.reply_clauses(reply['user_text'], timer, reply['deadline']), reply)
+        try:
+            if self.options['response_audio'] == 'json':
+                audio = b''.join([chunk async for chunk in chunks])
+                if audio:
+                    if timer is not None:
+                        timer.mark('first_audio').span('first_audio', 'end_stream', 'first_audio')
+                        timer.mark('audio_end').span('turn', 'end_stream', 'audio_end')
+                    await self.send({'type': 'response_audio', 'audio': list(audio), **self.timings(timer),
+                                     'timestamp': now_ms()})
+            else:
+                await self.stream_response_audio(chunks, reply)
+        except (AiError, RuntimeError) as err:
+            self.worker.stats['tts_failures'] += 1
+            await self.error('Failed to generate response', err)
+            return
+        finally:
+            await chunks.aclose()
+        reply['done'] = True
+        self.remember_turn(reply['user_text'], ' '.join(reply['clauses']))
+
+    def remember_turn(self, user_text, reply_text):
+        if reply_text:
+            self.history += [{'role': 'user', 'content': user_text}, {'role': 'assistant', 'content': reply_text}]
+            del self.history[:-2 * LLM_HISTORY_TURNS]
+
+    async def interrupt_turn(self, reason, client_played_ms=None):
+        """Barge-in, as interruptTurn in src/session.js: stop the reply (or a transcribing turn, or
+        account for a reply still playing) and report what was sent and played."""
+        reply, turn = self.reply, self.turn
+        stage = None
+        if reply is not None and not reply['done']:
+            stage = 'reply'
+        elif reason == 'client' and turn is not None:
+            stage = 'transcription'
+        elif reply is not None and reply_playing(reply):
+            stage = 'playback'
+        report = {'type': 'response_interrupted', 'reason': reason, 'stage': stage, 'response_id': None,
+                  'sent_ms': None, 'played_ms': None, 'clauses_generated': 0, 'heard_text': ''}
+        if stage is None:
+            if reason == 'client':
+                await self.send(dict(report, timestamp=now_ms()))
+            return False
+        if stage != 'playback':
+            self.turn = None
+            if self.reply_task is not None:
+                self.reply_task.cancel()
+            turn.cancel()
+        self.worker.stats['interruptions'] += 1
+
+        if stage != 'transcription':
+            self.reply = None
+            timed = reply['encoding'] == 'linear16'
+            sent_ms = audio_bytes_to_ms(reply['bytes_sent']) if timed else None
+            played_ms = None
+            if reply['response_id'] is not None and timed:
+                played_ms = min(sent_ms, client_played_ms if client_played_ms is not None
+                                else now_ms() - reply['started_at'])
+            heard = []
+            if reply['response_id'] is not None:
+                for clause, offset in zip(reply['clauses'], reply['clause_offsets']):
+                    if (audio_bytes_to_ms(offset) < played_ms) if played_ms is not None else offset < reply['bytes_sent']:
+                        heard.append(clause)
+            # A finished reply was remembered in full; keep only what was heard
+            if reply['done'] and self.history and self.history[-1]['content'] == ' '.join(reply['clauses']):
+                del self.history[-2:]
+            self.remember_turn(reply['user_text'], ' '.join(heard))
+            report.update(response_id=reply['response_id'], sent_ms=sent_ms, played_ms=played_ms,
+                          clauses_generated=len(reply['clauses']), heard_text=' '.join(heard))
+
+        if stage == 'reply' and reply['response_id'] is not None:
+            await self.send({'type': 'response_audio_end', 'response_id': reply['response_id'], 'frames': reply['frames'],
+                             'bytes': reply['bytes_sent'], 'interrupted': True, 'timestamp': now_ms()})
+        await self.send(dict(report, timestamp=now_ms()))
+        return True
+
+    async def reply_clauses(self, user_text, timer=None, deadline=None):
+        """Clauses of the reply as the LLM produces it; a canned reply if it fails before the first token."""
+        splitter = ClauseSplitter()
+        produced = False
+        history = list(self.history)
+        try:
+            tokens = await self.worker.scheduler.run(
+                LLM_MODEL, lambda: self.worker.llm.generate(user_text, history), timeout_s=LLM_TIMEOUT_S,
+                deadline=deadline, hedge=self.options['hedge'], shape='stream', timer=timer)
+            async for token in tokens:
+                if not produced and timer is not None:
+                    timer.mark('llm_first_token').span('llm_first_token', 'stt_done', 'llm_first_token')
+                produced = True
+                for clause in splitter.push(token):
+                    yield clause
+        except (AiError, asyncio.TimeoutError, TurnBudgetExhausted):
+            self.worker.stats['llm_failures'] += 1
+        if not produced:
+            for clause in splitter.push(self.worker.rng.choice(self.worker.responses)):
+                yield clause
+        for clause in splitter.flush():
+            yield clause
+
+    async def speak_clauses(self, clauses, reply):
+        """Audio chunks of the clauses in order; up to RESPONSE_TTS_AHEAD syntheses run ahead."""
+        spoken = reply['clauses']
+        slots = asyncio.Semaphore(RESPONSE_TTS_AHEAD)
+        queue = asyncio.Queue()  # TTS tasks in clause order, then None (or the producer's exception)
+
+        async def produce():
+            try:
+                async for clause in clauses:
+                    await slots.acquire()
+                    await self.send({'type': 'response_text_delta', 'text': clause, 'index': len(spoken),
+                                     'timestamp': now_ms()})
+                    spoken.append(clause)
+                    # Only the first clause's synthesis counts against the turn budget
+                    deadline = reply.get('deadline') if len(spoken) == 1 else None
+                    queue.put_nowait(asyncio.ensure_future(self.synthesize(clause, reply.get('timer'), deadline)))
+                await self.send({'type': 'response_text', 'text': ' '.join(spoken), 'clauses': len(spoken),
+                                 'timestamp': now_ms()})
+                queue.put_nowait(None)
+            except Exception as err:
+                queue.put_nowait(err)
+
+        producer = asyncio.ensure_future(produce())
+        offset = 0
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    if reply.get('timer') is not None:
+                        reply['timer'].mark('tts_done')
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                reply['clause_offsets'].append(offset)
+                async for chunk in await item:
+                    offset += len(chunk)
+                    yield chunk
+                slots.release()
+        finally:
+            producer.cancel()
+            while not queue.empty():
+                item = queue.get_nowait()
+                if isinstance(item, asyncio.Future):
+                    item.cancel()
+
+    async def synthesize(self, text, timer=None, deadline=None):
+        """TTS chunks of a clause; the fake's call returns at its first byte (tts_first_byte)."""
+        stages = self.worker.metrics.stages
+        started_at = time.perf_counter()
+        try:
+            chunks = await self.worker.scheduler.run(
+                TTS_MODEL, lambda: self.worker.tts.synthesize(text), timeout_s=TTS_TIMEOUT_S, deadline=deadline,
+                hedge=self.options['hedge'], shape='stream', timer=timer)
+        except asyncio.TimeoutError:
+            raise RuntimeError('AI.run timed out')
+        if timer is not None:
+            timer.mark('tts_first_byte')
+        stages.observe({'stage': 'tts_first_byte'}, (time.perf_counter() - started_at) * 1000)
+
+        async def timed():
+            async for chunk in chunks:
+                yield chunk
+            stages.observe({'stage': 'tts'}, (time.perf_counter() - started_at) * 1000)
+        return timed()
+
+    async def stream_response_audio(self, chunks, reply=None):
+        """response_audio_start, 0x02 frames (last one flagged final), response_audio_end.
+
+        `reply` records what went out, for interrupt_turn; its timer gets first_audio / audio_end.
+        """
+        reply = reply if reply is not None else {}
+        timer = reply.get('timer')
+        self.response_seq += 1
+        response_id = self.response_seq
+        seq = 0
+        total = 0
+        pending = None
+        started = False
+        async for chunk in chunks:
+            if not started:
+                started = True
+                reply.update(response_id=response_id, encoding='linear16', started_at=now_ms())
+                if timer is not None:
+                    timer.mark('first_audio').span('first_audio', 'end_stream', 'first_audio')
+                await self.send({'type': 'response_audio_start', 'response_id': response_id,
+                                 'encoding': 'linear16', 'sample_rate': TTS_SAMPLE_RATE, 'channels': 1,
+                                 'cached': False, **self.timings(timer), 'timestamp': reply['started_at']})
+            for pos in range(0, len(chunk), RESPONSE_AUDIO_MAX_PAYLOAD):
+                if pending is not None:
+                    seq += 1
+                    total += len(pending)
+                    reply.update(frames=seq, bytes_sent=total)
+                    await self.send(response_audio_frame(seq - 1, pending, False))
+                pending = chunk[pos:pos + RESPONSE_AUDIO_MAX_PAYLOAD]
+        if not started:
+            return
+        pending = pending or b''
+        await self.send(response_audio_frame(seq, pending, True))
+        seq += 1
+        total += len(pending)
+        if timer is not None:
+            timer.mark('audio_end').span('turn', 'end_stream', 'audio_end')
+        await self.send({'type': 'response_audio_end', 'response_id': response_id, 'frames': seq,
+                         'bytes': total, **self.timings(timer), 'timestamp': now_ms()})
+
+    async def attach(self, ws):
+        """Move the session to a reconnected socket; replies of a running turn follow it."""
+        old, self.ws = self.ws, ws
+        self.detached_at = None
+        self.acks.reset()
+        if old is not None and old is not ws:
+            with contextlib.suppress(Exception):
+                await old.close(4000, 'Replaced by a newer connection')
+
+    def close(self):
+        if self.reply_task is not None:
+            self.reply_task.cancel()
+        for task in list(self.tasks):
+            task.cancel()
+
+
+class SessionStore:
+    """In-process stand-in for the CallSession Durable Object (src/call_session.js).
+
+    Sessions outlive their socket for resume_window_s, so a reconnect with the
+    same ?session_id= finds the buffered audio, options and counters; work
+    still running for the call keeps going and replies to the new socket.
+    """
+
+    def __init__(self, resume_window_s=RESUME_WINDOW_S):
+        self.resume_window_s = resume_window_s
+        self.sessions = {}
+
+    def get(self, session_id):
+        self.purge()
+        return self.sessions.get(session_id)
+
+    def put(self, session):
+        self.purge()
+        self.sessions[session.id] = session
+
+    def detach(self, session):
+        session.detached_at = time.monotonic()
+
+    def connected(self):
+        return sum(1 for s in self.sessions.values() if s.detached_at is None)
+
+    def purge(self):
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            if session.detached_at is not None and now - session.detached_at >= self.resume_window_s:
+                session.close()
+                del self.sessions[session_id]
+
+
+def audio_bytes_to_ms(n):
+    return round(n / 2 * 1000 / TTS_SAMPLE_RATE)
+
+
+def reply_playing(reply):
+    """Whether the client is presumably still playing a reply whose audio has all been sent."""
+    return (reply['encoding'] == 'linear16' and reply['response_id'] is not None
+            and now_ms() - reply['started_at'] < audio_bytes_to_ms(reply['bytes_sent']))
+
+
+def response_audio_frame(seq, payload, final):
+    flags = frames.RESPONSE_AUDIO_FLAG_FINAL if final else 0
+    return struct.pack('<BBI', frames.FRAME_RESPONSE_AUDIO, flags, seq) + bytes(payload)
+
+
+class LocalWorker:
+    """The server: one Session per connection, shared fake backends and counters."""
+
+    def __init__(self, stt=None, tts=None, idle_timeout_s=IDLE_TIMEOUT_S, responses=RESPONSES, seed=None,
+                 resume_window_s=RESUME_WINDOW_S, llm=None):
+        self.stt = stt or FakeStt()
+        self.llm = llm or FakeLlm(seed=seed)
+        self.tts = tts or FakeTts()
+        self.idle_timeout_s = idle_timeout_s
+        self.responses = responses
+        self.rng = random.Random(seed)
+        self.store = SessionStore(resume_window_s)
+        self.stats = collections.Counter()
+        self.metrics = Metrics()
+        self.scheduler = AiScheduler(self.metrics)
+
+    async def handler(self, ws, path=None):
+        # websockets >= 10.1 passes only the connection; older releases also pass the path
+        if path is None:
+            request = getattr(ws, 'request', None)
+            path = request.path if request is not None else getattr(ws, 'path', '/')
+        session_id = parse_qs(urlsplit(path).query).get('session_id', [None])[0]
+        if session_id is not None and not SESSION_ID_RE.match(session_id):
+            await ws.close(1008, 'Invalid session_id')
+            return
+
+        session = self.store.get(session_id) if session_id else None
+        if session is not None:
+            await session.attach(ws)
+            self.stats['resumed_sessions'] += 1
+            await session.send({'type': 'session_resumed', 'session_id': session.id, 'buffer_size': len(session.audio),
+                                'response_seq': session.response_seq, 'stream': session.stream.describe(),
+                                'timestamp': now_ms()})
+        else:
+            try:
+                session = Session(self, ws, path, session_id)
+            except ValueError as err:
+                await ws.close(1008, str(err))
+                return
+            self.store.put(session)
+            self.stats['sessions'] += 1
+            if session.decoder_rejected is not None:
+                await session.session_configured(session.decoder_rejected)
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(ws.recv(), self.idle_timeout_s)
+                except asyncio.TimeoutError:
+                    await session.send({'type': 'session_closed', 'reason': 'idle_timeout'})
+                    await ws.close()
+                    break
+                self.stats['messages'] += 1
+                await session.handle(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            if session.ws is ws:
+                self.store.detach(session)
+
+    def health(self):
+        return {
+            'status': 'healthy',
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'version': 'local',
+            'active_sessions': self.store.connected(),
+            'stored_sessions': len(self.store.sessions),
+            'stats': dict(self.stats),
+            'stt': self.stt.stats(),
+            'llm': self.llm.stats(),
+            'tts': self.tts.stats(),
+            'ai_scheduler': self.scheduler.stats(),
+        }
+
+    def http_response(self, path):
+        """(content type, body) for GET /health and GET /metrics; None for anything else."""
+        route = path.split('?')[0]
+        if route == '/health':
+            return 'application/json', json.dumps(self.health())
+        if route == '/metrics':
+            return 'text/plain; version=0.0.4; charset=utf-8', self.metrics.render()
+        return None
+
+    def process_request(self, *args):
+        """Answer GET /health and /metrics over plain HTTP; everything else proceeds to the WebSocket handshake."""
+        if len(args) == 2 and hasattr(args[1], 'headers'):
+            # websockets >= 13: (connection, request)
+            connection, request = args
+            answer = self.http_response(request.path)
+            if answer is None:
+                return None
+            response = connection.respond(200, answer[1])
+            response.headers['Content-Type'] = answer[0]
+            return response
+        path, _headers = args
+        answer = self.http_response(path)
+        if answer is None:
+            return None
+        return 200, [('Content-Type', answer[0])], answer[1].encode()
+
+    async def transcribe_stt(self, wav_bytes, hedge=False):
+        """One POST /transcribe segment through FakeStt at 'batch' priority, measured like a turn's STT call."""
+        try:
+            return await self.scheduler.run(STT_MODEL, lambda: self.stt.transcribe(wav_bytes), priority='batch',
+                                            timeout_s=STT_TIMEOUT_S, hedge=hedge, shape='object-audio-uint8')
+        except (AiError, asyncio.TimeoutError) as err:
+            self.stats['stt_failures'] += 1
+            raise RuntimeError('All AI.run payload attempts failed') from err
+
+    async def handle_http(self, reader, writer):
+        """POST /transcribe over HTTP/1.1 (Content-Length or chunked body, streamed into batch.py)."""
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                return
+            method, target = request_line[0], request_line[1]
+            route = urlsplit(target)
+            if method != 'POST' or route.path != '/transcribe':
+                status, reply = 404, {'error': f"{method} {route.path} not found (POST /transcribe)"}
+            else:
+                params = dict(parse_qsl(route.query))
+                status, reply = await batch.transcribe_body(self.http_body(reader, headers), params, self.transcribe_stt)
+                self.stats['batch_requests'] += 1
+            body = json.dumps(reply).encode()
+            writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                         f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def http_body(reader, headers):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    return
+                yield await reader.readexactly(size)
+                await reader.readline()
+        remaining = int(headers.get('content-length', 0))
+        while remaining > 0:
+            data = await reader.read(min(remaining, 64 * 1024))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+    async def serve_http(self, host='127.0.0.1', port=8788):
+        return await asyncio.start_server(self.handle_http, host, port)
+
+    async def serve(self, host='127.0.0.1', port=8787):
+        return await websockets.serve(self.handler, host, port, process_request=self.process_request,
+                                      max_size=None)
+
+    @contextlib.asynccontextmanager
+    async def serving(self, host='127.0.0.1', port=0):
+        """Run the server for the duration of the block; yields its ws:// URL (port 0 picks a free port)."""
+        server = await self.serve(host, port)
+        try:
+            bound = list(server.sockets)[0].getsockname()
+            yield f"ws://{host}:{bound[1]}"
+        finally:
+            server.close()
+            await server.wait_closed()
+
+
+async def run(args):
+    worker = LocalWorker(
+        stt=FakeStt(transcript=args.transcript, latency_ms=args.stt_latency_ms, jitter_ms=args.stt_jitter_ms,
+                    failure_rate=args.stt_failure_rate, fail_code=args.fail_code, seed=args.seed),
+        llm=FakeLlm(reply=args.reply, latency_ms=args.llm_latency_ms, token_ms=args.llm_token_ms,
+                    failure_rate=args.llm_failure_rate, fail_code=args.fail_code, seed=args.seed),
+        tts=FakeTts(latency_ms=args.tts_latency_ms, jitter_ms=args.tts_jitter_ms,
+                    failure_rate=args.tts_failure_rate, fail_code=args.fail_code, seed=args.seed),
+        idle_timeout_s=args.idle_timeout_s,
+        resume_window_s=args.resume_window_s,
+        seed=args.seed,
+    )
+    server = await worker.serve(args.host, args.port)
+    http_port = args.http_port if args.http_port is not None else args.port + 1
+    http_server = await worker.serve_http(args.host, http_port)
+    print(f"Local worker listening on ws://{args.host}:{args.port} (GET /health for counters, /metrics for latencies)")
+    print(f"POST /transcribe on http://{args.host}:{http_port}")
+    try:
+        await asyncio.Future()
+    finally:
+        server.close()
+        http_server.close()
+        print("Stats:", json.dumps(worker.health()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the worker with fake STT/TTS backends')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--http-port', type=int, help='plain HTTP port for POST /transcribe (default --port + 1)')
+    parser.add_argument('--stt-latency-ms', type=float, default=300)
+    parser.add_argument('--stt-jitter-ms', type=float, default=0)
+    parser.add_argument('--stt-failure-rate', type=float, default=0.0)
+    parser.add_argument('--llm-latency-ms', type=float, default=200, help='time to first LLM token')
+    parser.add_argument('--llm-token-ms', type=float, default=30, help='time between LLM tokens')
+    parser.add_argument('--llm-failure-rate', type=float, default=0.0, help='failed LLM calls fall back to canned replies')
+    parser.add_argument('--tts-latency-ms', type=float, default=150, help='time to first TTS byte')
+    parser.add_argument('--tts-jitter-ms', type=float, default=0)
+    parser.add_argument('--tts-failure-rate', type=float, default=0.0)
+    parser.add_argument('--fail-code', type=int, default=3010, help='AiError code for injected failures')
+    parser.add_argument('--transcript', help='fixed STT text (default names the audio duration)')
+    parser.add_argument('--reply', help='fixed LLM reply (default picks a canned response)')
+    parser.add_argument('--idle-timeout-s', type=float, default=IDLE_TIMEOUT_S)
+    parser.add_argument('--resume-window-s', type=float, default=RESUME_WINDOW_S,
+                        help='how long a disconnected session can be resumed by session_id')
+    parser.add_argument('--seed', type=int, help='seed for jitter, failures and canned responses')
+    args = parser.parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
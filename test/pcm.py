@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Shared 16-bit PCM helpers for the test clients.
+
+WAV files are loaded once into an `array('h')` (or a NumPy int16 array when
+NumPy is installed and requested) and exposed as a `memoryview`, so chunking a
+long recording is just slicing a view: no per-sample Python lists and no
+`bytes +=` loops. Stereo input is reduced with stride views.
+
+Usage as a script (prints load timing):
+  python3 pcm.py path/to/file.wav [--numpy]
+"""
+
+import array
+import math
+import operator
+import struct
+import sys
+import time
+import wave
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; array('h') covers every client
+    np = None
+
+SAMPLE_RATE = 16000
+BIG_ENDIAN = sys.byteorder == 'big'
+
+
+def samples_from_bytes(raw, use_numpy=False):
+    """Wrap little-endian int16 PCM bytes as a sample buffer (one copy, no unpacking)."""
+    if use_numpy:
+        if np is None:
+            raise RuntimeError('NumPy is not installed')
+        return np.frombuffer(raw, dtype='<i2')
+    samples = array.array('h')
+    samples.frombytes(raw)
+    if BIG_ENDIAN:
+        samples.byteswap()
+    return memoryview(samples)
+
+
+def channel_view(samples, channels, channel=0):
+    """Zero-copy stride view of one channel of interleaved samples."""
+    if channels == 1:
+        return samples
+    return samples[channel::channels]
+
+
+def downmix(samples, channels):
+    """Average interleaved channels into mono (walks stride views, one output buffer)."""
+    if channels == 1:
+        return samples
+    if np is not None and isinstance(samples, np.ndarray):
+        acc = samples[0::channels].astype(np.int32)
+        for ch in range(1, channels):
+            acc += samples[ch::channels]
+        return (acc // channels).astype(np.int16)
+    # Channel sums through chained C-level maps over stride slices: no per-frame Python code
+    flat = memoryview(samples).cast('B').cast('h')
+    total = flat[0::channels]
+    for ch in range(1, channels):
+        total = map(operator.add, total, flat[ch::channels])
+    return memoryview(array.array('h', map(channels.__rfloordiv__, total)))
+
+
+def read_wav(path, use_numpy=False, mix=False, channel=0):
+    """Read a 16-bit PCM WAV file.
+
+    Returns (samples, sample_rate) where samples is a 1-D memoryview of
+    format 'h' (or an int16 ndarray with use_numpy=True). Multi-channel files
+    are reduced to `channel` via a stride view, or averaged with mix=True.
+    """
+    with wave.open(path, 'rb') as wf:
+        channels = wf.getnchannels()
+        sampwidth = wf.getsampwidth()
+        framerate = wf.getframerate()
+        raw = wf.readframes(wf.getnframes())
+
+    if sampwidth != 2:
+        raise RuntimeError(f"Unsupported sample width: {sampwidth*8} bits - only 16-bit supported")
+
+    samples = samples_from_bytes(raw, use_numpy=use_numpy)
+    if mix:
+        return downmix(samples, channels), framerate
+    return channel_view(samples, channels, channel), framerate
+
+
+def iter_chunks(samples, chunk_samples):
+    """Yield consecutive chunk views of at most chunk_samples samples (no copies)."""
+    for pos in range(0, len(samples), chunk_samples):
+        yield samples[pos:pos + chunk_samples]
+
+
+def pcm_bytes(samples):
+    """Little-endian int16 bytes for a sample buffer or view."""
+    if np is not None and isinstance(samples, np.ndarray):
+        return samples.astype('<i2', copy=False).tobytes()
+    if BIG_ENDIAN:
+        swapped = array.array('h', samples)
+        swapped.byteswap()
+        return swapped.tobytes()
+    return samples.tobytes()
+
+
+def to_list(samples):
+    """Plain list of ints (only for the legacy JSON transport)."""
+    return samples.tolist()
+
+
+def generate_sine(duration_s=1.0, freq=440, sample_rate=SAMPLE_RATE, amplitude=0.2):
+    total = int(duration_s * sample_rate)
+    step = 2 * math.pi * freq / sample_rate
+    peak = 32767 * amplitude
+    samples = array.array('h', (int(peak * math.sin(step * n)) for n in range(total)))
+    return memoryview(samples), sample_rate
+
+
+def build_wav_bytes(samples, sample_rate=SAMPLE_RATE, num_channels=1, bits_per_sample=16):
+    pcm = pcm_bytes(samples)
+    return wav_header(len(pcm), sample_rate, num_channels, bits_per_sample) + pcm
+
+
+def wav_header(data_size, sample_rate=SAMPLE_RATE, num_channels=1, bits_per_sample=16):
+    block_align = num_channels * bits_per_sample // 8
+    byte_rate = sample_rate * block_align
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, num_channels,
+                       sample_rate, byte_rate, block_align, bits_per_sample, b'data', data_size)
+
+
+class WavStreamWriter:
+    """Append 16-bit PCM to a WAV file as it arrives.
+
+    The header sizes are patched after every write, so the file on disk is
+    playable at any point during the stream. Odd trailing bytes are held
+    until the next write.
+    """
+
+    def __init__(self, path, sample_rate=SAMPLE_RATE, num_channels=1):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.num_channels = num_channels
+        self.data_size = 0
+        self._odd = b''
+        self._f = open(path, 'wb')
+        self._f.write(wav_header(0, sample_rate, num_channels))
+
+    def write(self, data):
+        data = self._odd + bytes(data)
+        usable = len(data) - len(data) % 2
+        self._odd = data[usable:]
+        if usable:
+            self._f.write(data[:usable])
+            self.data_size += usable
+            self._patch_header()
+
+    def _patch_header(self):
+        end = self._f.tell()
+        self._f.seek(0)
+        self._f.write(wav_header(self.data_size, self.sample_rate, self.num_channels))
+        self._f.seek(end)
+        self._f.flush()
+
+    @property
+    def duration_s(self):
+        return self.data_size / (2 * self.num_channels * self.sample_rate)
+
+    def close(self):
+        if not self._f.closed:
+            self._patch_header()
+            self._f.close()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', help='Path to WAV file (16-bit PCM)')
+    parser.add_argument('--numpy', action='store_true', help='load into a NumPy int16 array')
+    parser.add_argument('--chunk-samples', type=int, default=1600)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    samples, sr = read_wav(args.file, use_numpy=args.numpy)
+    loaded = time.perf_counter()
+    chunks = sum(1 for _ in iter_chunks(samples, args.chunk_samples))
+    done = time.perf_counter()
+    print(f"Loaded {len(samples)} samples at {sr} Hz in {(loaded - start)*1000:.2f} ms; "
+          f"sliced {chunks} chunks in {(done - loaded)*1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+"""
+Record whole WebSocket sessions and replay them against a worker.
+
+Usage:
+  python3 session_log.py record [--listen 127.0.0.1:8790] [--upstream wss://...] [--out-dir session_logs]
+  python3 session_log.py show call.wslog [--frames]
+  python3 session_log.py replay call.wslog [--url ws://127.0.0.1:8787] [--speed 1|4|0] [--out replay.wslog]
+  python3 session_log.py diff call.wslog replay.wslog
+
+record runs a pass-through proxy: point a client (a phone gateway, stream_audio.py)
+at ws://<listen>/?... instead of the worker and every connection is written to
+its own log, both directions, as the raw messages. StreamingClient(session_log=
+SessionLogWriter(path)) and stream_audio.py --session-log record a test client's
+session without the proxy.
+
+replay re-sends the client side of a log to --url (the deployed worker by
+default, or the local stand-in) and diffs what comes back with what was
+recorded. --speed 1 keeps the recorded pacing, N plays N times faster, 0 sends
+as fast as possible. Each client message is anchored to the last reply it
+followed in the recording (an interrupt sent 300 ms after response_audio_start
+waits for the replayed response_audio_start), so faster replays keep the
+conversation's order. The replay gets a fresh session_id so it never resumes
+the recorded call. The exit status is 1 when the replies differ, so an
+incident log (an intermittent 3010, a stuck turn) becomes a regression test.
+
+Log format (little-endian, append-only, a truncated tail is ignored):
+  header   b'WSLG', uint8 version, uint32 meta length, meta JSON (url, recorded_at, source)
+  record   uint8 kind, uint64 microseconds since the header (monotonic clock),
+           uint32 payload length, payload
+Kinds: 0x01 / 0x02 client text / binary message, 0x11 / 0x12 worker text /
+binary message, 0x21 close (payload JSON {"side", "code", "reason"}). Text
+payloads are the UTF-8 JSON as sent; binary payloads are the frames as sent.
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import difflib
+import json
+import os
+import struct
+import sys
+import time
+import uuid
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import websockets
+
+import endpoints
+import frames
+
+MAGIC = b'WSLG'
+VERSION = 1
+
+KIND_OUT_TEXT = 0x01
+KIND_OUT_BINARY = 0x02
+KIND_IN_TEXT = 0x11
+KIND_IN_BINARY = 0x12
+KIND_CLOSE = 0x21
+
+_HEADER = struct.Struct('<4sBI')
+_RECORD = struct.Struct('<BQI')
+
+# Fields that differ between runs of the same conversation; ignored by diff
+VOLATILE_FIELDS = ('timestamp', 'timings', 'session_id')
+# Replies a client message can wait for; acks and audio frames are too fine-grained to anchor on
+NO_ANCHOR_TYPES = ('chunk_received',)
+# Replies whose latency (ms after the end_stream before them) the replay report compares
+MILESTONE_TYPES = ('transcription', 'response_audio_start', 'response_audio_end', 'response_audio',
+                   'response_interrupted', 'error')
+
+Record = collections.namedtuple('Record', 't_s kind data')
+
+
+def direction(kind):
+    return {0x00: 'out', 0x10: 'in'}.get(kind & 0xF0, 'close')
+
+
+def is_text(kind):
+    return kind & 0x0F == 0x01 and kind != KIND_CLOSE
+
+
+class SessionLogWriter:
+    """Append-only session log; record() is cheap enough to call for every message."""
+
+    def __init__(self, path, meta=None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.meta = dict(meta or {}, recorded_at=datetime.datetime.now(datetime.timezone.utc).isoformat())
+        self.records = 0
+        self._t0 = time.monotonic_ns()
+        self._file = open(path, 'wb')
+        meta_bytes = json.dumps(self.meta).encode()
+        self._file.write(_HEADER.pack(MAGIC, VERSION, len(meta_bytes)) + meta_bytes)
+        self._file.flush()
+
+    def record(self, side, data):
+        """Log one message: side 'out' (client -> worker) or 'in' (worker -> client), str or bytes."""
+        if self._file is None:
+            return
+        if isinstance(data, str):
+            kind = KIND_OUT_TEXT if side == 'out' else KIND_IN_TEXT
+            data = data.encode()
+        else:
+            kind = KIND_OUT_BINARY if side == 'out' else KIND_IN_BINARY
+        self._write(kind, bytes(data))
+
+    def record_close(self, side, code=None, reason=''):
+        self._write(KIND_CLOSE, json.dumps({'side': side, 'code': code, 'reason': reason}).encode())
+
+    def _write(self, kind, payload):
+        if self._file is None:
+            return
+        t_us = (time.monotonic_ns() - self._t0) // 1000
+        self._file.write(_RECORD.pack(kind, t_us, len(payload)) + payload)
+        self._file.flush()
+        self.records += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_log(path):
+    """(meta, [Record]) of a session log; a record cut short by a crash ends the list."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        raise ValueError(f"{path}: not a session log (too short)")
+    magic, version, meta_len = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{path}: not a session log (magic {magic!r})")
+    if version != VERSION:
+        raise ValueError(f"{path}: unsupported session log version {version}")
+    offset = _HEADER.size + meta_len
+    meta = json.loads(data[_HEADER.size:offset])
+    records = []
+    while offset + _RECORD.size <= len(data):
+        kind, t_us, length = _RECORD.unpack_from(data, offset)
+        start = offset + _RECORD.size
+        if start + length > len(data):
+            break
+        payload = data[start:start + length]
+        records.append(Record(t_us / 1e6, kind, payload.decode() if is_text(kind) or kind == KIND_CLOSE else payload))
+        offset = start + length
+    return meta, records
+
+
+# -- describing messages ----------------------------------------------------
+
+def parse_text(text):
+    try:
+        message = json.loads(text)
+    except ValueError:
+        return {'type': None, 'raw': text}
+    return message if isinstance(message, dict) else {'type': None, 'raw': text}
+
+
+def record_type(record):
+    """Message type of a record: the JSON type, or a name for the binary frame kind."""
+    if record.kind == KIND_CLOSE:
+        return 'close'
+    if is_text(record.kind):
+        return parse_text(record.data).get('type')
+    names = {frames.FRAME_AUDIO: 'audio', frames.FRAME_OPUS: 'opus_audio',
+             frames.FRAME_SEQ_AUDIO: 'sequenced_audio', frames.FRAME_BULK_AUDIO: 'bulk_audio',
+             frames.FRAME_RESPONSE_AUDIO: 'response_audio_frame', frames.FRAME_ACK: 'chunk_received'}
+    return names.get(record.data[0], 'binary') if record.data else 'binary'
+
+
+def describe(record, width=160):
+    if record.kind == KIND_CLOSE or is_text(record.kind):
+        text = record.data
+        return text if len(text) <= width else text[:width - 3] + '...'
+    return f"<{record_type(record)} {len(record.data)} bytes>"
+
+
+def reply_lines(records, ignore=VOLATILE_FIELDS):
+    """The worker side of a session as comparable lines: JSON replies without volatile fields,
+    runs of response audio frames collapsed into one line, acks counted at the end."""
+    lines = []
+    acks = 0
+    frame_run = None  # [frames, bytes]
+    for record in records:
+        if direction(record.kind) != 'in':
+            continue
+        if not is_text(record.kind) and record_type(record) == 'chunk_received':
+            acks += 1
+            continue
+        if not is_text(record.kind):
+            if frame_run is None:
+                frame_run = [0, 0]
+                lines.append(frame_run)
+            frame_run[0] += 1
+            frame_run[1] += len(record.data)
+            continue
+        frame_run = None
+        message = parse_text(record.data)
+        if message.get('type') == 'chunk_received':
+            acks += 1
+            continue
+        lines.append(json.dumps({k: v for k, v in message.items() if k not in ignore}, sort_keys=True))
+    lines = [line if isinstance(line, str) else f"<response audio: {line[0]} frames, {line[1]} bytes>"
+             for line in lines]
+    lines.append(f"<chunk_received x {acks}>")
+    return lines
+
+
+def diff_replies(expected, actual, ignore=VOLATILE_FIELDS, labels=('recorded', 'replayed')):
+    """Unified diff of two sessions' replies; empty when they match."""
+    return list(difflib.unified_diff(reply_lines(expected, ignore), reply_lines(actual, ignore),
+                                     labels[0], labels[1], lineterm='', n=2))
+
+
+def milestones(records):
+    """[(type, ms after the preceding end_stream)] for the replies in MILESTONE_TYPES."""
+    result = []
+    anchor = records[0].t_s if records else 0.0
+    for record in records:
+        msg_type = record_type(record)
+        if direction(record.kind) == 'out' and msg_type == 'end_stream':
+            anchor = record.t_s
+        elif direction(record.kind) == 'in' and msg_type in MILESTONE_TYPES:
+            result.append((msg_type, (record.t_s - anchor) * 1000))
+    return result
+
+
+def print_milestones(recorded, replayed):
+    expected, actual = milestones(recorded), milestones(replayed)
+    if not expected and not actual:
+        return
+    print(f"\n{'reply':<24} {'recorded ms':>12} {'replayed ms':>12} {'delta':>8}")
+    for i in range(max(len(expected), len(actual))):
+        name = (expected[i] if i < len(expected) else actual[i])[0]
+        a = expected[i][1] if i < len(expected) else None
+        b = actual[i][1] if i < len(actual) else None
+        delta = f"{b - a:+8.0f}" if a is not None and b is not None else f"{'-':>8}"
+        print(f"{name:<24} {'-' if a is None else f'{a:.0f}':>12} {'-' if b is None else f'{b:.0f}':>12} {delta}")
+
+
+# -- replay -----------------------------------------------------------------
+
+def replay_url(recorded_url, target=None, session_id=None):
+    """The recorded URL's path and query on `target`, with a fresh session_id."""
+    parts = urlsplit(recorded_url or '')
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k != 'session_id']
+    query.append(('session_id', session_id or f"replay-{uuid.uuid4().hex[:12]}"))
+    base = urlsplit(target or recorded_url or endpoints.worker_url())
+    return urlunsplit((base.scheme, base.netloc, parts.path or base.path or '/', urlencode(query), ''))
+
+
+def client_schedule(records):
+    """[(record, anchor)] for the client messages; anchor = (reply type, occurrence, seconds after it)
+    of the last anchorable reply before the message in the recording, or None."""
+    schedule = []
+    seen = collections.Counter()
+    last = None  # (type, occurrence, t_s)
+    for record in records:
+        side = direction(record.kind)
+        if side == 'in' and is_text(record.kind):
+            msg_type = record_type(record)
+            if msg_type not in NO_ANCHOR_TYPES:
+                seen[msg_type] += 1
+                last = (msg_type, seen[msg_type], record.t_s)
+        elif side == 'out':
+            anchor = (last[0], last[1], record.t_s - last[2]) if last else None
+            schedule.append((record, anchor))
+    return schedule
+
+
+async def replay(records, url, speed=1.0, idle_s=2.0, timeout_s=60.0, anchor_timeout_s=10.0, log=None):
+    """Re-send the client side of `records` to url; returns the replayed session as Records
+    (client and worker messages, times from the start of the replay)."""
+    replayed = []
+    t0 = time.monotonic()
+    received = collections.Counter()
+    reply_times = {}  # (type, occurrence) -> monotonic time
+    changed = asyncio.Event()
+    stats = collections.Counter()
+
+    def add(kind, data):
+        replayed.append(Record(time.monotonic() - t0, kind, data))
+        if log is not None:
+            log.record(direction(kind), data)
+
+    async with websockets.connect(url, ssl=endpoints.ssl_context_for(url), max_size=None) as ws:
+        async def receive():
+            try:
+                async for raw in ws:
+                    add(KIND_IN_TEXT if isinstance(raw, str) else KIND_IN_BINARY, raw)
+                    if isinstance(raw, str):
+                        msg_type = parse_text(raw).get('type')
+                        received[msg_type] += 1
+                        reply_times[(msg_type, received[msg_type])] = time.monotonic()
+                    changed.set()
+            except websockets.exceptions.ConnectionClosed:
+                pass
+            finally:
+                changed.set()
+
+        receiver = asyncio.ensure_future(receive())
+        try:
+            for record, anchor in client_schedule(records):
+                if anchor is None:
+                    due = t0 + record.t_s / speed if speed else 0
+                else:
+                    key = anchor[:2]
+                    deadline = time.monotonic() + anchor_timeout_s
+                    while key not in reply_times and not receiver.done() and time.monotonic() < deadline:
+                        changed.clear()
+                        try:
+                            await asyncio.wait_for(changed.wait(), deadline - time.monotonic())
+                        except asyncio.TimeoutError:
+                            break
+                    if key not in reply_times:
+                        stats['missed_anchors'] += 1
+                        print(f"replay: no {key[0]} #{key[1]} within {anchor_timeout_s}s; sending on",
+                              file=sys.stderr)
+                        due = 0
+                    else:
+                        due = reply_times[key] + anchor[2] / speed if speed else 0
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if receiver.done():
+                    stats['unsent'] += 1
+                    continue
+                add(record.kind, record.data)
+                await ws.send(record.data)
+            # Let the worker finish: stop once it has been quiet for idle_s
+            end = time.monotonic() + timeout_s
+            while not receiver.done() and time.monotonic() < end:
+                count = len(replayed)
+                await asyncio.sleep(idle_s)
+                if len(replayed) == count:
+                    break
+        finally:
+            receiver.cancel()
+    if stats:
+        print(f"replay: {dict(stats)}", file=sys.stderr)
+    return replayed
+
+
+# -- record (pass-through proxy) --------------------------------------------
+
+class RecordingProxy:
+    """Forward WebSocket connections to upstream, logging every message of each to its own file."""
+
+    def __init__(self, upstream, out_dir):
+        self.upstream = upstream.rstrip('/')
+        self.out_dir = out_dir
+        self.sessions = 0
+
+    def log_path(self, path):
+        session_id = dict(parse_qsl(urlsplit(path).query)).get('session_id', '')
+        stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+        name = stamp + (f"-{session_id}" if session_id.replace('-', '').replace('_', '').isalnum() else '')
+        return os.path.join(self.out_dir, name + '.wslog')
+
+    async def handler(self, client, path=None):
+        # websockets >= 10.1 passes only the connection; older releases also pass the path
+        if path is None:
+            request = getattr(client, 'request', None)
+            path = request.path if request is not None else getattr(client, 'path', '/')
+        url = self.upstream + path
+        self.sessions += 1
+        log_path = self.log_path(path)
+        print(f"session {self.sessions}: {path} -> {log_path}")
+        with SessionLogWriter(log_path, {'url': url, 'source': 'proxy'}) as log:
+            try:
+                upstream = await websockets.connect(url, ssl=endpoints.ssl_context_for(url), max_size=None)
+            except Exception as err:
+                log.record_close('upstream', None, f"connect failed: {err}")
+                await client.close(1011, 'upstream unavailable')
+                return
+
+            async def pump(source, sink, side, name):
+                try:
+                    async for message in source:
+                        log.record(side, message)
+                        await sink.send(message)
+                except websockets.exceptions.ConnectionClosed:
+                    pass
+                log.record_close(name, getattr(source, 'close_code', None), getattr(source, 'close_reason', '') or '')
+                await sink.close()
+
+            await asyncio.gather(pump(client, upstream, 'out', 'client'), pump(upstream, client, 'in', 'worker'))
+        print(f"session {self.sessions}: {log.records} messages logged")
+
+    async def serve(self, host, port):
+        return await websockets.serve(self.handler, host, port, max_size=None)
+
+
+# -- commands ---------------------------------------------------------------
+
+def show(path, include_frames=False):
+    meta, records = read_log(path)
+    print(json.dumps(meta))
+    counts = collections.Counter()
+    byte_counts = collections.Counter()
+    for record in records:
+        side, msg_type = direction(record.kind), record_type(record)
+        counts[(side, msg_type)] += 1
+        byte_counts[side] += len(record.data)
+        binary = not is_text(record.kind) and record.kind != KIND_CLOSE
+        if include_frames or not (binary or msg_type == 'chunk_received'):
+            print(f"{record.t_s:10.3f}s  {side:<5} {describe(record)}")
+    duration = records[-1].t_s if records else 0.0
+    print(f"\n{len(records)} records over {duration:.1f}s; "
+          f"client {byte_counts['out']} bytes, worker {byte_counts['in']} bytes")
+    for (side, msg_type), n in sorted(counts.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+        print(f"  {side:<5} {msg_type or '?':<24} {n}")
+
+
+async def run_record(args):
+    host, _, port = args.listen.rpartition(':')
+    proxy = RecordingProxy(args.upstream, args.out_dir)
+    server = await proxy.serve(host or '127.0.0.1', int(port))
+    print(f"Recording proxy on ws://{host or '127.0.0.1'}:{port} -> {proxy.upstream}, logs in {args.out_dir}")
+    try:
+        await asyncio.Future()
+    finally:
+        server.close()
+
+
+def run_replay(args):
+    meta, records = read_log(args.log)
+    url = replay_url(meta.get('url'), args.url, args.session_id)
+    speed = 'as fast as possible' if args.speed == 0 else f"{args.speed:g}x"
+    print(f"Replaying {args.log} ({len(records)} records) to {url} at {speed}")
+    log = SessionLogWriter(args.out, {'url': url, 'source': 'replay', 'replay_of': args.log}) if args.out else None
+    try:
+        replayed = asyncio.run(replay(records, url, speed=args.speed, idle_s=args.idle_s, timeout_s=args.timeout_s,
+                                      anchor_timeout_s=args.anchor_timeout_s, log=log))
+    finally:
+        if log is not None:
+            log.close()
+    print_milestones(records, replayed)
+    return report_diff(records, replayed, args.ignore, (args.log, 'replay'))
+
+
+def report_diff(expected, actual, ignore, labels):
+    diff = diff_replies(expected, actual, tuple(VOLATILE_FIELDS) + tuple(ignore or ()), labels)
+    if diff:
+        print("\nReplies differ:")
+        print('\n'.join(diff))
+        return 1
+    print("\nReplies match")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    record = sub.add_parser('record', help='pass-through proxy that logs every session')
+    record.add_argument('--listen', default='127.0.0.1:8790', help='host:port clients connect to')
+    record.add_argument('--upstream', default=endpoints.worker_url(), help='worker WebSocket URL')
+    record.add_argument('--out-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'session_logs'))
+
+    show_cmd = sub.add_parser('show', help='print a session log')
+    show_cmd.add_argument('log')
+    show_cmd.add_argument('--frames', action='store_true', help='also list binary frames and acks')
+
+    replay_cmd = sub.add_parser('replay', help='re-drive a session and diff the replies')
+    replay_cmd.add_argument('log')
+    replay_cmd.add_argument('--url', '-u', help='worker to replay against (default: the recorded host)')
+    replay_cmd.add_argument('--speed', type=float, default=1.0,
+                            help='1 = recorded pacing, N = N times faster, 0 = as fast as possible')
+    replay_cmd.add_argument('--session-id', help='session_id for the replay (default: a fresh replay-<hex>)')
+    replay_cmd.add_argument('--out', help='also log the replayed session here (a baseline for later diffs)')
+    replay_cmd.add_argument('--ignore', action='append', default=[], metavar='FIELD',
+                            help='another reply field to leave out of the diff (repeatable), e.g. text')
+    replay_cmd.add_argument('--idle-s', type=float, default=2.0, help='stop after this long without a reply')
+    replay_cmd.add_argument('--timeout-s', type=float, default=60.0)
+    replay_cmd.add_argument('--anchor-timeout-s', type=float, default=10.0,
+                            help='how long a client message waits for the reply it followed when recorded')
+
+    diff_cmd = sub.add_parser('diff', help='diff the replies of two session logs')
+    diff_cmd.add_argument('expected')
+    diff_cmd.add_argument('actual')
+    diff_cmd.add_argument('--ignore', action='append', default=[], metavar='FIELD')
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        try:
+            asyncio.run(run_record(args))
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'show':
+        show(args.log, args.frames)
+    elif args.command == 'replay':
+        if args.speed < 0:
+            parser.error('--speed must be >= 0')
+        sys.exit(run_replay(args))
+    else:
+        _, expected = read_log(args.expected)
+        _, actual = read_log(args.actual)
+        print_milestones(expected, actual)
+        sys.exit(report_diff(expected, actual, args.ignore, (args.expected, args.actual)))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,117 +3,251 @@
 Stream a WAV file (or generated tone) to the deployed worker as real audio chunks.
 
 Usage:
-  python3 stream_audio.py [--file path/to/file.wav] [--url wss://...] [--chunk-samples N]
+  python3 stream_audio.py [--file path/to/file.wav] [--url wss://...] [--chunk-samples N] [--transport binary|json]
+                         [--encoding pcm16|mulaw|alaw|opus] [--interrupt-after-ms N] [--session-log PATH]
+                         [--adaptive-chunks [--min-chunk-ms N] [--max-chunk-ms N] [--latency-budget-ms N]]
+                         [--ack chunk|count|interval|none [--ack-every N] [--ack-interval-ms N]]
+                         [--sequenced [--reconnect-after-ms N]] [--bulk]
 
 If no file is provided, a 1s 440Hz sine wave (16kHz, mono, 16-bit) is generated.
+Files at 8, 24 or 48 kHz are sent at their own rate (declared to the worker,
+which resamples); --encoding mulaw/alaw sends G.711 bytes like a phone line,
+--encoding opus sends 0x03 Opus frames (needs opuslib; falls back to pcm16).
+Chunks go out as binary frames by default; --transport json sends the legacy
+JSON number arrays. Chunks are paced by the audio clock (stream_client.py) and
+acks are handled as they arrive rather than awaited per chunk. A byte/CPU
+comparison of both transports is printed at the end. --interrupt-after-ms
+barges in N ms into the spoken reply (an interrupt message with played_ms=N)
+and prints the worker's response_interrupted accounting. --session-log writes
+both directions of the session to a binary log that session_log.py can replay.
+--adaptive-chunks lets the client pick the chunk duration from the ack RTT and
+queue depth (stream_client.ChunkSizer) and prints each resize decision.
+--ack count|interval|none asks the worker for fewer acks (one per --ack-every
+chunks, one per --ack-interval-ms, or none).
+--sequenced sends 0x05 frames that carry their position in the call (session
+id in the URL); --reconnect-after-ms drops the connection N ms into the audio,
+reconnects and resumes from the offset the worker reports in session_resumed.
+--bulk uploads the whole file as one 0x06 frame that also ends the turn
+(offline transcription of a recording: one message instead of one per chunk).
 """
 
 import argparse
 import asyncio
-import websockets
-import ssl
-import wave
-import struct
-import math
 import json
-import os
+import time
+import uuid
 
-DEFAULT_URL = "wss://solitary-boat-0723.timtimtim001021.workers.dev"
-CHUNK_SAMPLES = 1600  # 100ms at 16kHz
-
-
-def generate_sine(duration_s=1.0, freq=440, sample_rate=16000):
-    samples = []
-    total = int(duration_s * sample_rate)
-    for n in range(total):
-        t = n / sample_rate
-        # amplitude for 16-bit PCM
-        val = int(32767 * 0.2 * math.sin(2 * math.pi * freq * t))
-        samples.append(val)
-    return samples, sample_rate
-
-
-def read_wav_as_samples(path):
-    with wave.open(path, 'rb') as wf:
-        channels = wf.getnchannels()
-        sampwidth = wf.getsampwidth()
-        framerate = wf.getframerate()
-        nframes = wf.getnframes()
-        raw = wf.readframes(nframes)
-
-    if sampwidth != 2:
-        raise RuntimeError(f"Unsupported sample width: {sampwidth*8} bits - only 16-bit supported")
-
-    # unpack little-endian signed 16-bit
-    fmt = '<' + 'h' * (len(raw)//2)
-    ints = list(struct.unpack(fmt, raw))
-
-    # If stereo, pick the first channel
-    if channels == 2:
-        ints = ints[0::2]
-
-    return ints, framerate
+import endpoints
+import codec
+import frames
+import pcm
+import vad
+from session_log import SessionLogWriter
+from stream_client import StreamingClient
 
+CHUNK_SAMPLES = 1600  # 100ms at 16kHz
 
-async def stream_samples(samples, sample_rate, websocket_url, chunk_samples=CHUNK_SAMPLES, session_id="stream-session"):
-    ssl_context = ssl.create_default_context()
-    ssl_context.check_hostname = False
-    ssl_context.verify_mode = ssl.CERT_NONE
 
-    print(f"Connecting to {websocket_url} (resampling not performed; expected 16000 Hz)")
-    async with websockets.connect(websocket_url, ssl=ssl_context) as ws:
+def transport_cost(samples, chunk_samples, transport, session_id, encoding='pcm16'):
+    """Bytes on the wire and encode CPU seconds for sending samples over a transport."""
+    total = 0
+    start = time.process_time()
+    for chunk in pcm.iter_chunks(samples, chunk_samples):
+        total += len(frames.encode_chunk(chunk, transport, session_id, encoding))
+    return total, time.process_time() - start
+
+
+def print_transport_comparison(samples, chunk_samples, transport, sent_bytes, encode_cpu, session_id,
+                               encoding='pcm16'):
+    # Re-encode offline with the other transport so the live loop only pays for one
+    other = 'json' if transport == 'binary' else 'binary'
+    other_bytes, other_cpu = transport_cost(samples, chunk_samples, other, session_id, encoding)
+    print(f"Transport comparison (audio frames only, {encoding}):")
+    for name, nbytes, cpu, note in ((transport, sent_bytes, encode_cpu, 'sent'),
+                                    (other, other_bytes, other_cpu, 'offline estimate')):
+        print(f"  {name:<6} {nbytes:>10} bytes  {cpu*1000:8.2f} ms encode CPU  ({note})")
+    json_bytes = sent_bytes if transport == 'json' else other_bytes
+    binary_bytes = sent_bytes if transport == 'binary' else other_bytes
+    if binary_bytes:
+        print(f"  json/binary size ratio: {json_bytes / binary_bytes:.2f}x")
+
+
+async def stream_samples(samples, sample_rate, websocket_url, chunk_samples=CHUNK_SAMPLES,
+                         session_id=None, transport='binary', session_config=None,
+                         response_dir='.', max_outstanding=32, encoding='pcm16', interrupt_after_ms=None,
+                         session_log_path=None, chunking=None, acks=None, sequenced=False,
+                         reconnect_after_ms=None, bulk=False):
+    # A fixed id would resume the previous run's session (its audio and seq/offset state)
+    session_id = session_id or f"stream-{uuid.uuid4().hex[:12]}"
+    print(f"Connecting to {websocket_url} over {transport} transport ({encoding} at {sample_rate} Hz)")
+    receiver = frames.ResponseAudioReceiver(out_dir=response_dir)
+
+    def on_message(msg, t):
+        if receiver.handle(msg):
+            if isinstance(msg, dict) and msg['type'] == 'response_audio_end':
+                path, nbytes = receiver.completed[-1]
+                print(f"Response audio: {nbytes} bytes written to {path}"
+                      f"{' (interrupted)' if msg.get('interrupted') else ''}")
+        elif not isinstance(msg, dict) or msg.get('type') != 'chunk_received':
+            print("Received:", json.dumps(msg)[:300] if isinstance(msg, dict) else f"{len(msg)} binary bytes")
+
+    log = SessionLogWriter(session_log_path, {'url': websocket_url, 'source': 'stream_audio.py'}) \
+        if session_log_path else None
+    client = StreamingClient(websocket_url, transport=transport, chunk_samples=chunk_samples,
+                             sample_rate=sample_rate, session_id=session_id, max_outstanding=max_outstanding,
+                             encoding=encoding, session_log=log, sequenced=sequenced, **(chunking or {}),
+                             **(acks or {}))
+    async with client:
         print("Connected")
-        pos = 0
-        # send chunks
-        while pos < len(samples):
-            chunk = samples[pos:pos+chunk_samples]
-            msg = {
-                "type": "audio_chunk",
-                "audio": chunk,
-                "session_id": session_id
-            }
-            await ws.send(json.dumps(msg))
-            print(f"Sent chunk samples {pos}-{pos+len(chunk)} ({len(chunk)} samples)")
-            # receive optional ack
+        if session_config:
             try:
-                resp = await asyncio.wait_for(ws.recv(), timeout=2.0)
-                print("Received:", resp)
+                print("Session config:", await client.configure(session_config))
             except asyncio.TimeoutError:
-                print("No immediate response")
-            pos += chunk_samples
-            await asyncio.sleep(0.05)  # small delay to simulate streaming
-
-        # send end_stream
-        await ws.send(json.dumps({"type": "end_stream", "session_id": session_id}))
-        print("Sent end_stream, waiting for processing response...")
+                print("No session_configured reply")
+        client.on('*', on_message)
+        if interrupt_after_ms is None:
+            done = client.queue('response_audio_end', 'response_audio', 'error')
+        else:
+            done = client.queue('response_interrupted', 'error')
+
+            async def barge_in():
+                await asyncio.sleep(interrupt_after_ms / 1000)
+                print(f"Interrupting {interrupt_after_ms} ms into the reply")
+                await client.interrupt(played_ms=interrupt_after_ms)
+
+            client.on('response_audio_start', lambda msg, t: asyncio.ensure_future(barge_in()))
+
+        # Sender runs on the audio clock; acks and replies are handled as they arrive
+        if bulk:
+            await client.send_bulk(samples)
+        elif reconnect_after_ms is None:
+            await client.stream(samples)
+        else:
+            cut = reconnect_after_ms * sample_rate // 1000
+            await client.stream(samples, stop=cut)
+            position = await client.reconnect()
+            stream = client.resumed.get('stream', {})
+            print(f"Reconnected after {cut} samples: worker has {position} "
+                  f"({stream.get('duplicates', 0)} duplicate frames, {stream.get('gaps', 0)} gaps so far)")
+            await client.stream(samples, start=position)
+        stats = client.stats()
+        print(f"Sent {stats['chunks_sent']} chunks ({stats['bytes_sent']} bytes), {stats.get('chunks_acked', 0)} acked so far "
+              f"in {stats.get('acks', 0)} acks ({stats['ack']} policy), "
+              f"max {stats['max_outstanding']} outstanding, {stats.get('backpressure_waits', 0)} backpressure waits")
+        if client.sizer is not None:
+            print(f"Adaptive chunks: {stats['chunk_resizes']} resizes, ms used {stats['chunk_ms_used']}, "
+                  f"ack srtt {stats['srtt_ms']} ms")
+            for decision in stats['chunk_decisions']:
+                print(f"  chunk {decision['chunk']}: {decision['from_ms']} -> {decision['to_ms']} ms "
+                      f"({decision['reason']}, srtt {decision['srtt_ms']} ms, {decision['outstanding']} outstanding)")
+
+        if bulk:
+            print("Sent the file as one bulk frame, waiting for processing response...")
+        else:
+            await client.end_stream()
+            print("Sent end_stream, waiting for processing response...")
         try:
-            resp = await asyncio.wait_for(ws.recv(), timeout=15.0)
-            print("Processing response:", resp)
+            await asyncio.wait_for(done.get(), timeout=15.0)
         except asyncio.TimeoutError:
-            print("No processing response received")
+            print("No further processing response received")
+
+    if log is not None:
+        log.close()
+        print(f"Session log: {log.records} messages in {session_log_path} (replay: session_log.py replay)")
+
+    if bulk:
+        chunks = -(-len(samples) // chunk_samples)
+        print(f"Bulk: 1 message of {stats['bytes_sent']} bytes instead of {chunks} chunks and an end_stream")
+    elif client.encoding == 'opus':
+        pcm_bytes, _ = transport_cost(samples, chunk_samples, 'binary', session_id)
+        print(f"Opus: {stats['bytes_sent']} bytes sent, {pcm_bytes} as pcm16 binary frames "
+              f"({pcm_bytes / max(1, stats['bytes_sent']):.1f}x smaller)")
+    else:
+        print_transport_comparison(samples, chunk_samples, transport, stats['bytes_sent'],
+                                   stats['encode_cpu_us'] / 1e6, session_id, client.encoding)
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--file', '-f', help='Path to WAV file (16-bit PCM, mono or stereo, 16kHz recommended)')
-    parser.add_argument('--url', '-u', default=os.environ.get('WORKER_WS_URL', DEFAULT_URL), help='WebSocket URL')
+    parser.add_argument('--file', '-f', help='Path to WAV file (16-bit PCM, mono or stereo, 8/16/24/48kHz)')
+    parser.add_argument('--url', '-u', default=endpoints.worker_url(), help='WebSocket URL')
     parser.add_argument('--chunk-samples', type=int, default=CHUNK_SAMPLES)
-    parser.add_argument('--session-id', default='stream-session')
+    parser.add_argument('--session-id', help='session to open or resume (default: a fresh one per run)')
+    parser.add_argument('--transport', choices=frames.TRANSPORTS, default='binary',
+                        help='binary frames (default) or legacy JSON number arrays')
+    parser.add_argument('--encoding', choices=codec.INPUT_ENCODINGS, default='pcm16',
+                        help='wire encoding of the audio (mulaw/alaw: G.711, half the bytes of pcm16; '
+                             'opus: 24 kbit/s, needs opuslib)')
+    parser.add_argument('--max-outstanding', type=int, default=32,
+                        help='unacknowledged chunks before the sender pauses (0 = no limit)')
+    parser.add_argument('--response-dir', default='.', help='where streamed TTS responses are written')
+    parser.add_argument('--vad', action='store_true',
+                        help='enable server-side VAD (trims silence, ends turns without end_stream)')
+    parser.add_argument('--vad-threshold-db', type=float, default=vad.VAD_DEFAULTS['threshold_db'])
+    parser.add_argument('--vad-hangover-ms', type=int, default=vad.VAD_DEFAULTS['hangover_ms'])
+    parser.add_argument('--interrupt-after-ms', type=int,
+                        help='barge in this long after the reply audio starts (tests interruption)')
+    parser.add_argument('--session-log', help='log the whole session here for session_log.py replay')
+    parser.add_argument('--ack', choices=frames.ACK_POLICIES,
+                        help='ask for cumulative acks every --ack-every chunks (count), every --ack-interval-ms '
+                             '(interval) or none; binary 0x04 acks on the binary transport')
+    parser.add_argument('--ack-every', type=int, default=10)
+    parser.add_argument('--ack-interval-ms', type=int, default=200)
+    parser.add_argument('--sequenced', action='store_true',
+                        help='send 0x05 frames with seq and sample offset so a reconnect resumes in place')
+    parser.add_argument('--reconnect-after-ms', type=int,
+                        help='with --sequenced: drop and resume the connection this far into the audio')
+    parser.add_argument('--bulk', action='store_true',
+                        help='upload the whole file as one 0x06 frame that ends the turn (no pacing)')
+    parser.add_argument('--adaptive-chunks', action='store_true',
+                        help='size chunks from ack RTT and queue depth instead of a fixed --chunk-samples')
+    parser.add_argument('--min-chunk-ms', type=int, default=40)
+    parser.add_argument('--max-chunk-ms', type=int, default=400)
+    parser.add_argument('--latency-budget-ms', type=int,
+                        help='with --adaptive-chunks: keep chunk duration + ack RTT under this')
     args = parser.parse_args()
 
     if args.file:
         print(f"Reading WAV file {args.file}")
-        samples, sr = read_wav_as_samples(args.file)
+        samples, sr = pcm.read_wav(args.file)
         print(f"Read {len(samples)} samples at {sr} Hz")
     else:
         print("No file provided; generating 1s sine wave (440Hz)")
-        samples, sr = generate_sine(duration_s=1.0)
+        samples, sr = pcm.generate_sine(duration_s=1.0)
         print(f"Generated {len(samples)} samples at {sr} Hz")
 
-    if sr != 16000:
-        print("Warning: sample rate is not 16000 Hz. Worker assumes 16kHz. Results may vary.")
-
-    asyncio.run(stream_samples(samples, sr, args.url, chunk_samples=args.chunk_samples, session_id=args.session_id))
+    if sr not in codec.INPUT_SAMPLE_RATES:
+        parser.error(f"{sr} Hz input is not supported (worker accepts {', '.join(map(str, codec.INPUT_SAMPLE_RATES))} Hz)")
+
+    if args.transport == 'binary' and args.chunk_samples > frames.MAX_FRAME_SAMPLES:
+        parser.error(f"--chunk-samples must be <= {frames.MAX_FRAME_SAMPLES} for binary transport")
+
+    chunking = None
+    if args.adaptive_chunks:
+        chunking = {'adaptive_chunks': True, 'min_chunk_ms': args.min_chunk_ms, 'max_chunk_ms': args.max_chunk_ms,
+                    'latency_budget_ms': args.latency_budget_ms}
+
+    acks = None
+    if args.ack:
+        acks = {'ack': args.ack, 'ack_every': args.ack_every, 'ack_interval_ms': args.ack_interval_ms}
+
+    if args.bulk and (args.transport != 'binary' or args.encoding == 'opus' or args.sequenced):
+        parser.error("--bulk needs the binary transport, a PCM or G.711 encoding and no --sequenced")
+    if args.reconnect_after_ms is not None and not args.sequenced:
+        parser.error("--reconnect-after-ms needs --sequenced")
+
+    session_config = None
+    if args.vad:
+        session_config = {"vad": True, "vad_threshold_db": args.vad_threshold_db,
+                          "vad_hangover_ms": args.vad_hangover_ms}
+
+    asyncio.run(stream_samples(samples, sr, args.url, chunk_samples=args.chunk_samples,
+                               session_id=args.session_id, transport=args.transport,
+                               session_config=session_config, response_dir=args.response_dir,
+                               max_outstanding=args.max_outstanding, encoding=args.encoding,
+                               interrupt_after_ms=args.interrupt_after_ms, session_log_path=args.session_log,
+                               chunking=chunking, acks=acks, sequenced=args.sequenced,
+                               reconnect_after_ms=args.reconnect_after_ms, bulk=args.bulk))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""
+Full-duplex streaming client for the worker protocol (docs/protocol.md).
+
+Sending and receiving are decoupled: stream() paces chunks by a monotonic
+audio clock and never waits for a reply, while a receiver task routes every
+incoming message to typed callbacks, queues and waiters. The only coupling is
+backpressure: once max_outstanding chunks are unacknowledged the sender
+pauses until chunk_received acks catch up, then sends the backlog straight
+away (the audio clock keeps running, so pacing does not drift).
+
+  async with StreamingClient(url) as client:
+      client.on('transcription', lambda msg, t: print(msg['text']))
+      await client.stream(samples)
+      await client.end_stream()
+      msg, t = await client.wait_for('response_audio_end', 'error', timeout=15)
+
+Audio is sent as int16 samples at sample_rate; with encoding='mulaw'/'alaw'
+or a rate other than 16 kHz, connect() declares the format with a
+session_config first (the worker decodes and resamples to 16 kHz).
+encoding='opus' sends 0x03 frames (20 ms packets, about 10x fewer bytes than
+pcm16) and falls back to pcm16 when opuslib is missing here or the worker
+answers codec_unavailable; `codec_fallback` then holds the reason.
+
+Callbacks and queue items are (message, received_at), received_at from
+time.monotonic(). JSON messages arrive parsed; binary messages arrive as bytes
+under 'response_audio_frame' (0x02) or 'binary'. '*' matches every message.
+With adaptive_chunks=True the chunk duration follows the link instead of
+staying at chunk_samples: ChunkSizer coalesces chunks while acks are slow or
+queue up and shrinks them when a latency_budget_ms is at risk, within
+[min_chunk_ms, max_chunk_ms]; stats() reports every decision.
+With ack='count' / 'interval' / 'none' the worker acknowledges chunks in
+cumulative batches (ack_every chunks, ack_interval_ms) or not at all, as
+0x04 frames on the binary transport; binary acks are routed as
+chunk_received, and every ack releases the chunks it covers.
+With sequenced=True chunks go out as 0x05 frames carrying their seq and
+sample offset in the call. session_id (when set) joins the URL, so
+reconnect() reaches the same session; after it the worker's session_resumed says how far the audio got, and
+stream(samples, start=position) carries on from there without re-sending or
+doubling audio (resends the worker already has are dropped as duplicates).
+send_bulk(samples) uploads a whole recording as one 0x06 frame that also
+ends the turn, for offline transcription instead of real-time streaming.
+With session_log=session_log.SessionLogWriter(path) every message sent and
+received is logged for a later replay (session_log.py).
+"""
+
+import asyncio
+import collections
+import json
+import math
+import sys
+import time
+
+import websockets
+
+import codec
+import endpoints
+import frames
+import pcm
+
+ANY = '*'
+BINARY_TYPES = {frames.FRAME_RESPONSE_AUDIO: 'response_audio_frame'}
+CHUNK_STEP_MS = codec.OPUS_FRAME_MS  # adaptive chunk sizes are whole Opus packets
+
+
+def message_type(message):
+    """Routing key for a received message (parsed JSON dict or raw bytes)."""
+    if isinstance(message, dict):
+        return message.get('type')
+    return BINARY_TYPES.get(message[0], 'binary') if message else 'binary'
+
+
+class ChunkSizer:
+    """Chooses how much audio goes into the next chunk from the ack RTT and the send-queue depth.
+
+    Starts at the configured chunk duration. While the link is slow (the smoothed ack RTT exceeds
+    a chunk, or more than queue_depth chunks wait for their ack) chunks are coalesced: the duration
+    doubles, saving a message and an ack per merged chunk. Once acks keep up again (one chunk
+    outstanding, RTT under half a chunk) it halves back to the configured duration. With a
+    latency_budget_ms, chunk + RTT (how late the last audio of a turn reaches the worker) is kept
+    inside the budget, shrinking below the configured duration if need be. Durations are whole
+    CHUNK_STEP_MS steps within [min_ms, max_ms]; a new decision waits for hold_chunks chunks.
+    """
+
+    def __init__(self, chunk_ms, min_ms=40, max_ms=400, latency_budget_ms=None, queue_depth=4, hold_chunks=4):
+        self.min_ms = max(CHUNK_STEP_MS, min_ms - min_ms % CHUNK_STEP_MS)
+        self.max_ms = max(self.min_ms, max_ms - max_ms % CHUNK_STEP_MS)
+        self.preferred_ms = self.clamp(chunk_ms)
+        self.chunk_ms = self.preferred_ms
+        self.latency_budget_ms = latency_budget_ms
+        self.queue_depth = queue_depth
+        self.hold_chunks = hold_chunks
+        self.srtt_ms = None
+        self.chunks = 0
+        self._since_change = 0
+        self.decisions = []  # {'chunk', 'from_ms', 'to_ms', 'reason', 'srtt_ms', 'outstanding'}
+        self.used_ms = collections.Counter()  # chunk duration -> chunks sent at it
+
+    def clamp(self, ms):
+        return min(self.max_ms, max(self.min_ms, int(ms) - int(ms) % CHUNK_STEP_MS))
+
+    def on_ack(self, rtt_s):
+        rtt_ms = rtt_s * 1000
+        self.srtt_ms = rtt_ms if self.srtt_ms is None else 0.875 * self.srtt_ms + 0.125 * rtt_ms
+
+    def next_chunk_ms(self, outstanding):
+        """Duration of the chunk about to be sent."""
+        if self._since_change >= self.hold_chunks and self.srtt_ms is not None:
+            target, reason = self._decide(outstanding)
+            if target != self.chunk_ms:
+                self.decisions.append({'chunk': self.chunks, 'from_ms': self.chunk_ms, 'to_ms': target, 'reason': reason,
+                                       'srtt_ms': round(self.srtt_ms, 1), 'outstanding': outstanding})
+                self.chunk_ms = target
+                self._since_change = 0
+        self.chunks += 1
+        self._since_change += 1
+        self.used_ms[self.chunk_ms] += 1
+        return self.chunk_ms
+
+    def _decide(self, outstanding):
+        chunk, rtt, budget = self.chunk_ms, self.srtt_ms, self.latency_budget_ms
+        ceiling = self.max_ms if budget is None else self.clamp(min(self.max_ms, budget - rtt))
+        if budget is not None and chunk + rtt > budget:
+            return ceiling, 'latency_budget'
+        if outstanding > self.queue_depth:
+            return self.clamp(min(chunk * 2, ceiling)), 'queue_depth'
+        if rtt > chunk:
+            return self.clamp(min(chunk * 2, ceiling)), 'slow_acks'
+        if chunk > self.preferred_ms and outstanding <= 1 and rtt < chunk / 2:
+            return self.clamp(max(self.preferred_ms, chunk // 2)), 'recovered'
+        if chunk < self.preferred_ms and chunk * 2 + rtt <= (budget if budget is not None else float('inf')):
+            return self.clamp(min(self.preferred_ms, chunk * 2)), 'recovered'
+        return chunk, None
+
+    def stats(self):
+        return {
+            'chunk_ms': self.chunk_ms,
+            'chunk_resizes': len(self.decisions),
+            'chunk_ms_used': dict(sorted(self.used_ms.items())),
+            'chunk_decisions': list(self.decisions),
+            'srtt_ms': None if self.srtt_ms is None else round(self.srtt_ms, 1),
+        }
+
+
+class StreamingClient:
+    def __init__(self, url, transport='binary', chunk_samples=1600, sample_rate=pcm.SAMPLE_RATE, pace=1.0,
+                 max_outstanding=32, ack_timeout_s=10.0, session_id=None, record_events=False, encoding='pcm16',
+                 session_log=None, adaptive_chunks=False, min_chunk_ms=40, max_chunk_ms=400, latency_budget_ms=None,
+                 ack=None, ack_every=10, ack_interval_ms=200, sequenced=False):
+        if transport not in frames.TRANSPORTS:
+            raise ValueError(f"Unknown transport: {transport}")
+        if encoding not in codec.INPUT_ENCODINGS or sample_rate not in codec.INPUT_SAMPLE_RATES:
+            raise ValueError(f"Unsupported input format: {encoding} at {sample_rate} Hz")
+        if encoding == 'opus':
+            if transport != 'binary':
+                raise ValueError("Opus audio needs the binary transport")
+            if chunk_samples % (sample_rate * codec.OPUS_FRAME_MS // 1000):
+                raise ValueError(f"chunk_samples must be a multiple of {codec.OPUS_FRAME_MS} ms for Opus")
+        if ack is not None:
+            if ack not in frames.ACK_POLICIES:
+                raise ValueError(f"Unknown ack policy: {ack}")
+            if ack == 'count' and 0 < max_outstanding <= ack_every:
+                raise ValueError(f"max_outstanding ({max_outstanding}) must exceed ack_every ({ack_every})")
+            params = {'ack': ack, 'ack_every': ack_every, 'ack_interval_ms': ack_interval_ms}
+            if transport == 'binary':
+                params['ack_binary'] = 1
+            url = endpoints.with_params(url, params)
+        if sequenced and (transport != 'binary' or encoding == 'opus'):
+            raise ValueError("sequenced frames need the binary transport and a PCM or G.711 encoding")
+        if session_id is not None:
+            url = endpoints.with_params(url, {'session_id': session_id})
+        self.url = url
+        self.ack = ack or 'chunk'
+        self.transport = transport
+        self.encoding = encoding
+        self.codec_fallback = None
+        self._opus = None
+        self.chunk_samples = chunk_samples
+        self.sample_rate = sample_rate
+        self.pace = pace
+        self.max_outstanding = max_outstanding
+        self.ack_timeout_s = ack_timeout_s
+        self.session_id = session_id
+        self.record_events = record_events
+        self.session_log = session_log
+        self.sequenced = sequenced
+        self.next_seq = 0
+        self.sample_offset = 0  # input-rate samples sent since the start of the call
+        self.stream_base = 0  # call offset of samples[0] in the current stream()
+        self.resumed = None  # the latest session_resumed
+        self.sizer = None
+        if adaptive_chunks:
+            if transport == 'binary':
+                max_chunk_ms = min(max_chunk_ms, frames.MAX_FRAME_SAMPLES * 1000 // sample_rate)
+            chunk_ms = chunk_samples * 1000 / sample_rate
+            # Chunks waiting for a batched ack are not a queue building up
+            batched = {'count': ack_every, 'interval': math.ceil(ack_interval_ms / chunk_ms)}.get(ack, 0)
+            self.sizer = ChunkSizer(chunk_ms, min_chunk_ms, max_chunk_ms, latency_budget_ms, queue_depth=4 + batched)
+        self.ws = None
+        self.events = []  # (t, direction, kind, size) when record_events
+        self.ack_rtts = []  # seconds, in ack order
+        self.end_stream_at = None
+        self.closed = False
+        self._callbacks = collections.defaultdict(list)
+        self._queues = collections.defaultdict(list)
+        self._waiters = []  # (types, future)
+        self._send_times = collections.deque()
+        self._ack_event = None
+        self._receiver = None
+        self.counters = collections.Counter()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # -- routing -------------------------------------------------------------
+
+    def on(self, msg_type, callback):
+        """Call callback(message, received_at) for every message of msg_type ('*' for all)."""
+        self._callbacks[msg_type].append(callback)
+
+    def queue(self, *msg_types):
+        """An asyncio.Queue that receives (message, received_at) for the given types."""
+        q = asyncio.Queue()
+        for msg_type in msg_types or (ANY,):
+            self._queues[msg_type].append(q)
+        return q
+
+    async def wait_for(self, *msg_types, timeout=None):
+        """The next (message, received_at) of one of msg_types that arrives from now on."""
+        future = asyncio.get_running_loop().create_future()
+        waiter = (set(msg_types), future)
+        self._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    # -- connection ----------------------------------------------------------
+
+    async def connect(self):
+        self._ack_event = asyncio.Event()
+        self.ws = await websockets.connect(self.url, ssl=endpoints.ssl_context_for(self.url), max_size=None)
+        self._receiver = asyncio.ensure_future(self._receive())
+        if self.encoding == 'opus' and not codec.opus_available():
+            self._fall_back('no local Opus encoder (opuslib / libopus not installed)')
+        if self.encoding != 'pcm16' or self.sample_rate != pcm.SAMPLE_RATE:
+            try:
+                await self.declare_input_format()
+            except BaseException:
+                await self.close()
+                raise
+        return self
+
+    async def declare_input_format(self):
+        """Tell the worker how the audio is encoded; fails if it does not accept the format."""
+        reply = await self._session_config({'input_encoding': self.encoding, 'input_sample_rate': self.sample_rate})
+        options = reply.get('options', {})
+        if self.encoding == 'opus' and options.get('input_encoding') == 'pcm16':
+            rejected = reply.get('rejected') or {'reason': 'opus not supported'}
+            self._fall_back(f"worker: {rejected.get('reason')} ({rejected.get('message', '')})")
+        if options.get('input_encoding') != self.encoding or options.get('input_sample_rate') != self.sample_rate:
+            raise RuntimeError(f"worker did not accept {self.encoding} at {self.sample_rate} Hz "
+                               f"(session options: {options})")
+        if self.encoding == 'opus':
+            self._opus = codec.OpusEncoder(self.sample_rate)
+        return options
+
+    def _fall_back(self, reason):
+        self.codec_fallback = reason
+        self.encoding = 'pcm16'
+        print(f"StreamingClient: sending pcm16 instead of opus: {reason}", file=sys.stderr)
+
+    async def configure(self, session_config, timeout=5.0):
+        """Send session_config and return the effective options from session_configured."""
+        return (await self._session_config(session_config, timeout)).get('options', {})
+
+    async def _session_config(self, session_config, timeout=5.0):
+        waiting = asyncio.ensure_future(self.wait_for('session_configured', 'error', timeout=timeout))
+        await asyncio.sleep(0)
+        await self.send_json(dict(session_config, type='session_config'))
+        message, _ = await waiting
+        if message.get('type') == 'error':
+            raise RuntimeError(f"session_config rejected: {message.get('message')}")
+        return message
+
+    async def reconnect(self, timeout=5.0):
+        """Drop the connection and resume the call (needs session_id); with sequenced=True returns
+        the position in the last stream()'s samples the worker has audio up to."""
+        if self.session_id is None:
+            raise ValueError("reconnect needs a session_id")
+        await self.close()
+        self.closed = False
+        self.resumed = None
+        self._send_times.clear()  # unacknowledged chunks: session_resumed says what arrived
+        self.counters['reconnects'] += 1
+        await self.connect()
+        if self.resumed is None:
+            await self.wait_for('session_resumed', timeout=timeout)
+        if self.sequenced:
+            return self.sample_offset - self.stream_base
+        return None
+
+    async def close(self):
+        if self._receiver is not None:
+            self._receiver.cancel()
+            self._receiver = None
+        if self.ws is not None:
+            await self.ws.close()
+        self._closed()
+
+    # -- sending -------------------------------------------------------------
+
+    @property
+    def outstanding(self):
+        """Chunks sent but not yet acknowledged."""
+        return len(self._send_times)
+
+    async def send_json(self, message):
+        data = json.dumps(message)
+        self._record('out', message.get('type'), len(data))
+        self._log('out', data)
+        await self.ws.send(data)
+
+    async def send_chunk(self, samples):
+        start = time.process_time()
+        if self._opus is not None:
+            msg = frames.opus_frame(self._opus.encode(samples))
+        elif self.sequenced:
+            msg = frames.sequenced_audio_frame(self.next_seq, self.sample_offset, samples, self.encoding)
+            self.next_seq += 1
+            self.sample_offset += len(samples)
+        else:
+            msg = frames.encode_chunk(samples, self.transport, self.session_id, self.encoding)
+        self.counters['encode_cpu_us'] += int((time.process_time() - start) * 1e6)
+        if self.ack != 'none':
+            self._send_times.append(time.monotonic())
+        self.counters['chunks_sent'] += 1
+        self.counters['bytes_sent'] += len(msg)
+        self.counters['samples_sent'] += len(samples)
+        self.counters['max_outstanding'] = max(self.counters['max_outstanding'], self.outstanding)
+        self._record('out', 'audio', len(msg))
+        self._log('out', msg)
+        await self.ws.send(msg)
+
+    async def send_bulk(self, samples, end=True):
+        """Upload samples as one 0x06 frame, unpaced; end=True ends the turn as end_stream would."""
+        if self.transport != 'binary' or self.encoding == 'opus':
+            raise ValueError("bulk frames need the binary transport and a PCM or G.711 encoding")
+        start = time.process_time()
+        msg = frames.bulk_audio_frame(samples, self.encoding, end)
+        self.counters['encode_cpu_us'] += int((time.process_time() - start) * 1e6)
+        if self.ack != 'none':
+            self._send_times.append(time.monotonic())
+        if end:
+            self.end_stream_at = time.monotonic()
+        self.counters['chunks_sent'] += 1
+        self.counters['bytes_sent'] += len(msg)
+        self.counters['samples_sent'] += len(samples)
+        self.counters['max_outstanding'] = max(self.counters['max_outstanding'], self.outstanding)
+        self._record('out', 'bulk_audio', len(msg))
+        self._log('out', msg)
+        await self.ws.send(msg)
+
+    async def stream(self, samples, start=0, stop=None):
+        """Send samples[start:stop] in chunks on the audio clock; returns once the last chunk is sent."""
+        stop = len(samples) if stop is None else min(stop, len(samples))
+        self.stream_base = self.sample_offset - start
+        t0 = time.monotonic()
+        pos = start
+        while pos < stop:
+            await self._wait_for_window()
+            delay = t0 + (pos - start) / self.sample_rate / self.pace - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                self.counters['max_lag_ms'] = max(self.counters['max_lag_ms'], int(-delay * 1000))
+            n = min(self.next_chunk_samples(), stop - pos)
+            await self.send_chunk(samples[pos:pos + n])
+            pos += n
+
+    def next_chunk_samples(self):
+        """Samples in the next chunk: chunk_samples, or the ChunkSizer's choice with adaptive_chunks."""
+        if self.sizer is None:
+            return self.chunk_samples
+        return self.sizer.next_chunk_ms(self.outstanding) * self.sample_rate // 1000
+
+    async def end_stream(self, **extra):
+        self.end_stream_at = time.monotonic()
+        message = {'type': 'end_stream'}
+        if self.session_id is not None:
+            message['session_id'] = self.session_id
+        message.update(extra)
+        await self.send_json(message)
+
+    async def interrupt(self, played_ms=None):
+        """Barge in: stop the reply being generated or spoken; the worker answers response_interrupted."""
+        message = {'type': 'interrupt'}
+        if played_ms is not None:
+            message['played_ms'] = played_ms
+        await self.send_json(message)
+
+    async def _wait_for_window(self):
+        if not self.max_outstanding or self.outstanding < self.max_outstanding:
+            return
+        self.counters['backpressure_waits'] += 1
+        start = time.monotonic()
+        while self.outstanding >= self.max_outstanding:
+            if self.closed:
+                raise ConnectionError('connection closed while waiting for acks')
+            self._ack_event.clear()
+            try:
+                await asyncio.wait_for(self._ack_event.wait(), self.ack_timeout_s)
+            except asyncio.TimeoutError:
+                raise RuntimeError(f"no chunk_received for {self.ack_timeout_s}s "
+                                   f"with {self.outstanding} chunks outstanding") from None
+        self.counters['backpressure_ms'] += int((time.monotonic() - start) * 1000)
+
+    # -- receiving -----------------------------------------------------------
+
+    async def _receive(self):
+        try:
+            async for raw in self.ws:
+                received_at = time.monotonic()
+                self._log('in', raw)
+                if isinstance(raw, str):
+                    try:
+                        message = json.loads(raw)
+                    except ValueError:
+                        message = {'type': None, 'raw': raw}
+                elif raw[:1] == bytes([frames.FRAME_ACK]):
+                    message = frames.parse_ack_frame(raw)
+                else:
+                    message = raw
+                msg_type = message_type(message)
+                self._record('in', msg_type, len(raw))
+                self.counters['messages_received'] += 1
+                if msg_type == 'chunk_received':
+                    self._ack(received_at, message.get('chunks', 1))
+                elif msg_type == 'session_resumed':
+                    self._resumed(message)
+                self._dispatch(msg_type, message, received_at)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self._closed()
+
+    def _ack(self, received_at, chunks=1):
+        # Acks come back in send order; a cumulative ack releases the oldest `chunks` chunks
+        released = 0
+        while self._send_times and released < chunks:
+            self.ack_rtts.append(received_at - self._send_times.popleft())
+            released += 1
+        if released and self.sizer is not None:
+            # The newest chunk's RTT: older ones also waited for the ack batch to fill
+            self.sizer.on_ack(self.ack_rtts[-1])
+        self.counters['acks'] += 1
+        self.counters['chunks_acked'] += released
+        self._ack_event.set()
+
+    def _resumed(self, message):
+        # Carry on from where the worker's input stream is, not from what this side sent
+        self.resumed = message
+        stream = message.get('stream')
+        if self.sequenced and stream:
+            self.next_seq = stream['next_seq']
+            self.sample_offset = stream['next_offset']
+
+    def _dispatch(self, msg_type, message, received_at):
+        for key in (msg_type, ANY):
+            for callback in self._callbacks.get(key, ()):
+                try:
+                    callback(message, received_at)
+                except Exception as err:
+                    print(f"StreamingClient: {key} callback failed: {err!r}", file=sys.stderr)
+            for q in self._queues.get(key, ()):
+                q.put_nowait((message, received_at))
+        for types, future in list(self._waiters):
+            if msg_type in types and not future.done():
+                future.set_result((message, received_at))
+
+    def _closed(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._ack_event is not None:
+            self._ack_event.set()
+        for _, future in self._waiters:
+            if not future.done():
+                future.set_exception(ConnectionError('connection closed'))
+
+    def _record(self, direction, kind, size):
+        if self.record_events:
+            self.events.append((time.monotonic(), direction, kind, size))
+
+    def _log(self, direction, data):
+        if self.session_log is not None:
+            self.session_log.record(direction, data)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['outstanding'] = self.outstanding
+        stats['encoding'] = self.encoding
+        stats['ack'] = self.ack
+        stats['audio_s_sent'] = self.counters['samples_sent'] / self.sample_rate
+        if self.sizer is not None:
+            stats.update(self.sizer.stats())
+        return stats
@@ -7,7 +7,9 @@ import requests
 import json
 import time
 import wave
-import struct
+import array
+
+import pcm
 
 def create_test_audio():
     """Create a simple test audio file with a spoken phrase"""
@@ -25,12 +27,8 @@ def create_test_audio():
         sample = int(32767 * wave_value)
         samples.append(sample)
 
-    # Convert to bytes (16-bit PCM)
-    audio_bytes = b''
-    for sample in samples:
-        audio_bytes += struct.pack('<h', sample)
-
-    return audio_bytes
+    # Convert to bytes (16-bit PCM) in one pass
+    return pcm.pcm_bytes(memoryview(array.array('h', samples)))
 
 def test_with_generated_audio(worker_url):
     """Test the worker with generated audio data"""
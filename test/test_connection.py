@@ -7,9 +7,11 @@ import asyncio
 import websockets
 import json
 
+import endpoints
+
 async def test_connection():
     """Test basic WebSocket connection"""
-    uri = "wss://solitary-boat-0723.timtimtim001021.workers.dev"
+    uri = endpoints.worker_url()
 
     try:
         async with websockets.connect(uri) as websocket:
@@ -0,0 +1,259 @@
+"""
+Protocol tests against the stand-in (local_worker.py), offline and with
+deterministic fakes:
+
+  python3 -m pytest -q test/test_local_worker.py
+
+Unlike the other test_*.py scripts here, which talk to a deployed worker and
+are run by hand, these need only websockets and pytest. Each test serves a
+fresh LocalWorker on a free port and drives it with StreamingClient; the
+server-side Session is inspected through worker.store where the wire does not
+say enough.
+"""
+
+import array
+import asyncio
+import contextlib
+import math
+
+import pytest
+
+import batch
+import frames
+import pcm
+from local_worker import FakeLlm, FakeStt, FakeTts, LocalWorker
+from stream_client import StreamingClient
+
+TRANSCRIPT = 'what time do you open tomorrow'
+REPLY = 'We open at nine. See you then!'
+CHUNK = 1600  # 100 ms at 16 kHz
+
+
+def tone(samples, start=0, amplitude=6000):
+    """A recognisable ramp of samples: sample i of the call holds a value derived from start + i."""
+    return array.array('h', (int(amplitude * math.sin((start + i) * 0.2)) for i in range(samples)))
+
+
+def run(scenario):
+    asyncio.run(asyncio.wait_for(scenario, 30))
+
+
+@contextlib.asynccontextmanager
+async def local_worker(**fakes):
+    worker = LocalWorker(stt=fakes.get('stt') or FakeStt(transcript=TRANSCRIPT),
+                         llm=fakes.get('llm') or FakeLlm(reply=REPLY, token_ms=1),
+                         tts=fakes.get('tts') or FakeTts(ms_per_char=5, chunk_interval_ms=1))
+    async with worker.serving() as url:
+        yield worker, url
+
+
+async def settle(client):
+    """Wait until the worker has handled everything sent so far (messages are handled in order)."""
+    waiting = asyncio.ensure_future(client.wait_for('pong', timeout=5))
+    await asyncio.sleep(0)
+    await client.send_json({'type': 'ping'})
+    await waiting
+
+
+async def send_sequenced(client, seq, offset, samples):
+    await client.ws.send(frames.sequenced_audio_frame(seq, offset, samples))
+
+
+def test_full_turn():
+    async def scenario():
+        async with local_worker() as (worker, url):
+            client = StreamingClient(url, pace=50)
+            response_frames = []
+            client.on('response_audio_frame', lambda m, t: response_frames.append(frames.parse_response_audio_frame(m)))
+            async with client:
+                await client.stream(tone(16000))
+                transcription = asyncio.ensure_future(client.wait_for('transcription', timeout=10))
+                text = asyncio.ensure_future(client.wait_for('response_text', timeout=10))
+                end = asyncio.ensure_future(client.wait_for('response_audio_end', timeout=10))
+                await client.end_stream()
+                assert (await transcription)[0]['text'] == TRANSCRIPT
+                assert (await text)[0]['text'] == REPLY
+                done = (await end)[0]
+            assert not done.get('interrupted')
+            assert done['frames'] == len(response_frames)
+            assert done['bytes'] == sum(len(payload) for _, _, payload in response_frames)
+            assert [seq for seq, _, _ in response_frames] == list(range(len(response_frames)))
+            assert [final for _, final, _ in response_frames] == [False] * (len(response_frames) - 1) + [True]
+            assert client.counters['chunks_acked'] == 10
+            assert worker.stt.calls == 1
+    run(scenario())
+
+
+def test_partials_are_refused():
+    # The stand-in has no partial windows: asking for them fails instead of silently getting none
+    async def scenario():
+        async with local_worker() as (worker, url):
+            async with StreamingClient(url) as client:
+                with pytest.raises(RuntimeError, match='not emulated'):
+                    await client.configure({'partials': True, 'vad': True})
+                options = await client.configure({'vad': True})
+            assert options['partials'] is False and options['vad'] is True
+    run(scenario())
+
+
+def test_barge_in_stops_the_reply():
+    async def scenario():
+        # A long reply spoken slowly, so the caller can cut in while it is still being sent
+        tts = FakeTts(ms_per_char=60, chunk_ms=100, chunk_interval_ms=50)
+        llm = FakeLlm(reply='Let me read you the whole list of opening hours. ' * 4, token_ms=1)
+        async with local_worker(tts=tts, llm=llm) as (worker, url):
+            async with StreamingClient(url, pace=50) as client:
+                await client.stream(tone(8000))
+                started = asyncio.ensure_future(client.wait_for('response_audio_start', timeout=10))
+                await client.end_stream()
+                await started
+                end = asyncio.ensure_future(client.wait_for('response_audio_end', timeout=5))
+                interrupted = asyncio.ensure_future(client.wait_for('response_interrupted', timeout=5))
+                await client.interrupt(played_ms=0)
+                end, report = (await end)[0], (await interrupted)[0]
+            assert end['interrupted'] is True
+            assert report['reason'] == 'client' and report['stage'] == 'reply'
+            assert report['response_id'] == end['response_id']
+            assert report['played_ms'] == 0 and report['heard_text'] == ''
+            assert worker.stats['interruptions'] == 1
+    run(scenario())
+
+
+def test_sequenced_duplicate_and_overlap():
+    async def scenario():
+        async with local_worker() as (worker, url):
+            gaps = []
+            async with StreamingClient(url, sequenced=True, session_id='seq-dup') as client:
+                client.on('audio_gap', lambda m, t: gaps.append(m))
+                await send_sequenced(client, 0, 0, tone(CHUNK))
+                await send_sequenced(client, 1, CHUNK, tone(CHUNK, CHUNK))
+                await send_sequenced(client, 1, CHUNK, tone(CHUNK, CHUNK))  # resent after a reconnect
+                # Overlaps the end of seq 1 by half a chunk: only the new half is kept
+                await send_sequenced(client, 2, CHUNK + CHUNK // 2, tone(CHUNK, CHUNK + CHUNK // 2))
+                await settle(client)
+                session = worker.store.get('seq-dup')
+                stream = session.stream.describe()
+            assert stream['next_seq'] == 3 and stream['next_offset'] == 2 * CHUNK + CHUNK // 2
+            assert stream['duplicates'] == 1 and stream['overlap_samples'] == CHUNK // 2
+            assert stream['gaps'] == stream['lost_frames'] == stream['late_frames'] == 0
+            assert session.audio == tone(2 * CHUNK + CHUNK // 2)
+            assert gaps == []
+    run(scenario())
+
+
+def test_sequenced_reordered_frame_closes_its_gap():
+    # A frame overtaken by the next one is placed in order, not zero-filled and then dropped
+    async def scenario():
+        async with local_worker() as (worker, url):
+            gaps = []
+            async with StreamingClient(url, sequenced=True, session_id='seq-reorder') as client:
+                client.on('audio_gap', lambda m, t: gaps.append(m))
+                await send_sequenced(client, 0, 0, tone(CHUNK))
+                await send_sequenced(client, 2, 2 * CHUNK, tone(CHUNK, 2 * CHUNK))
+                await settle(client)
+                session = worker.store.get('seq-reorder')
+                assert session.stream.describe()['held_frames'] == 1
+                await send_sequenced(client, 1, CHUNK, tone(CHUNK, CHUNK))
+                await settle(client)
+                stream = session.stream.describe()
+            assert stream['reordered_frames'] == 1 and stream['held_frames'] == 0
+            assert stream['lost_frames'] == stream['duplicates'] == stream['late_frames'] == stream['gaps'] == 0
+            assert session.audio == tone(3 * CHUNK)
+            assert gaps == []
+    run(scenario())
+
+
+def test_sequenced_frame_partly_overlapping_a_held_one():
+    # Held frames that overlap are trimmed when placed, not dropped whole as duplicates
+    async def scenario():
+        async with local_worker() as (worker, url):
+            async with StreamingClient(url, sequenced=True, session_id='seq-held-overlap') as client:
+                await send_sequenced(client, 0, 0, tone(CHUNK))
+                await send_sequenced(client, 2, 2 * CHUNK, tone(CHUNK, 2 * CHUNK))
+                await send_sequenced(client, 3, 2 * CHUNK + CHUNK // 2, tone(CHUNK, 2 * CHUNK + CHUNK // 2))
+                # Wholly inside the two held frames: a real duplicate
+                await send_sequenced(client, 3, 2 * CHUNK + CHUNK // 4, tone(CHUNK // 2, 2 * CHUNK + CHUNK // 4))
+                await settle(client)
+                session = worker.store.get('seq-held-overlap')
+                assert session.stream.describe()['held_frames'] == 2
+                await send_sequenced(client, 1, CHUNK, tone(CHUNK, CHUNK))
+                await settle(client)
+                stream = session.stream.describe()
+            assert stream['duplicates'] == 1 and stream['overlap_samples'] == CHUNK // 2
+            assert stream['next_offset'] == 3 * CHUNK + CHUNK // 2 and stream['held_frames'] == 0
+            assert stream['gaps'] == stream['lost_frames'] == 0
+            assert session.audio == tone(3 * CHUNK + CHUNK // 2)
+    run(scenario())
+
+
+def test_sequenced_late_frame_after_its_gap_was_filled():
+    async def scenario():
+        async with local_worker() as (worker, url):
+            async with StreamingClient(url, sequenced=True, session_id='seq-late') as client:
+                await send_sequenced(client, 0, 0, tone(CHUNK))
+                gap = asyncio.ensure_future(client.wait_for('audio_gap', timeout=5))
+                # More than the 200 ms reorder window past the gap: it is filled with silence
+                for seq in range(2, 5):
+                    await send_sequenced(client, seq, seq * CHUNK, tone(CHUNK, seq * CHUNK))
+                gap = (await gap)[0]
+                await send_sequenced(client, 1, CHUNK, tone(CHUNK, CHUNK))
+                await settle(client)
+                session = worker.store.get('seq-late')
+                stream = session.stream.describe()
+            assert gap['offset'] == CHUNK and gap['samples'] == CHUNK and gap['filled']
+            assert stream['late_frames'] == 1 and stream['duplicates'] == 0
+            assert stream['reordered_frames'] == 1 and stream['lost_frames'] == 0
+            assert stream['filled_samples'] == CHUNK and stream['next_offset'] == 5 * CHUNK
+            assert session.audio[CHUNK:2 * CHUNK] == array.array('h', [0]) * CHUNK
+            assert session.audio[2 * CHUNK:] == tone(3 * CHUNK, 2 * CHUNK)
+    run(scenario())
+
+
+def test_resume_after_reconnect():
+    async def scenario():
+        # The default transcript names the duration STT was given: all of it, once
+        async with local_worker(stt=FakeStt()) as (worker, url):
+            samples = tone(16000)
+            async with StreamingClient(url, pace=50, sequenced=True, session_id='resume-1') as client:
+                await client.stream(samples, stop=8000)
+                await settle(client)
+                position = await client.reconnect()
+                assert position == 8000
+                assert client.resumed['buffer_size'] == 8000
+                assert client.resumed['stream']['next_offset'] == 8000
+                # A chunk re-sent from before the drop is harmless: the worker drops it as a duplicate
+                await send_sequenced(client, 4, position - CHUNK, samples[position - CHUNK:position])
+                await client.stream(samples, start=position)
+                transcription = asyncio.ensure_future(client.wait_for('transcription', timeout=10))
+                await client.end_stream()
+                assert (await transcription)[0]['text'] == 'test audio of 1.0 seconds'
+                stream = worker.store.get('resume-1').stream.describe()
+            assert worker.stats['resumed_sessions'] == 1
+            assert stream['next_offset'] == 16000 and stream['next_seq'] == 10 and stream['duplicates'] == 1
+            assert worker.stt.calls == 1
+    run(scenario())
+
+
+def test_transcribe_endpoint(tmp_path):
+    async def scenario():
+        async with local_worker() as (worker, _):
+            server = await worker.serve_http('127.0.0.1', 0)
+            try:
+                base = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+                wav = tmp_path / 'call.wav'
+                silence = array.array('h', [0]) * 8000
+                wav.write_bytes(pcm.build_wav_bytes(tone(16000) + silence + tone(16000)))
+                status, reply, _ = await asyncio.to_thread(batch.post_file, batch.transcribe_url(base, {}), wav)
+                assert status == 200
+                assert reply['text'] == TRANSCRIPT and reply['duration_ms'] == 2500
+                assert reply['stats']['transcribed'] == 1 and reply['stats']['failed'] == 0
+
+                raw = tmp_path / 'call.raw'
+                raw.write_bytes(tone(1600).tobytes())
+                url = batch.transcribe_url(base, {'sample_rate': 11025})
+                status, reply, _ = await asyncio.to_thread(batch.post_file, url, raw)
+                assert status == 400 and 'sample rate' in reply['error']
+            finally:
+                server.close()
+                await server.wait_closed()
+    run(scenario())
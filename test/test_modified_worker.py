@@ -7,7 +7,9 @@ import requests
 import json
 import time
 import wave
-import struct
+import array
+
+import pcm
 
 def create_simple_audio_phrase():
     """Create a simple audio sample that should transcribe to something recognizable"""
@@ -24,12 +26,8 @@ def create_simple_audio_phrase():
         sample = int(32767 * amplitude * (i % 2 - 0.5) * 2)  # Square wave
         samples.append(sample)
 
-    # Convert to bytes (16-bit PCM)
-    audio_bytes = b''
-    for sample in samples:
-        audio_bytes += struct.pack('<h', sample)
-
-    return audio_bytes
+    # Convert to bytes (16-bit PCM) in one pass
+    return pcm.pcm_bytes(memoryview(array.array('h', samples)))
 
 def test_modified_worker(worker_url):
     """Test the modified worker with different scenarios"""
@@ -8,17 +8,21 @@ import asyncio
 import websockets
 import json
 import time
-import wave
-import struct
+import array
 import threading
 import queue
 
+import endpoints
+import frames
+import pcm
+
 class AudioStreamer:
     def __init__(self, websocket_url):
         self.websocket_url = websocket_url
         self.audio_queue = queue.Queue()
         self.response_queue = queue.Queue()
         self.is_connected = False
+        self.response_audio = frames.ResponseAudioReceiver()
 
     async def connect(self):
         """Establish WebSocket connection"""
@@ -68,6 +72,13 @@ class AudioStreamer:
         """Receive and process messages from worker"""
         try:
             async for message in self.websocket:
+                # Streamed TTS: response_audio_start, binary 0x02 frames, response_audio_end
+                if self.response_audio.handle(message):
+                    if not isinstance(message, bytes):
+                        data = json.loads(message)
+                        if data['type'] == 'response_audio_end':
+                            print(f"🔊 Received audio response: {data['bytes']} bytes -> {self.response_audio.completed[-1][0]}")
+                    continue
                 data = json.loads(message)
 
                 if data['type'] == 'chunk_received':
@@ -117,22 +128,15 @@ def create_test_audio():
     """Create a simple test audio sample"""
     sample_rate = 16000
     duration = 1.5  # 1.5 seconds
-    frequency = 440  # A note
-
-    samples = []
-    for i in range(int(sample_rate * duration)):
-        # Create a sine wave with some variation
-        t = i / sample_rate
-        wave_value = 0.3 * (1 + 0.2 * (i % 100) / 100) * (0.8 + 0.2 * (i % 50) / 50)
-        sample = int(32767 * wave_value)
-        samples.append(sample)
 
-    # Convert to bytes (16-bit PCM)
-    audio_bytes = b''
-    for sample in samples:
-        audio_bytes += struct.pack('<h', sample)
+    # Same waveform as before, built straight into an int16 buffer
+    samples = array.array('h', (
+        int(32767 * 0.3 * (1 + 0.2 * (i % 100) / 100) * (0.8 + 0.2 * (i % 50) / 50))
+        for i in range(int(sample_rate * duration))
+    ))
 
-    return audio_bytes
+    # 16-bit PCM bytes
+    return pcm.pcm_bytes(memoryview(samples))
 
 async def simulate_phone_call(streamer):
     """Simulate a phone call by streaming audio chunks"""
@@ -156,7 +160,7 @@ async def simulate_phone_call(streamer):
     await asyncio.sleep(3)
 
 async def main():
-    websocket_url = "wss://solitary-boat-0723.timtimtim001021.workers.dev"
+    websocket_url = endpoints.worker_url()
 
     print("=" * 60)
     print("📞 Real-World WebSocket Audio Streaming Test")
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Reference energy / zero-crossing VAD, mirroring src/vad.js (same defaults, same decisions).
+
+Use it to tune the worker's VAD thresholds offline:
+  python3 vad.py path/to/file.wav [--threshold-db -45] [--hangover-ms 600]
+  python3 vad.py encoded_records/20250919T105022Z      # record dirs with full.b64
+
+Prints each detected utterance (start/end, speech ms) and how much audio the
+trimming keeps. Input is expected at 16 kHz like the worker.
+"""
+
+import argparse
+import array
+import base64
+import io
+import math
+import os
+import sys
+
+import pcm
+
+VAD_DEFAULTS = {
+    'sample_rate': 16000,
+    'frame_ms': 20,
+    'threshold_db': -45,
+    'noise_margin_db': 10,
+    'zcr_threshold': 0.3,
+    'fricative_margin_db': 6,
+    'onset_ms': 60,
+    'hangover_ms': 600,
+    'pre_roll_ms': 200,
+    'post_roll_ms': 200,
+    'min_speech_ms': 250,
+}
+
+NOISE_FLOOR_INIT_DB = -70
+NOISE_FLOOR_ALPHA = 0.05
+
+
+def frame_levels(frame):
+    """RMS level in dBFS and zero-crossing rate of one frame."""
+    n = len(frame)
+    sum_squares = sum(v * v for v in frame)
+    crossings = sum(1 for i in range(1, n) if (frame[i] >= 0) != (frame[i - 1] >= 0))
+    mean_square = sum_squares / max(1, n)
+    db = 10 * math.log10(mean_square / (32768 * 32768)) if mean_square > 0 else -100
+    return db, crossings / max(1, n - 1)
+
+
+class VoiceActivityDetector:
+    """Frame-based VAD; process() returns ('start',), ('audio', samples) and ('end', speech_ms, discard) events."""
+
+    def __init__(self, **options):
+        self.options = dict(VAD_DEFAULTS, **options)
+        o = self.options
+
+        def frames(ms):
+            return max(1, round(ms / o['frame_ms']))
+
+        self.frame_samples = round(o['sample_rate'] * o['frame_ms'] / 1000)
+        self.onset_frames = frames(o['onset_ms'])
+        self.hangover_frames = frames(o['hangover_ms'])
+        self.pre_roll_frames = round(o['pre_roll_ms'] / o['frame_ms'])
+        self.post_roll_frames = round(o['post_roll_ms'] / o['frame_ms'])
+        self.min_speech_frames = frames(o['min_speech_ms'])
+        self.reset()
+
+    def reset(self):
+        self.partial = array.array('h')
+        self.in_speech = False
+        self.noise_floor_db = NOISE_FLOOR_INIT_DB
+        self.pre_roll = []
+        self.onset = []
+        self.held = []
+        self.speech_frames = 0
+
+    def is_speech(self, frame):
+        db, zcr = frame_levels(frame)
+        o = self.options
+        threshold = max(o['threshold_db'], self.noise_floor_db + o['noise_margin_db'])
+        speech = db >= threshold
+        if not speech and self.in_speech:
+            speech = db >= threshold - o['fricative_margin_db'] and zcr >= o['zcr_threshold']
+        if not speech:
+            self.noise_floor_db += NOISE_FLOOR_ALPHA * (db - self.noise_floor_db)
+        return speech
+
+    def process(self, samples):
+        events = []
+        offset = 0
+        while offset < len(samples):
+            n = min(self.frame_samples - len(self.partial), len(samples) - offset)
+            self.partial.extend(samples[offset:offset + n])
+            offset += n
+            if len(self.partial) == self.frame_samples:
+                frame, self.partial = self.partial, array.array('h')
+                self._process_frame(frame, events)
+        return events
+
+    def _process_frame(self, frame, events):
+        speech = self.is_speech(frame)
+        if not self.in_speech:
+            if speech:
+                self.onset.append(frame)
+                if len(self.onset) >= self.onset_frames:
+                    self.in_speech = True
+                    self.speech_frames = len(self.onset)
+                    events.append(('start',))
+                    events.append(('audio', _concat(self.pre_roll + self.onset)))
+                    self.pre_roll = []
+                    self.onset = []
+            else:
+                self.pre_roll.extend(self.onset)
+                self.pre_roll.append(frame)
+                self.onset = []
+                if len(self.pre_roll) > self.pre_roll_frames:
+                    del self.pre_roll[:len(self.pre_roll) - self.pre_roll_frames]
+            return
+
+        if speech:
+            self.speech_frames += 1
+            self.held.append(frame)
+            events.append(('audio', _concat(self.held)))
+            self.held = []
+            return
+
+        self.held.append(frame)
+        if len(self.held) >= self.hangover_frames:
+            self._end_utterance(events)
+
+    def _end_utterance(self, events):
+        tail = self.held[:self.post_roll_frames]
+        if tail:
+            events.append(('audio', _concat(tail)))
+        speech_ms = self.speech_frames * self.options['frame_ms']
+        events.append(('end', speech_ms, self.speech_frames < self.min_speech_frames))
+        self.pre_roll = self.held[-self.pre_roll_frames:] if self.pre_roll_frames > 0 else []
+        self.held = []
+        self.in_speech = False
+        self.speech_frames = 0
+
+    def flush(self):
+        events = []
+        if self.in_speech:
+            if self.partial:
+                self.held.append(self.partial)
+            self._end_utterance(events)
+        self.partial = array.array('h')
+        self.onset = []
+        return events
+
+
+def _concat(frames):
+    out = array.array('h')
+    for f in frames:
+        out.extend(f)
+    return out
+
+
+def segment(samples, **options):
+    """Run the VAD over a whole buffer; returns a list of (start_ms, end_ms, speech_ms, discard, kept_samples)."""
+    vad = VoiceActivityDetector(**options)
+    frame_ms = vad.options['frame_ms']
+    frame_samples = vad.frame_samples
+    segments = []
+    kept = 0
+    start = None
+    pos = 0
+    for chunk in pcm.iter_chunks(samples, frame_samples):
+        pos += len(chunk)
+        for ev in vad.process(chunk):
+            if ev[0] == 'start':
+                start = pos / frame_samples * frame_ms - vad.onset_frames * frame_ms
+            elif ev[0] == 'audio':
+                kept += len(ev[1])
+            elif ev[0] == 'end':
+                segments.append((start, pos / frame_samples * frame_ms, ev[1], ev[2], kept))
+                kept = 0
+    for ev in vad.flush():
+        if ev[0] == 'audio':
+            kept += len(ev[1])
+        elif ev[0] == 'end':
+            segments.append((start, pos / frame_samples * frame_ms, ev[1], ev[2], kept))
+    return segments
+
+
+def load_samples(path):
+    """Samples from a WAV file or an encoded_records directory (needs full.b64)."""
+    if os.path.isdir(path):
+        full = os.path.join(path, 'full.b64')
+        if not os.path.exists(full) or os.path.getsize(full) == 0:
+            raise RuntimeError(f"{path} has no full.b64 (record with record_encoded.py --full)")
+        with open(full, 'rb') as f:
+            path = io.BytesIO(base64.b64decode(f.read()))
+    return pcm.read_wav(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='+', help='WAV files or encoded_records/<ts> directories')
+    parser.add_argument('--threshold-db', type=float, default=VAD_DEFAULTS['threshold_db'])
+    parser.add_argument('--hangover-ms', type=int, default=VAD_DEFAULTS['hangover_ms'])
+    parser.add_argument('--min-speech-ms', type=int, default=VAD_DEFAULTS['min_speech_ms'])
+    args = parser.parse_args()
+
+    for path in args.inputs:
+        try:
+            samples, sr = load_samples(path)
+        except RuntimeError as e:
+            print(f"{path}: skipped ({e})")
+            continue
+        if sr != VAD_DEFAULTS['sample_rate']:
+            print(f"{path}: warning: {sr} Hz input, VAD frames assume {VAD_DEFAULTS['sample_rate']} Hz", file=sys.stderr)
+        segments = segment(samples, threshold_db=args.threshold_db, hangover_ms=args.hangover_ms,
+                           min_speech_ms=args.min_speech_ms)
+        total_ms = len(samples) * 1000 / sr
+        kept = sum(s[4] for s in segments if not s[3])
+        print(f"{path}: {total_ms:.0f} ms, {len(segments)} utterance(s), "
+              f"kept {kept * 1000 / sr:.0f} ms ({100 * kept / max(1, len(samples)):.1f}%)")
+        for start_ms, end_ms, speech_ms, discard, _ in segments:
+            note = ' (discarded)' if discard else ''
+            print(f"  {start_ms:8.0f} - {end_ms:8.0f} ms  speech {speech_ms} ms{note}")
+
+
+if __name__ == '__main__':
+    main()